@@ -0,0 +1,142 @@
+"""Admission control for the routes that cost the most backend work.
+
+Searching and posting or editing tweets with images make many more backend
+calls and move many more bytes than other requests, so a few users sending
+them in a loop could use up the Firestore quota and the worker for everyone.
+Each such request is let in by two limits before the route reads its body:
+
+- `RateLimiter` gives every signed in user a token bucket per route. A request
+  takes a token, and tokens come back at a steady rate up to a burst, so a user
+  going faster than that is answered 429 Too Many Requests, with a
+  ``Retry-After`` of when their next token is due.
+- `ConcurrencyLimiter` caps how many of these requests a worker has in flight
+  at once. Past the cap new ones are shed straight away with 503 Service
+  Unavailable and a ``Retry-After``, rather than queueing behind a backend that
+  is already slow.
+
+Buckets are kept in-process in a bounded LRU, so each worker enforces the
+rates on its own. For limits that hold across workers they can be kept in a
+shared tier (e.g. Redis) implementing `BucketTier`; when it cannot be reached
+the in-process buckets are used. Every decision is counted in
+``app_admission_decisions_total``.
+
+The limits are configured with environment variables:
+
+- RATE_LIMIT_SEARCH_PER_MINUTE, RATE_LIMIT_SEARCH_BURST: searches per user
+- RATE_LIMIT_UPLOAD_PER_MINUTE, RATE_LIMIT_UPLOAD_BURST: tweets posted or edited per user
+- ADMISSION_MAX_IN_FLIGHT: the most expensive requests in flight per worker
+"""
+import math
+import os
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Protocol
+from metrics import Counter
+
+
+@dataclass(frozen=True)
+class RateLimit:
+    """The rate at which a user may make requests to a route."""
+    per_minute: float  # requests let in per minute once the burst is used up
+    burst: int  # requests let in at once after a quiet spell
+
+    @property
+    def per_second(self):
+        return self.per_minute / 60
+
+
+SEARCH_LIMIT = RateLimit(float(os.environ.get('RATE_LIMIT_SEARCH_PER_MINUTE', 30)), int(os.environ.get('RATE_LIMIT_SEARCH_BURST', 10)))
+UPLOAD_LIMIT = RateLimit(float(os.environ.get('RATE_LIMIT_UPLOAD_PER_MINUTE', 10)), int(os.environ.get('RATE_LIMIT_UPLOAD_BURST', 5)))
+ADMISSION_MAX_IN_FLIGHT = int(os.environ.get('ADMISSION_MAX_IN_FLIGHT', 16))
+BUCKETS_MAX = 100_000  # buckets kept per worker, the least recently used are dropped beyond this
+SHED_RETRY_SECONDS = 1  # Retry-After sent with requests shed by the concurrency limiter
+
+ADMISSIONS = Counter('app_admission_decisions_total', 'Expensive requests by route and decision: admitted, rate_limited or shed.', ('route', 'decision'))
+
+
+class BucketTier(Protocol):
+    """A store of token buckets shared by every worker."""
+
+    def take(self, key, rate, burst):
+        """Take a token from the bucket under `key`, refilled at `rate` per second up to `burst`.
+
+        Returns:
+            0 if a token was taken, or the seconds until one is due.
+        """
+
+
+class RateLimiter:
+    """Token buckets keyed by user and route.
+
+    Args:
+        tier: the shared tier to keep the buckets in, if any.
+        max_buckets: the most buckets kept in-process.
+    """
+
+    def __init__(self, tier: BucketTier | None = None, max_buckets=BUCKETS_MAX):
+        self.tier = tier
+        self.max_buckets = max_buckets
+        self._buckets = OrderedDict()  # key -> (tokens, monotonic time they were counted at)
+        self._lock = threading.Lock()
+
+    def _take_local(self, key, limit, now):
+        with self._lock:
+            tokens, counted_at = self._buckets.pop(key, (limit.burst, now))
+            tokens = min(limit.burst, tokens + (now - counted_at) * limit.per_second)
+            wait = 0.0 if tokens >= 1 else (1 - tokens) / limit.per_second
+            if not wait:
+                tokens -= 1
+            self._buckets[key] = (tokens, now)  # most recently used last
+            if len(self._buckets) > self.max_buckets:
+                self._buckets.popitem(last=False)
+            return wait
+
+    def take(self, user_id, route, limit: RateLimit, now=None):
+        """Take a token from a user's bucket for a route.
+
+        Returns:
+            0 if the request may go ahead, or the seconds until the user's next token is due.
+        """
+        key = f'{route}:{user_id}'
+        if self.tier is not None:
+            try:
+                return self.tier.take(f'ratelimit:{key}', limit.per_second, limit.burst)
+            except Exception as err:
+                print(f"Could not reach the shared rate limit tier, limiting in-process: {err}")
+        return self._take_local(key, limit, time.monotonic() if now is None else now)
+
+
+class Overloaded(Exception):
+    """The worker already has as many expensive requests in flight as allowed."""
+
+
+class ConcurrencyLimiter:
+    """Cap the expensive requests in flight on a worker. Only used from the event loop, so it needs no lock.
+
+    Args:
+        limit: the most requests in flight at once.
+    """
+
+    def __init__(self, limit=ADMISSION_MAX_IN_FLIGHT):
+        self.limit = limit
+        self.in_flight = 0
+
+    def acquire(self):
+        """Take a slot, to be given back with `release` once the request is done.
+
+        Raises:
+            Overloaded: if every slot is taken.
+        """
+        if self.in_flight >= self.limit:
+            raise Overloaded("Too many requests in flight, try again shortly")
+        self.in_flight += 1
+
+    def release(self):
+        self.in_flight -= 1
+
+
+def retryAfter(seconds):
+    """Format a wait as the value of a Retry-After header, in whole seconds and at least one."""
+    return str(max(1, math.ceil(seconds)))
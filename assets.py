@@ -0,0 +1,163 @@
+"""Fingerprinted, precompressed static assets, cached by browsers for good.
+
+`StaticAssets.build` copies every file of the static directory into
+STATIC_BUILD_DIR under a name carrying a hash of its content, such as
+``styles.3f2a9c1b0d4e.css``, and writes gzip compressed copies of the text
+files next to them, plus brotli compressed ones when the `brotli` package is
+installed. The app builds them when it starts; files already built, e.g. by
+running this module when the container image is made, are left as they are.
+
+Templates link assets through `asset_path`, so a page always names the
+current content of an asset. `AssetFiles` serves a fingerprinted name with
+``Cache-Control: immutable`` for a year, since a changed asset gets a new
+name, and picks the smallest copy the browser accepts. Names without a hash,
+as linked before the build, are served with ``no-cache`` so they are
+revalidated. `ImmutableFiles` serves uploaded images stored locally the same
+way, as every upload is stored under a new name (see `images.py`).
+
+    python assets.py
+
+The build directory is set with the STATIC_BUILD_DIR environment variable.
+"""
+import gzip
+import hashlib
+import mimetypes
+import os
+from pathlib import Path, PurePosixPath
+from starlette.datastructures import Headers
+from starlette.responses import FileResponse
+from starlette.staticfiles import NotModifiedResponse, StaticFiles
+
+try:
+    import brotli
+except ImportError:  # optional, browsers get gzip without it
+    brotli = None
+
+STATIC_BUILD_DIR = os.environ.get('STATIC_BUILD_DIR', 'build/static')
+HASH_LENGTH = 12  # hex digits of the content hash put in fingerprinted names
+COMPRESSIBLE = {'.css', '.js', '.mjs', '.json', '.map', '.svg', '.txt', '.html', '.xml'}
+COMPRESS_MIN_BYTES = 256  # smaller files gain too little from compression to be worth a variant
+IMMUTABLE = 'public, max-age=31536000, immutable'
+REVALIDATE = 'no-cache'
+ENCODINGS = (('br', '.br'), ('gzip', '.gz'))  # in order of preference
+
+
+def fingerprintedName(name, data):
+    """Return the name of an asset with the hash of its content before its extension."""
+    path = PurePosixPath(name)
+    return str(path.with_name(f'{path.stem}.{hashlib.sha256(data).hexdigest()[:HASH_LENGTH]}{path.suffix}'))
+
+
+def _write(path, data):
+    """Write a file unless it already holds `data`, replacing it atomically so workers starting together don't clash."""
+    if path.is_file() and path.read_bytes() == data:
+        return
+    path.parent.mkdir(parents=True, exist_ok=True)
+    temporary = path.with_name(f'.{path.name}.{os.getpid()}.tmp')
+    temporary.write_bytes(data)
+    os.replace(temporary, path)
+
+
+def _compressed(data):
+    """Yield the suffix and content of each compressed variant worth keeping of an asset."""
+    yield '.gz', gzip.compress(data, compresslevel=9, mtime=0)  # no timestamp, so a rebuild writes the same bytes
+    if brotli is not None:
+        yield '.br', brotli.compress(data, quality=11)
+
+
+class StaticAssets:
+    """The static directory and its build.
+
+    Args:
+        source: the directory the assets are kept in.
+        output: the directory they are built into.
+    """
+
+    def __init__(self, source='static', output=STATIC_BUILD_DIR):
+        self.source = Path(source)
+        self.output = Path(output)  # created by `build`
+        self.manifest = {}  # asset name -> fingerprinted name
+        self._fingerprinted = set()
+
+    def build(self):
+        """Write the fingerprinted and compressed copies of every asset.
+
+        Returns:
+            the number of assets built.
+        """
+        manifest = {}
+        for file in sorted(self.source.rglob('*')):
+            if not file.is_file():
+                continue
+            name = file.relative_to(self.source).as_posix()
+            data = file.read_bytes()
+            manifest[name] = fingerprintedName(name, data)
+            for built_name in (name, manifest[name]):
+                _write(self.output / built_name, data)
+                if file.suffix in COMPRESSIBLE and len(data) >= COMPRESS_MIN_BYTES:
+                    for suffix, compressed in _compressed(data):
+                        if len(compressed) < len(data):
+                            _write(self.output / (built_name + suffix), compressed)
+        self.manifest = manifest
+        self._fingerprinted = set(manifest.values())
+        return len(manifest)
+
+    def path(self, name):
+        """Return the path to link an asset at, fingerprinted once the assets are built.
+
+        Args:
+            name: the asset's path in the static directory, e.g. `/styles.css`.
+        """
+        name = name.lstrip('/')
+        return '/' + self.manifest.get(name, name)
+
+    def isFingerprinted(self, full_path):
+        """Return whether a built file is the fingerprinted copy of an asset."""
+        path, output = Path(full_path).resolve(), self.output.resolve()
+        return path.is_relative_to(output) and path.relative_to(output).as_posix() in self._fingerprinted
+
+
+class ImmutableFiles(StaticFiles):
+    """Serve files that never change once stored, letting browsers cache them for good."""
+
+    def file_response(self, full_path, stat_result, scope, status_code=200):
+        response = super().file_response(full_path, stat_result, scope, status_code)
+        response.headers['Cache-Control'] = IMMUTABLE
+        return response
+
+
+class AssetFiles(StaticFiles):
+    """Serve built assets, compressed if the browser accepts it, caching fingerprinted ones for good.
+
+    Args:
+        assets: the StaticAssets to serve.
+    """
+
+    def __init__(self, assets: StaticAssets):
+        super().__init__()
+        self.all_directories = [assets.output, assets.source]  # until the assets are built, serve them as they are
+        self.assets = assets
+
+    def file_response(self, full_path, stat_result, scope, status_code=200):
+        request_headers = Headers(scope=scope)
+        accepted = request_headers.get('accept-encoding', '')
+        headers = {
+            'Cache-Control': IMMUTABLE if self.assets.isFingerprinted(full_path) else REVALIDATE,
+            'Vary': 'Accept-Encoding',
+        }
+        for encoding, suffix in ENCODINGS:
+            if encoding in accepted and os.path.isfile(full_path + suffix):
+                full_path, stat_result = full_path + suffix, os.stat(full_path + suffix)
+                headers['Content-Encoding'] = encoding
+                media_type = mimetypes.guess_type(full_path[:-len(suffix)])[0]
+                break
+        else:
+            media_type = None  # guessed from the file name
+        response = FileResponse(full_path, status_code=status_code, headers=headers, media_type=media_type, stat_result=stat_result, method=scope['method'])
+        if self.is_not_modified(response.headers, request_headers):
+            return NotModifiedResponse(response.headers)
+        return response
+
+
+if __name__ == '__main__':
+    print(f"Built {StaticAssets().build()} static assets into {STATIC_BUILD_DIR}.")
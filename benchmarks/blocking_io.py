@@ -0,0 +1,130 @@
+"""Benchmark one worker's throughput with blocking backend calls made inline and offloaded.
+
+The app is run in process behind an ASGI client, as in `benchmarks.load_test`,
+on the SQLite backend with a synthetic social graph, so no emulator is needed.
+Every repository call is made to block for the given latency first, standing in
+for the round trip of a synchronous Firestore call. The same mix of routes is
+then driven by concurrent virtual users twice:
+
+- inline: the routes call the backend straight from the event loop, as they used to
+- offloaded: the routes await their calls through `blocking.runBlocking` and
+  `blocking.gatherBlocking`, as they do now
+
+Run from the repository root::
+
+    python -m benchmarks.blocking_io --requests 500 --concurrency 20 --latency 20
+"""
+import argparse
+import asyncio
+import os
+import random
+import tempfile
+import time
+from datetime import datetime, timedelta, timezone
+import metrics
+from blocking import IO_MAX_WORKERS
+from firebase_auth import StaticCertSource
+from benchmarks.load_test import ROUTES, TokenSigner, drive, percentile, zipfWeights
+
+READ_ROUTES = [name for name in ROUTES if name != 'post']  # posting also enqueues jobs and stores files, which are not compared here
+VOCABULARY_SIZE = 500
+
+
+class DelayedRepository:
+    """Wrap a repository so every call blocks for `latency` seconds before it is made."""
+
+    def __init__(self, repository, latency):
+        self.repository = repository
+        self.latency = latency
+
+    def __getattr__(self, name):
+        attribute = getattr(self.repository, name)
+        if not callable(attribute):
+            return attribute
+
+        def delayed(*args, **kwargs):
+            time.sleep(self.latency)
+            return attribute(*args, **kwargs)
+        return delayed
+
+
+async def runInline(function, *args, **kwargs):
+    """Make a blocking call straight from the event loop, as the routes did before `runBlocking`."""
+    return function(*args, **kwargs)
+
+
+async def gatherInline(*calls):
+    return [function(*args) for function, *args in calls]
+
+
+def seed(repository, rng, users, follows, tweets):
+    """Seed a synthetic social graph through the repository.
+
+    Returns:
+        the user ids and usernames of the users, and the words tweets are made of.
+    """
+    people = [(f'user{index:05d}', f'person{index:05d}') for index in range(users)]
+    words = [f'word{index}' for index in range(VOCABULARY_SIZE)]
+    popularity, word_weights = zipfWeights(users), zipfWeights(VOCABULARY_SIZE)
+    now = datetime.now(timezone.utc)
+    for user_id, username in people:
+        repository.loadUser({'user_id': user_id})
+        repository.claimUsername(user_id, username)
+    for user_id, username in people:
+        for index in set(rng.choices(range(users), popularity, k=rng.randint(0, 2 * follows))):
+            if people[index][0] != user_id:
+                repository.addFollow(user_id, username, *people[index])
+        for _ in range(rng.randint(0, 2 * tweets)):
+            repository.addTweet({
+                'author_id': user_id,
+                'username': username,
+                'date': now - timedelta(seconds=rng.randint(0, 30 * 24 * 3600)),
+                'body': ' '.join(rng.choices(words, word_weights, k=rng.randint(3, 20))),
+                'image_url': '',
+                'blob_name': '',
+            })
+    return people, words
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=100, help='number of users to seed')
+    parser.add_argument('--follows', type=int, default=10, help='average number of users each user follows')
+    parser.add_argument('--tweets', type=int, default=10, help='average number of tweets per user')
+    parser.add_argument('--concurrency', type=int, default=20, help='number of virtual users sending requests at once')
+    parser.add_argument('--requests', type=int, default=500, help='number of requests sent in each mode')
+    parser.add_argument('--latency', type=float, default=20, help='latency added to each backend call in milliseconds')
+    parser.add_argument('--seed', type=int, default=1, help='random seed, so runs are reproducible')
+    args = parser.parse_args()
+
+    data_dir = tempfile.mkdtemp(prefix='blocking-io-')
+    os.environ['DATA_BACKEND'] = 'sqlite'
+    os.environ['SQLITE_DB_PATH'] = os.path.join(data_dir, 'data.sqlite3')
+    os.environ['STORAGE_BACKEND'] = 'local'
+    os.environ['STORAGE_LOCAL_ROOT'] = os.path.join(data_dir, 'media')
+    os.environ['JOBS_DB_PATH'] = os.path.join(data_dir, 'jobs.sqlite3')
+    for name in ('RATE_LIMIT_SEARCH_PER_MINUTE', 'RATE_LIMIT_SEARCH_BURST', 'ADMISSION_MAX_IN_FLIGHT'):
+        os.environ.setdefault(name, '1000000')  # measure the routes, not admission control
+    metrics.SLOW_REQUEST_SECONDS = float('inf')  # every request is slow by design here
+
+    import main as app_module  # after the environment is set, since the app configures itself on import
+
+    signer = TokenSigner(app_module.token_verifier.project_id)
+    app_module.token_verifier.cert_source = StaticCertSource(signer.certs)
+    rng = random.Random(args.seed)
+    people, words = seed(app_module.repository, rng, args.users, args.follows, args.tweets)
+    app_module.repository = DelayedRepository(app_module.repository, args.latency / 1000)
+    offloaded = (app_module.runBlocking, app_module.gatherBlocking)
+    asyncio.run(drive(app_module.app, signer, people, words, READ_ROUTES, 1, len(READ_ROUTES) * 4, rng))  # compile templates and fill caches first
+
+    print(f"{args.requests} requests from {args.concurrency} users, {args.latency}ms per backend call, {IO_MAX_WORKERS} I/O threads")
+    for mode, (run_blocking, gather_blocking) in [('inline', (runInline, gatherInline)), ('offloaded', offloaded)]:
+        app_module.runBlocking, app_module.gatherBlocking = run_blocking, gather_blocking
+        latencies, errors, elapsed = asyncio.run(drive(app_module.app, signer, people, words, READ_ROUTES, args.concurrency, args.requests, random.Random(args.seed)))
+        served = [latency for route in READ_ROUTES for latency in latencies[route]]
+        print(f"{mode:>10}: {len(served) / elapsed:8.1f} requests/s, p50 {percentile(served, 0.5) * 1000:8.1f}ms, "
+              f"p99 {percentile(served, 0.99) * 1000:8.1f}ms, {sum(errors.values())} errors")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,106 @@
+"""Benchmark how fast a new instance of the app can serve.
+
+Each run starts a fresh Python process, as a new container or worker would,
+and measures the time to import the app, to run its startup warm-up, and to
+answer the first and second request to each path. Runs are made both with the
+warm-up, as the app is served, and without it, to show what the warm-up moves
+out of the first requests, and both signed out and signed in, with a token
+signed by a key generated for the run.
+
+The app is configured by the environment as usual, so point it at the
+Firestore emulator or a test project. Run from the repository root::
+
+    FIRESTORE_EMULATOR_HOST=localhost:8080 python -m benchmarks.cold_start --runs 5
+    DATA_BACKEND=sqlite STORAGE_BACKEND=local python -m benchmarks.cold_start --runs 5
+
+The local backends have no connections to open, and the certificates come from
+the generated key, so there only the template and thread pool steps show; the
+database, certificate and storage steps pay off against Firestore, Google and
+Cloud Storage.
+"""
+import argparse
+import asyncio
+import json
+import statistics
+import subprocess
+import sys
+import time
+
+DEFAULT_PATHS = ('/healthz', '/readyz', '/')
+
+
+async def measure(paths, warm_up, signed_in):
+    """Import the app and time its start and first requests, in this process.
+
+    Returns:
+        a dict of the seconds taken by each stage.
+    """
+    import httpx
+
+    start = time.perf_counter()
+    import main
+    timings = {'import': time.perf_counter() - start}
+
+    from benchmarks.load_test import TokenSigner  # after timing the import, since it imports parts of the app too
+    from firebase_auth import StaticCertSource
+    signer = TokenSigner(main.token_verifier.project_id)
+    main.token_verifier.cert_source = StaticCertSource(signer.certs)
+    cookies = {'token': signer.token('cold-start-user')} if signed_in else {}
+
+    async def requests():
+        transport = httpx.ASGITransport(app=main.app)
+        async with httpx.AsyncClient(transport=transport, base_url='http://cold-start', cookies=cookies) as client:
+            for path in paths:
+                for attempt in ('first', 'second'):
+                    start = time.perf_counter()
+                    response = await client.get(path)
+                    timings[f'{attempt} {path}'] = time.perf_counter() - start
+                    if response.status_code == 500:  # a 503 from the readiness probe before warm-up is expected
+                        raise RuntimeError(f"{path} answered {response.status_code}")
+
+    if warm_up:
+        start = time.perf_counter()
+        async with main.app.router.lifespan_context(main.app):
+            timings['warm-up'] = time.perf_counter() - start
+            await requests()
+    else:
+        await requests()
+    return timings
+
+
+def runChild(paths, warm_up, signed_in):
+    """Measure a start of the app in a fresh Python process."""
+    command = [sys.executable, '-m', 'benchmarks.cold_start', '--child', '--paths', ','.join(paths)]
+    if not warm_up:
+        command.append('--no-warm-up')
+    if signed_in:
+        command.append('--signed-in')
+    output = subprocess.run(command, check=True, capture_output=True, text=True).stdout
+    return json.loads(output.strip().splitlines()[-1])  # the app may print while it starts
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--runs', type=int, default=5, help='number of fresh processes started for each mode')
+    parser.add_argument('--paths', default=','.join(DEFAULT_PATHS), help='comma separated paths to request')
+    parser.add_argument('--no-warm-up', action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument('--signed-in', action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument('--child', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    paths = args.paths.split(',')
+
+    if args.child:
+        print(json.dumps(asyncio.run(measure(paths, not args.no_warm_up, args.signed_in))))
+        return
+
+    for signed_in in (False, True):
+        for warm_up in (True, False):
+            runs = [runChild(paths, warm_up, signed_in) for _ in range(args.runs)]
+            print(f"{'signed in' if signed_in else 'signed out'}, {'with' if warm_up else 'without'} warm-up ({args.runs} runs)")
+            for stage in runs[0]:
+                values = [run[stage] * 1000 for run in runs]
+                print(f"  {stage:<24} median {statistics.median(values):8.1f}ms  max {max(values):8.1f}ms")
+
+
+if __name__ == '__main__':
+    main()
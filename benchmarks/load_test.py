@@ -0,0 +1,311 @@
+"""Load test the app against the Firestore emulator and local image storage.
+
+The app is run in process behind an ASGI client, with Firestore pointed at the
+emulator, images stored in a temporary directory and Firebase ID tokens signed
+with a key generated for the run. A synthetic social graph is seeded first:
+users whose follows favour a few popular accounts, and tweets whose words
+favour a few common ones, so timelines, profiles and searches all have data to
+work through. The routes are then driven by concurrent virtual users.
+
+For each route it reports the median and 99th percentile latency and the
+Firestore and storage calls and document reads made per request, plus the
+overall throughput. Results can be saved and later runs compared against them,
+failing when a route got slower or makes more backend calls.
+
+Needs the Firestore emulator (`gcloud emulators firestore start`) and httpx.
+Run from the repository root::
+
+    FIRESTORE_EMULATOR_HOST=localhost:8080 python -m benchmarks.load_test --users 200 --concurrency 20 --requests 2000
+    FIRESTORE_EMULATOR_HOST=localhost:8080 python -m benchmarks.load_test --compare baseline.json
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta, timezone
+import google.auth.jwt
+import httpx
+import requests
+import rsa
+from google.auth import crypt
+import metrics
+from cards import backfillCards
+from firebase_auth import StaticCertSource
+from follows import migrateFollowArrays
+from search_index import normalizeUsername, rebuildIndex
+from users import newUserData, rebuildUsernameRegistry
+
+ROUTES = {
+    # name: (weight, endpoint name the metrics are labelled with)
+    'home': (40, 'root'),
+    'profile': (15, 'viewYourProfile'),
+    'view-profile': (20, 'viewOthersProfile'),
+    'search-tweet': (10, 'searchTweet'),
+    'search-username': (10, 'searchUsername'),
+    'post': (5, 'addTweet'),
+}
+VOCABULARY_SIZE = 2000  # distinct words tweets are made of
+KEY_ID = 'load-test'
+
+
+def zipfWeights(count, exponent=1.1):
+    """Return weights that favour the first items, as follows and word use do."""
+    return [1 / (rank + 1) ** exponent for rank in range(count)]
+
+
+class TokenSigner:
+    """Sign Firebase ID tokens with a key generated for the run."""
+
+    def __init__(self, project_id):
+        public_key, private_key = rsa.newkeys(2048)
+        self.project_id = project_id
+        self.signer = crypt.RSASigner.from_string(private_key.save_pkcs1(), key_id=KEY_ID)
+        self.certs = {KEY_ID: public_key.save_pkcs1().decode('utf-8')}
+
+    def token(self, user_id):
+        now = int(time.time())
+        claims = {
+            'iss': f'https://securetoken.google.com/{self.project_id}',
+            'aud': self.project_id,
+            'sub': user_id,
+            'user_id': user_id,
+            'auth_time': now,
+            'iat': now,
+            'exp': now + 3600,
+        }
+        return google.auth.jwt.encode(self.signer, claims).decode('utf-8')
+
+
+def resetEmulator(db):
+    """Delete every document in the emulator."""
+    host = os.environ['FIRESTORE_EMULATOR_HOST']
+    response = requests.delete(f'http://{host}/emulator/v1/projects/{db.project}/databases/(default)/documents')
+    response.raise_for_status()
+
+
+def seed(db, rng, users, follows, tweets):
+    """Seed a synthetic social graph.
+
+    Args:
+        users: the number of users.
+        follows: the average number of users each user follows.
+        tweets: the average number of tweets posted by each user.
+    Returns:
+        the user ids and usernames of the users, and the words tweets are made of.
+    """
+    user_ids = [f'user{index:05d}' for index in range(users)]
+    usernames = [f'person{index:05d}' for index in range(users)]
+    words = [f'word{index}' for index in range(VOCABULARY_SIZE)]
+    popularity, word_weights = zipfWeights(users), zipfWeights(VOCABULARY_SIZE)
+    now = datetime.now(timezone.utc)
+
+    writer = db.bulk_writer()
+    for user_id, username in zip(user_ids, usernames):
+        following = {usernames[index] for index in rng.choices(range(users), popularity, k=rng.randint(0, 2 * follows))}
+        following.discard(username)
+        writer.set(db.collection('User').document(user_id), dict(
+            newUserData(),
+            username=username,
+            username_lower=normalizeUsername(username),
+            following=sorted(following),  # moved into the follow graph below
+        ))
+        for _ in range(rng.randint(0, 2 * tweets)):
+            writer.set(db.collection('Tweet').document(), {
+                'author_id': user_id,
+                'username': username,
+                'date': now - timedelta(seconds=rng.randint(0, 30 * 24 * 3600)),
+                'body': ' '.join(rng.choices(words, word_weights, k=rng.randint(3, 20))),
+                'image_url': '',
+                'blob_name': '',
+            })
+    writer.close()
+
+    rebuildUsernameRegistry(db)
+    migrateFollowArrays(db)
+    rebuildIndex(db)
+    backfillCards(db)
+    return list(zip(user_ids, usernames)), words
+
+
+async def request(client, route, rng, usernames, words):
+    """Make one request to `route`, returning its status code."""
+    if route == 'home':
+        response = await client.get('/')
+    elif route == 'profile':
+        response = await client.get('/profile')
+    elif route == 'view-profile':
+        response = await client.get(f'/view-profile/{rng.choice(usernames)}')
+    elif route == 'search-tweet':
+        response = await client.post('/search-tweet', data={'content': ' '.join(rng.sample(words[:50], 2))})
+    elif route == 'search-username':
+        response = await client.post('/search-username', data={'username': rng.choice(usernames)[:8]})
+    else:
+        response = await client.post('/post', data={'tweet': ' '.join(rng.choices(words[:200], k=10))}, files={'tweetImage': ('', b'')})
+    return response.status_code
+
+
+async def drive(app, signer, people, words, routes, concurrency, total, rng):
+    """Send `total` requests from `concurrency` virtual users at once.
+
+    Returns:
+        the latencies in seconds of the successful requests by route, the number of failed requests by
+        route, and the time taken.
+    """
+    usernames = [username for _, username in people]
+    names, weights = zip(*((name, ROUTES[name][0]) for name in routes))
+    latencies = {name: [] for name in routes}
+    errors = dict.fromkeys(routes, 0)
+    remaining = total
+
+    async def virtualUser(seed):
+        nonlocal remaining
+        user_rng = random.Random(seed)
+        user_id, _ = user_rng.choice(people)
+        transport = httpx.ASGITransport(app=app, raise_app_exceptions=False)  # count errors as failed requests
+        async with httpx.AsyncClient(transport=transport, base_url='http://load-test', cookies={'token': signer.token(user_id)}) as client:
+            while remaining > 0:
+                remaining -= 1
+                route = user_rng.choices(names, weights)[0]
+                start = time.perf_counter()
+                status = await request(client, route, user_rng, usernames, words)
+                if status < 400:
+                    latencies[route].append(time.perf_counter() - start)
+                else:
+                    errors[route] += 1
+
+    start = time.perf_counter()
+    await asyncio.gather(*(virtualUser(rng.random()) for _ in range(concurrency)))
+    return latencies, errors, time.perf_counter() - start
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+def perRoute(counter_before, counter_after, index):
+    """Sum the increase of a counter by route and the label at `index`."""
+    totals = {}
+    for labels, value in counter_after.items():
+        key = (labels[0], labels[index])
+        totals[key] = totals.get(key, 0) + value - counter_before.get(labels, 0)
+    return totals
+
+
+def report(routes, latencies, errors, elapsed, calls, reads):
+    """Summarize the run, by route."""
+    results = {'throughput': sum(map(len, latencies.values())) / elapsed, 'routes': {}}
+    for name in routes:
+        served = len(latencies[name]) + errors[name]
+        if not served:
+            continue
+        endpoint = ROUTES[name][1]
+        results['routes'][name] = {
+            'requests': served,
+            'errors': errors[name],
+            'p50_ms': percentile(latencies[name], 0.5) * 1000 if latencies[name] else None,
+            'p99_ms': percentile(latencies[name], 0.99) * 1000 if latencies[name] else None,
+            'firestore_calls': calls.get((endpoint, 'firestore'), 0) / served,
+            'firestore_reads': reads.get((endpoint, 'firestore'), 0) / served,
+            'storage_calls': calls.get((endpoint, 'storage'), 0) / served,
+        }
+    return results
+
+
+def printReport(results):
+    print(f"{'route':>16} {'requests':>8} {'errors':>6} {'p50 ms':>8} {'p99 ms':>8} {'fs calls':>8} {'fs reads':>8} {'gcs calls':>9}")
+    for name, route in results['routes'].items():
+        p50 = f"{route['p50_ms']:8.1f}" if route['p50_ms'] is not None else f"{'-':>8}"
+        p99 = f"{route['p99_ms']:8.1f}" if route['p99_ms'] is not None else f"{'-':>8}"
+        print(f"{name:>16} {route['requests']:8d} {route['errors']:6d} {p50} {p99} "
+              f"{route['firestore_calls']:8.1f} {route['firestore_reads']:8.1f} {route['storage_calls']:9.1f}")
+    print(f"throughput: {results['throughput']:.1f} requests/s")
+
+
+def regressions(results, baseline, tolerance):
+    """List the routes that got slower or make more backend calls than in `baseline`, beyond `tolerance`."""
+    found = []
+    for name, route in results['routes'].items():
+        before = baseline['routes'].get(name)
+        if before is None:
+            continue
+        for key in ('p99_ms', 'firestore_calls', 'firestore_reads', 'storage_calls'):
+            if route[key] is not None and before[key] is not None and route[key] > before[key] * (1 + tolerance) + 1e-9:
+                found.append(f"{name} {key}: {before[key]:.1f} -> {route[key]:.1f}")
+    if results['throughput'] < baseline['throughput'] * (1 - tolerance):
+        found.append(f"throughput: {baseline['throughput']:.1f} -> {results['throughput']:.1f}")
+    return found
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=200, help='number of users to seed')
+    parser.add_argument('--follows', type=int, default=20, help='average number of users each user follows')
+    parser.add_argument('--tweets', type=int, default=20, help='average number of tweets per user')
+    parser.add_argument('--concurrency', type=int, default=20, help='number of virtual users sending requests at once')
+    parser.add_argument('--requests', type=int, default=2000, help='total number of requests to send')
+    parser.add_argument('--routes', default=','.join(ROUTES), help='comma separated routes to drive, out of ' + ', '.join(ROUTES))
+    parser.add_argument('--seed', type=int, default=1, help='random seed, so runs are reproducible')
+    parser.add_argument('--no-reset', action='store_true', help='keep the data already in the emulator instead of seeding')
+    parser.add_argument('--save', help='save the results as JSON to this file')
+    parser.add_argument('--compare', help='compare the results with those saved in this file, failing on regressions')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='fraction a metric may get worse by before it is a regression')
+    args = parser.parse_args()
+
+    if not os.environ.get('FIRESTORE_EMULATOR_HOST'):
+        sys.exit("Set FIRESTORE_EMULATOR_HOST to the address of the Firestore emulator.")
+    routes = args.routes.split(',')
+    if unknown := set(routes) - set(ROUTES):
+        sys.exit(f"Unknown routes: {', '.join(sorted(unknown))}")
+    os.environ['DATA_BACKEND'] = 'firestore'
+    os.environ['STORAGE_BACKEND'] = 'local'
+    os.environ['STORAGE_LOCAL_ROOT'] = tempfile.mkdtemp(prefix='load-test-media-')
+    os.environ['JOBS_DB_PATH'] = os.path.join(tempfile.mkdtemp(prefix='load-test-jobs-'), 'jobs.sqlite3')
+    for name in ('RATE_LIMIT_SEARCH_PER_MINUTE', 'RATE_LIMIT_SEARCH_BURST', 'RATE_LIMIT_UPLOAD_PER_MINUTE', 'RATE_LIMIT_UPLOAD_BURST', 'ADMISSION_MAX_IN_FLIGHT'):
+        os.environ.setdefault(name, '1000000')  # the report covers the routes, set these to load test admission control too
+    if 'SLOW_REQUEST_SECONDS' not in os.environ:
+        metrics.SLOW_REQUEST_SECONDS = float('inf')  # the report covers latency, keep the output readable
+
+    import main as app_module  # after the environment is set, since the app configures itself on import
+
+    signer = TokenSigner(app_module.token_verifier.project_id)
+    app_module.token_verifier.cert_source = StaticCertSource(signer.certs)
+    rng = random.Random(args.seed)
+    db = app_module.repository.db
+
+    if args.no_reset:
+        people = [(user.id, user.get('username')) for user in db.collection('User').stream() if user.get('username')]
+        words = [f'word{index}' for index in range(VOCABULARY_SIZE)]
+    else:
+        resetEmulator(db)
+        start = time.perf_counter()
+        people, words = seed(db, rng, args.users, args.follows, args.tweets)
+        print(f"Seeded {len(people)} users in {time.perf_counter() - start:.1f}s")
+
+    calls_before, reads_before = metrics.BACKEND_CALLS.snapshot(), metrics.BACKEND_READS.snapshot()
+    app_module.job_queue.start()  # background jobs run alongside, their backend calls are not counted against a route
+    latencies, errors, elapsed = asyncio.run(drive(app_module.app, signer, people, words, routes, args.concurrency, args.requests, rng))
+    app_module.job_queue.stop()
+    calls = perRoute(calls_before, metrics.BACKEND_CALLS.snapshot(), 1)
+    reads = perRoute(reads_before, metrics.BACKEND_READS.snapshot(), 1)
+
+    results = report(routes, latencies, errors, elapsed, calls, reads)
+    printReport(results)
+    if args.save:
+        with open(args.save, 'w') as file:
+            json.dump(results, file, indent=2)
+    if args.compare:
+        with open(args.compare) as file:
+            found = regressions(results, json.load(file), args.tolerance)
+        for regression in found:
+            print(f"Regression: {regression}")
+        if found:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,239 @@
+"""Check that a repository backend behaves as `repository.Repository` describes, and time its operations.
+
+The same scenario is run against every backend: users sign in and choose
+usernames, follow and unfollow each other, and post, edit and delete tweets,
+while their profiles, timelines and searches are paged through. Each result is
+checked against what the interface promises, so a backend that passes serves
+the app the same way as the others, and the time taken by each operation is
+reported.
+
+The SQLite backend runs on a temporary database. The Firestore backend needs
+the emulator, which is cleared first. Run from the repository root::
+
+    python -m benchmarks.repositories
+    FIRESTORE_EMULATOR_HOST=localhost:8080 python -m benchmarks.repositories --backend firestore
+"""
+import argparse
+import os
+import statistics
+import sys
+import tempfile
+import time
+from collections import defaultdict
+from datetime import datetime, timedelta
+from repository import TweetChanged
+from tweets import PAGE_SIZE
+from users import UsernameRejected
+
+BACKENDS = ('sqlite', 'firestore')
+START = datetime(2024, 1, 1, 12, 0, 0)  # naive, as the routes date tweets
+
+
+def createBackend(name):
+    """Create an empty repository of the named backend."""
+    if name == 'sqlite':
+        from sqlite_repository import SqliteRepository
+        return SqliteRepository(os.path.join(tempfile.mkdtemp(prefix='repositories-'), 'data.sqlite3'))
+
+    if not os.environ.get('FIRESTORE_EMULATOR_HOST'):
+        sys.exit("Set FIRESTORE_EMULATOR_HOST to the address of the Firestore emulator.")
+    from google.cloud import firestore
+    from benchmarks.load_test import resetEmulator
+    from read_cache import ReadCache
+    from repository import FirestoreRepository
+    db = firestore.Client()
+    resetEmulator(db)
+    return FirestoreRepository(db, ReadCache())
+
+
+class Run:
+    """The timed calls made to a repository and the checks that failed."""
+
+    def __init__(self, repository):
+        self.repository = repository
+        self.seconds = defaultdict(list)  # operation -> seconds taken by each call
+        self.failures = []
+
+    def call(self, operation, *args, **kwargs):
+        """Call an operation of the repository, timing it."""
+        start = time.perf_counter()
+        try:
+            return getattr(self.repository, operation)(*args, **kwargs)
+        finally:
+            self.seconds[operation].append(time.perf_counter() - start)
+
+    def check(self, description, condition):
+        if not condition:
+            self.failures.append(description)
+
+    def raises(self, description, error, operation, *args):
+        """Check that an operation fails with `error`."""
+        try:
+            self.call(operation, *args)
+        except error:
+            return
+        except Exception as err:
+            self.failures.append(f"{description}: raised {err!r}")
+            return
+        self.failures.append(f"{description}: did not raise {error.__name__}")
+
+    def pages(self, operation, *args):
+        """Page through a list of tweets to the end, returning the ids of the tweets in order."""
+        ids, cursor = [], None
+        while True:
+            cards, cursor = self.call(operation, *args, cursor=cursor)
+            self.check(f"{operation} returns full pages until the last", cursor is None or len(cards) == PAGE_SIZE)
+            ids.extend(card['id'] for card in cards)
+            if cursor is None:
+                return ids
+
+    def searchIds(self, query):
+        """Page through the results of a tweet search, returning the ids of the tweets found."""
+        ids, page = [], 1
+        while True:
+            cards, has_next_page = self.call('searchTweets', query, page)
+            ids.extend(card['id'] for card in cards)
+            if not has_next_page:
+                return ids
+            page += 1
+
+
+class Notifications:
+    """Record what the fan-out jobs notify."""
+
+    def __init__(self):
+        self.events = []
+
+    def __call__(self, user_ids, event, data):
+        self.events.append((set(user_ids), event, data))
+
+
+def tweetData(author_id, username, body, date, **image_fields):
+    return {'author_id': author_id, 'username': username, 'date': date, 'body': body, 'image_url': '', 'blob_name': '', **image_fields}
+
+
+def runScenario(run, tweets):
+    """Run the scenario against a repository, recording failed checks on `run`.
+
+    Args:
+        tweets: the number of tweets the first user posts, more than a page of them.
+    """
+    alice, bob, carol = 'user-alice', 'user-bob', 'user-carol'
+
+    # users and usernames
+    for user_id in (alice, bob, carol):
+        user = run.call('loadUser', {'user_id': user_id})
+        run.check("a new user has no username and no follows", (user.user_id, user.username, user.following_count, user.followers_count) == (user_id, '', 0, 0))
+    run.check("loading a user again finds the same user", run.call('loadUser', {'user_id': alice}).user_id == alice)
+    run.call('claimUsername', alice, 'Alice')
+    run.call('claimUsername', bob, 'bob')
+    run.call('claimUsername', carol, 'Alicia')
+    run.call('claimUsername', alice, 'Alice')  # claiming the username a user has again changes nothing
+    run.raises("claiming a taken username", UsernameRejected, 'claimUsername', carol, 'Alice')
+    run.raises("claiming a second username", UsernameRejected, 'claimUsername', alice, 'Alicia2')
+    run.raises("claiming an invalid username", UsernameRejected, 'claimUsername', 'user-dave', 'a/b')
+    run.check("a username finds its user", run.call('userIdForUsername', 'Alice') == alice)
+    run.check("an unclaimed username finds nobody", run.call('userIdForUsername', 'nobody') is None)
+    run.check("the loaded user has their username", run.call('loadUser', {'user_id': alice}).username == 'Alice')
+    users, cursor = run.call('searchUsernames', 'ALI')
+    run.check("a username search matches prefixes ignoring case, in order", ([user.username for user in users], cursor) == (['Alice', 'Alicia'], None))
+    run.check("an empty username search finds nobody", run.call('searchUsernames', ' ') == ([], None))
+
+    # follows
+    run.check("following a user", run.call('addFollow', bob, 'bob', alice, 'Alice') is True)
+    run.check("following a user again", run.call('addFollow', bob, 'bob', alice, 'Alice') is False)
+    run.raises("following oneself", ValueError, 'addFollow', alice, 'Alice', alice, 'Alice')
+    run.check("a follow is found", run.call('isFollowing', bob, alice) and not run.call('isFollowing', alice, bob))
+    run.check("a follow counts for both users", (run.call('userData', alice)['followers_count'], run.call('userData', bob)['following_count']) == (1, 1))
+
+    # posting, with the fan-out job notifying followers
+    notifications = Notifications()
+    posted = []
+    for index in range(tweets):
+        card = run.call('addTweet', tweetData(alice, 'Alice', f'hello world number{index}', START + timedelta(seconds=index)))
+        run.call('pushToFollowerTimelines', alice, card['id'], notify=notifications)
+        posted.append(card['id'])
+    run.check("a new tweet's card copies the tweet", card['body'] == f'hello world number{tweets - 1}' and card['username'] == 'Alice' and card['date'].tzinfo is not None)
+    run.check("a new tweet is notified to the followers", notifications.events[-1][:2] == ({bob}, 'tweet') and notifications.events[-1][2]['id'] == posted[-1])
+    bob_tweet = run.call('addTweet', tweetData(bob, 'bob', 'Bob says HELLO', START + timedelta(days=1)))['id']
+    newest_first = posted[::-1]
+    run.check("a profile pages through the author's tweets, newest first", run.pages('tweetsByAuthor', alice) == newest_first)
+    run.check("a timeline holds the user's and the followed users' tweets, newest first", run.pages('timeline', bob, 'bob') == [bob_tweet] + newest_first)
+    run.check("a timeline without follows holds the user's tweets", run.pages('timeline', alice, 'Alice') == newest_first)
+    run.check("a timeline of a user without tweets or follows is empty", run.call('timeline', carol, 'Alicia') == ([], None))
+
+    # searching
+    run.check("a search matches every word by prefix, over every page", sorted(run.searchIds('hello WOR')) == sorted(posted))
+    run.check("a search matches whole words", run.searchIds('number7') == [posted[7]])
+    run.check("a search ignores case", run.searchIds('bob hello') == [bob_tweet])
+    run.check("a search with no words finds nothing", run.call('searchTweets', '!?') == ([], False))
+
+    # editing, refused when the tweet changed since it was read
+    tweet = run.call('getTweet', posted[0])
+    run.check("a tweet is read with its fields", tweet.id == posted[0] and tweet.data['body'] == 'hello world number0' and tweet.record['id'] == posted[0])
+    card = run.call('editTweet', tweet, {'body': 'edited text'})
+    run.check("an edit returns the new card", card['id'] == posted[0] and card['body'] == 'edited text')
+    run.check("an edit is saved", run.call('getTweet', posted[0]).data['body'] == 'edited text')
+    run.raises("editing a tweet changed since it was read", TweetChanged, 'editTweet', tweet, {'body': 'lost edit'})
+    run.check("an edit is searchable", run.searchIds('edited') == [posted[0]])
+    run.check("an edit replaces the old words in the search index", run.searchIds('number0') == [])
+    run.call('refreshCardInTimelines', alice, posted[0], notify=notifications)
+    run.check("an edit is notified to the author and the followers", notifications.events[-1][:2] == ({alice, bob}, 'update') and notifications.events[-1][2]['body'] == 'edited text')
+    cards, _ = run.call('timeline', bob, 'bob', cursor=None)
+    run.check("an edit shows on timelines", all(card['body'] == 'edited text' for card in cards if card['id'] == posted[0]))
+
+    # image renditions, recorded only for the image they were made from
+    image_fields = {'image_url': '/media/alice/1/cat.png', 'blob_name': 'alice/1/cat.png', 'thumbnail_url': '', 'display_url': '', 'rendition_blob_names': []}
+    image_tweet = run.call('addTweet', tweetData(alice, 'Alice', 'a cat', START + timedelta(days=2), **image_fields))['id']
+    renditions = {'thumbnail_url': '/media/t.png', 'display_url': '/media/d.png', 'rendition_blob_names': ['t.png', 'd.png']}
+    run.check("renditions of a replaced image are not recorded", run.call('recordRenditions', image_tweet, 'alice/0/dog.png', renditions) is False)
+    run.check("renditions are recorded", run.call('recordRenditions', image_tweet, 'alice/1/cat.png', renditions) is True)
+    run.check("renditions are saved on the tweet", run.call('getTweet', image_tweet).data['rendition_blob_names'] == ['t.png', 'd.png'])
+    cards, _ = run.call('tweetsByAuthor', alice)
+    run.check("renditions show on the tweet's card", (cards[0]['id'], cards[0]['thumbnail_url'], cards[0]['display_url']) == (image_tweet, '/media/t.png', '/media/d.png'))
+
+    # deleting
+    tweet = run.call('getTweet', posted[2])
+    run.call('deleteTweet', tweet)
+    run.check("a deleted tweet is gone", run.call('getTweet', posted[2]) is None)
+    run.raises("deleting a tweet deleted since it was read", TweetChanged, 'deleteTweet', tweet)
+    run.check("a deleted tweet leaves the profile", posted[2] not in run.pages('tweetsByAuthor', alice))
+    run.check("a deleted tweet leaves the search index", posted[2] not in run.searchIds('hello'))
+    run.call('removeFromFollowerTimelines', alice, [posted[2]], notify=notifications)
+    run.check("a deletion is notified to the followers", notifications.events[-1] == ({bob}, 'remove', {'ids': [posted[2]]}))
+    run.check("a deleted tweet leaves the timelines", posted[2] not in run.pages('timeline', bob, 'bob'))
+
+    # unfollowing
+    run.check("unfollowing a user", run.call('removeFollow', bob, alice, 'Alice') is True)
+    run.check("unfollowing a user again", run.call('removeFollow', bob, alice, 'Alice') is False)
+    run.check("an unfollow is found", not run.call('isFollowing', bob, alice))
+    run.check("an unfollow counts for both users", (run.call('userData', alice)['followers_count'], run.call('userData', bob)['following_count']) == (0, 0))
+    run.check("an unfollowed user's tweets leave the timeline", run.pages('timeline', bob, 'bob') == [bob_tweet])
+
+    run.call('ping')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--backend', choices=BACKENDS, action='append', help='backend to check, sqlite unless given, may be repeated')
+    parser.add_argument('--tweets', type=int, default=3 * PAGE_SIZE, help='number of tweets posted by the busiest user')
+    args = parser.parse_args()
+    if args.tweets <= PAGE_SIZE:
+        sys.exit(f"Post more than a page of tweets ({PAGE_SIZE}).")
+
+    failed = False
+    for backend in args.backend or ['sqlite']:
+        run = Run(createBackend(backend))
+        runScenario(run, args.tweets)
+        print(f"{backend}: {'ok' if not run.failures else f'{len(run.failures)} checks failed'}")
+        for failure in run.failures:
+            print(f"  FAILED {failure}")
+        for operation, seconds in sorted(run.seconds.items()):
+            values = [second * 1000 for second in seconds]
+            print(f"  {operation:<28} x{len(values):<4} median {statistics.median(values):8.3f}ms  max {max(values):8.3f}ms")
+        failed = failed or bool(run.failures)
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,39 @@
+"""Running blocking Firestore and Cloud Storage calls off the event loop.
+
+The Firestore and Cloud Storage clients are synchronous. Calling them straight
+from an `async def` route stops the event loop, and with it every other request
+on the worker, until the call returns. Routes instead hand those calls to
+`runBlocking`, which runs them on a bounded thread pool. The pool size caps how
+many backend calls a worker has in flight at once; calls beyond it wait their
+turn without holding up the event loop.
+
+Calls run in a copy of the caller's context, so context variables such as the
+metrics of the current request are seen by the call.
+"""
+import asyncio
+import contextvars
+import functools
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+IO_MAX_WORKERS = int(os.environ.get('IO_MAX_WORKERS', 32))  # most blocking calls in flight per worker process
+
+_executor = ThreadPoolExecutor(max_workers=IO_MAX_WORKERS, thread_name_prefix='blocking-io')
+
+
+async def runBlocking(function, *args, **kwargs):
+    """Run a blocking function on the I/O thread pool and wait for its result without blocking the event loop."""
+    loop = asyncio.get_running_loop()
+    context = contextvars.copy_context()
+    return await loop.run_in_executor(_executor, context.run, functools.partial(function, *args, **kwargs))
+
+
+async def gatherBlocking(*calls):
+    """Run several independent blocking calls concurrently.
+
+    Args:
+        calls: tuples of a function followed by its positional arguments.
+    Returns:
+        the results of the calls, in the same order.
+    """
+    return await asyncio.gather(*(runBlocking(*call) for call in calls))
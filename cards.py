@@ -0,0 +1,104 @@
+"""Denormalized tweet cards, the only tweet data lists of tweets read.
+
+Every tweet has a ``TweetCard/{tweet_id}`` document holding just what a list
+of tweets shows: the author's id and username, the body, the image URLs and
+the post date, plus the tweet's id. Profiles and searches read cards instead of
+the Tweet documents, and timelines embed the cards themselves, so a page of a
+timeline is a single read.
+
+A card is written in the same commit as the tweet it copies (see
+`unit_of_work.py`), and image renditions are recorded on both. Timelines
+holding a card are refreshed in the background when it changes.
+
+Run this module to create the cards of existing tweets and repair any that
+differ from their tweet, or with ``--check`` to only report them::
+
+    python cards.py [--check]
+"""
+import sys
+from datetime import timezone
+from google.cloud import firestore
+
+CARD_FIELDS = ('author_id', 'username', 'body', 'date', 'image_url', 'thumbnail_url', 'display_url')
+
+
+def cardRef(db, tweet_id):
+    """Return the DocumentReference of the card of a tweet."""
+    return db.collection('TweetCard').document(tweet_id)
+
+
+def tweetCard(tweet_id, tweet_data):
+    """Build the card of a tweet.
+
+    Args:
+        tweet_id: the id of the Tweet document.
+        tweet_data: the fields of the Tweet document.
+    Returns:
+        a dict of the fields in `CARD_FIELDS`, plus the tweet's id under `id`.
+    """
+    card = {field: tweet_data.get(field, '') for field in CARD_FIELDS}
+    card['id'] = tweet_id
+    if card['date'].tzinfo is None:
+        card['date'] = card['date'].replace(tzinfo=timezone.utc)  # Firestore stores naive datetimes as UTC and returns them timezone-aware
+    return card
+
+
+def _differences(db):
+    """Yield the id, expected card and stored card of every tweet whose card is missing, stale or orphaned.
+
+    The expected card is None for orphaned cards, whose tweet no longer exists, and the stored
+    card is None for missing ones.
+    """
+    stored_cards = {card.id: card.to_dict() for card in db.collection('TweetCard').stream()}
+    for tweet in db.collection('Tweet').stream():
+        expected = tweetCard(tweet.id, tweet.to_dict())
+        stored = stored_cards.pop(tweet.id, None)
+        if stored != expected:
+            yield tweet.id, expected, stored
+    for tweet_id, stored in stored_cards.items():
+        yield tweet_id, None, stored
+
+
+def checkCards(db):
+    """Compare every card with the tweet it copies.
+
+    Returns:
+        a dict of the ids of the tweets whose cards are `missing`, `stale` or `orphaned`.
+    """
+    found = {'missing': [], 'stale': [], 'orphaned': []}
+    for tweet_id, expected, stored in _differences(db):
+        if expected is None:
+            found['orphaned'].append(tweet_id)
+        elif stored is None:
+            found['missing'].append(tweet_id)
+        else:
+            found['stale'].append(tweet_id)
+    return found
+
+
+def backfillCards(db):
+    """Write the cards that are missing or stale, and delete the orphaned ones.
+
+    Returns:
+        the number of cards written or deleted.
+    """
+    repaired = 0
+    writer = db.bulk_writer()
+    for tweet_id, expected, _ in _differences(db):
+        if expected is None:
+            writer.delete(cardRef(db, tweet_id))
+        else:
+            writer.set(cardRef(db, tweet_id), expected)
+        repaired += 1
+    writer.close()
+    return repaired
+
+
+if __name__ == '__main__':
+    client = firestore.Client()
+    if '--check' in sys.argv[1:]:
+        found = checkCards(client)
+        for problem, tweet_ids in found.items():
+            print(f"{len(tweet_ids)} {problem} cards{': ' if tweet_ids else ''}{', '.join(tweet_ids[:20])}")
+        sys.exit(1 if any(found.values()) else 0)
+    print(f"Repaired {backfillCards(client)} tweet cards.")
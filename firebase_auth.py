@@ -0,0 +1,162 @@
+"""Verification of Firebase ID tokens with cached certificates and claims.
+
+Google rotates the certificates that sign Firebase ID tokens every few hours
+and says how long each set may be cached in the Cache-Control header of the
+certificate endpoint. `TokenVerifier` keeps the current set for that long and
+remembers the claims of every token it has verified until the token expires,
+so a signed in user's requests skip both the certificate fetch and the RSA
+signature check.
+
+Certificates come from a pluggable `CertSource`. `GoogleCertSource` fetches
+Google's published certificates; `StaticCertSource` serves a fixed key set so
+tokens signed with a local key can be verified offline.
+"""
+import asyncio
+import hashlib
+import json
+import re
+import time
+from collections import OrderedDict
+from typing import Mapping, Protocol
+import google.auth.jwt
+from google.auth import exceptions
+from google.auth.transport import requests
+
+FIREBASE_CERTS_URL = 'https://www.googleapis.com/robot/v1/metadata/x509/securetoken@system.gserviceaccount.com'
+DEFAULT_CERTS_MAX_AGE = 3600  # seconds to keep certificates when the response does not say
+CERTS_RETRY_AFTER = 60  # seconds to keep using stale certificates after a failed refresh, and the least time between refreshes
+CLAIMS_CACHE_SIZE = 10000  # number of verified tokens remembered
+CLOCK_SKEW = 10  # seconds of clock difference tolerated when checking `iat` and `exp`
+
+MAX_AGE_PATTERN = re.compile(r'max-age=(\d+)')
+
+
+class CertSource(Protocol):
+    """Somewhere to get the certificates that sign Firebase ID tokens from."""
+
+    def fetch(self) -> tuple[Mapping[str, str], float]:
+        """Return the certificates by key id, and the number of seconds they may be cached for."""
+
+
+class GoogleCertSource:
+    """Fetch the certificates Google publishes for Firebase ID tokens."""
+
+    def __init__(self, url=FIREBASE_CERTS_URL):
+        self.url = url
+        self.request = None  # created on the first fetch, then reuses one HTTP session, and so its connections, across fetches
+
+    def fetch(self):
+        if self.request is None:
+            self.request = requests.Request()
+        response = self.request(self.url, method='GET')
+        if response.status != 200:
+            raise exceptions.TransportError(f"Could not fetch certificates at {self.url}")
+
+        max_age = MAX_AGE_PATTERN.search(response.headers.get('cache-control', ''))
+        return json.loads(response.data.decode('utf-8')), int(max_age.group(1)) if max_age else DEFAULT_CERTS_MAX_AGE
+
+
+class StaticCertSource:
+    """Serve a fixed set of certificates, for verifying tokens signed with a local key."""
+
+    def __init__(self, certs, max_age=DEFAULT_CERTS_MAX_AGE):
+        self.certs = dict(certs)
+        self.max_age = max_age
+
+    def fetch(self):
+        return self.certs, self.max_age
+
+
+class TokenVerifier:
+    """Verify Firebase ID tokens for one project, caching certificates and verified claims.
+
+    Args:
+        project_id: the Firebase project the tokens must be issued for.
+        cert_source: where to get the signing certificates from.
+        cache_size: the number of verified tokens to remember.
+    """
+
+    def __init__(self, project_id, cert_source=None, cache_size=CLAIMS_CACHE_SIZE):
+        self.project_id = project_id
+        self.cert_source = cert_source or GoogleCertSource()
+        self.cache_size = cache_size
+        self._certs = None
+        self._certs_expiry = 0.0
+        self._certs_fetched_at = 0.0
+        self._certs_lock = asyncio.Lock()
+        self._claims = OrderedDict()  # token hash -> claims, least recently used first
+
+    async def certs(self, force_refresh=False):
+        """Return the current certificates, fetching them in a worker thread when the cached set has expired."""
+        if self._certs is not None and not force_refresh and time.time() < self._certs_expiry:
+            return self._certs
+
+        async with self._certs_lock:
+            # another request may have refreshed the certificates while this one waited for the lock
+            if self._certs is not None and not force_refresh and time.time() < self._certs_expiry:
+                return self._certs
+            if self._certs is not None and time.time() - self._certs_fetched_at < CERTS_RETRY_AFTER:
+                return self._certs  # don't let tokens with made up key ids trigger a fetch each
+            try:
+                certs, max_age = await asyncio.to_thread(self.cert_source.fetch)
+            except exceptions.TransportError as err:
+                if self._certs is None:
+                    raise
+                print(str(err))
+                self._certs_expiry = time.time() + CERTS_RETRY_AFTER  # keep the stale certificates for a little longer
+                return self._certs
+            self._certs_fetched_at = time.time()
+            self._certs, self._certs_expiry = certs, self._certs_fetched_at + max_age
+            return certs
+
+    def _cached_claims(self, token_hash):
+        """Return the remembered claims of a token, if it was verified before and has not expired."""
+        claims = self._claims.get(token_hash)
+        if claims is None:
+            return None
+        if claims['exp'] + CLOCK_SKEW <= time.time():
+            del self._claims[token_hash]
+            return None
+        self._claims.move_to_end(token_hash)
+        return claims
+
+    def _remember(self, token_hash, claims):
+        """Remember the claims of a verified token, evicting the least recently used ones."""
+        self._claims[token_hash] = claims
+        self._claims.move_to_end(token_hash)
+        while len(self._claims) > self.cache_size:
+            self._claims.popitem(last=False)
+
+    def _decode(self, id_token, certs):
+        """Check the signature and claims of a token."""
+        claims = google.auth.jwt.decode(id_token, certs=certs, audience=self.project_id, clock_skew_in_seconds=CLOCK_SKEW)
+        if claims.get('iss') != f'https://securetoken.google.com/{self.project_id}':
+            raise exceptions.InvalidValue(f"Token has wrong issuer {claims.get('iss')}")
+        if not claims.get('sub'):
+            raise exceptions.InvalidValue("Token has no subject")
+        return claims
+
+    async def verify(self, id_token):
+        """Verify a Firebase ID token.
+
+        Returns:
+            the claims of the token.
+        Raises:
+            ValueError: if the token is not valid.
+        """
+        token_hash = hashlib.sha256(id_token.encode('utf-8')).hexdigest()
+        claims = self._cached_claims(token_hash)
+        if claims is not None:
+            return claims
+
+        certs = await self.certs()
+        try:
+            claims = await asyncio.to_thread(self._decode, id_token, certs)
+        except exceptions.MalformedError:
+            # the token may be signed with a key published after the cached certificates were fetched
+            if google.auth.jwt.decode_header(id_token).get('kid') in certs:
+                raise
+            claims = await asyncio.to_thread(self._decode, id_token, await self.certs(force_refresh=True))
+
+        self._remember(token_hash, claims)
+        return claims
@@ -0,0 +1,138 @@
+"""The follow graph.
+
+A follow is stored as a pair of edge documents keyed by user id:
+``User/{follower_id}/following/{followed_id}`` and
+``User/{followed_id}/followers/{follower_id}``, each holding the username of
+the user at the other end. Checking whether one user follows another is a
+single document read, and neither user document grows with the number of
+follows.
+
+Edges are written in a transaction together with the ``following_count`` and
+``followers_count`` counters on both user documents, so concurrent follows and
+unfollows cannot lose updates or let the counters drift from the edges.
+
+Running this module migrates the ``following`` and ``followers`` arrays of user
+documents written before the follow graph into edge documents and counters.
+"""
+from google.cloud import firestore
+
+FOLLOWING = 'following'  # subcollection of the users a user follows
+FOLLOWERS = 'followers'  # subcollection of the users following a user
+
+
+def _user_ref(db, user_id):
+    return db.collection('User').document(user_id)
+
+
+def _edge_refs(db, follower_id, followed_id):
+    """Return the references of the two edge documents of a follow."""
+    return (
+        _user_ref(db, follower_id).collection(FOLLOWING).document(followed_id),
+        _user_ref(db, followed_id).collection(FOLLOWERS).document(follower_id),
+    )
+
+
+@firestore.transactional
+def _add_follow(transaction, db, follower_id, follower_username, followed_id, followed_username):
+    following_ref, follower_ref = _edge_refs(db, follower_id, followed_id)
+    if following_ref.get(transaction=transaction).exists:
+        return False
+    transaction.set(following_ref, {'username': followed_username, 'date': firestore.SERVER_TIMESTAMP})
+    transaction.set(follower_ref, {'username': follower_username, 'date': firestore.SERVER_TIMESTAMP})
+    transaction.update(_user_ref(db, follower_id), {'following_count': firestore.Increment(1)})
+    transaction.update(_user_ref(db, followed_id), {'followers_count': firestore.Increment(1)})
+    return True
+
+
+@firestore.transactional
+def _remove_follow(transaction, db, follower_id, followed_id):
+    following_ref, follower_ref = _edge_refs(db, follower_id, followed_id)
+    if not following_ref.get(transaction=transaction).exists:
+        return False
+    transaction.delete(following_ref)
+    transaction.delete(follower_ref)
+    transaction.update(_user_ref(db, follower_id), {'following_count': firestore.Increment(-1)})
+    transaction.update(_user_ref(db, followed_id), {'followers_count': firestore.Increment(-1)})
+    return True
+
+
+def addFollow(db, follower_id, follower_username, followed_id, followed_username):
+    """Make one user follow another.
+
+    Returns:
+        True if the follow was added, False if the user already followed the other user.
+    Raises:
+        ValueError: if a user tries to follow themselves.
+    """
+    if follower_id == followed_id:
+        raise ValueError("Users cannot follow themselves")
+    return _add_follow(db.transaction(), db, follower_id, follower_username, followed_id, followed_username)
+
+
+def removeFollow(db, follower_id, followed_id):
+    """Make one user stop following another.
+
+    Returns:
+        True if the follow was removed, False if the user did not follow the other user.
+    """
+    return _remove_follow(db.transaction(), db, follower_id, followed_id)
+
+
+def isFollowing(db, follower_id, followed_id):
+    """Return whether one user follows another, with a single document read."""
+    following_ref, _ = _edge_refs(db, follower_id, followed_id)
+    return following_ref.get().exists
+
+
+def followingUsernames(db, user_id):
+    """Return the usernames of the users a user follows."""
+    edges = _user_ref(db, user_id).collection(FOLLOWING).select(['username']).stream()
+    return [edge.get('username') for edge in edges]
+
+
+def followerIds(db, user_id):
+    """Return the user ids of the followers of a user."""
+    edges = _user_ref(db, user_id).collection(FOLLOWERS).select([]).stream()  # the ids are all that is needed, so read no fields
+    return [edge.id for edge in edges]
+
+
+def migrateFollowArrays(db):
+    """Move the `following` and `followers` arrays of every user document into edge documents and counters.
+
+    Only the `following` arrays are read, since each follow appears in both arrays and its
+    edges are written from the follower's side. Safe to run more than once.
+
+    Returns:
+        the number of users migrated.
+    """
+    users = {user.id: user.to_dict() for user in db.collection('User').stream()}
+    user_ids = {data.get('username'): user_id for user_id, data in users.items() if data.get('username')}
+
+    writer = db.bulk_writer()
+    for follower_id, data in users.items():
+        if not data.get('username'):
+            continue
+        for followed_username in data.get('following') or []:
+            followed_id = user_ids.get(followed_username)
+            if followed_id is None or followed_id == follower_id:
+                continue  # the followed user no longer exists
+            following_ref, follower_ref = _edge_refs(db, follower_id, followed_id)
+            writer.set(following_ref, {'username': followed_username, 'date': firestore.SERVER_TIMESTAMP})
+            writer.set(follower_ref, {'username': data['username'], 'date': firestore.SERVER_TIMESTAMP})
+    writer.flush()
+
+    # recount from the edges, so the counters are right however many times this has run
+    for user_id in users:
+        user_ref = _user_ref(db, user_id)
+        writer.update(user_ref, {
+            'following_count': user_ref.collection(FOLLOWING).count().get()[0][0].value,
+            'followers_count': user_ref.collection(FOLLOWERS).count().get()[0][0].value,
+            'following': firestore.DELETE_FIELD,
+            'followers': firestore.DELETE_FIELD,
+        })
+    writer.close()
+    return len(users)
+
+
+if __name__ == '__main__':
+    print(f"Migrated the follows of {migrateFollowArrays(firestore.Client())} users.")
@@ -0,0 +1,184 @@
+"""Upload pipeline for the images attached to tweets.
+
+An uploaded image is checked against a size limit, its type is sniffed from
+its first bytes and it is decoded, so a damaged file is refused before it is
+stored. It is then streamed to storage from the spooled upload file, and the
+route returns as soon as the original is stored.
+
+A thumbnail and a display sized rendition are made afterwards by a
+``makeRenditions`` job on the background job queue (see `jobs.py`), which
+reads the original back from storage. The renditions are stored next to the
+original and their URLs recorded on the tweet through the repository (on the
+Tweet document and its card with Firestore), then the job queues a refresh of
+the tweet's card in timelines. Pages show the thumbnail and link to the
+display rendition, falling back to the original until the renditions are ready.
+"""
+import io
+import os
+import uuid
+from pathlib import PurePosixPath
+from google.api_core.exceptions import NotFound
+from google.cloud import firestore
+from PIL import Image, ImageOps, UnidentifiedImageError
+from cards import cardRef, tweetCard
+
+IMAGE_MAX_BYTES = int(os.environ.get('IMAGE_MAX_BYTES', 10 * 1024 * 1024))  # largest image accepted
+IMAGE_TOO_LARGE = f"Images must be smaller than {IMAGE_MAX_BYTES // (1024 * 1024)}MB."
+RENDITIONS = {
+    'thumbnail': 200,  # shown at 100x100, so twice that for high density screens
+    'display': 1280,
+}
+
+SIGNATURES = {
+    b'\x89PNG\r\n\x1a\n': 'image/png',
+    b'\xff\xd8\xff': 'image/jpeg',
+}
+
+class ImageRejected(ValueError):
+    """An uploaded image that cannot be accepted, with a message to show the user.
+
+    Args:
+        message: the reason, shown to the user.
+        status_code: the HTTP status to answer with.
+    """
+
+    def __init__(self, message, status_code=400):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+def sniffContentType(header):
+    """Return the content type of an image from its first bytes, or None if it is not a supported type."""
+    for signature, content_type in SIGNATURES.items():
+        if header.startswith(signature):
+            return content_type
+    return None
+
+
+def checkImage(upload):
+    """Check the size and type of an uploaded image, and that it decodes.
+
+    Returns:
+        a tuple of the image's size in bytes and its content type.
+    Raises:
+        ImageRejected: if the image is too large, not a png or jpg, or corrupt.
+    """
+    upload.file.seek(0, io.SEEK_END)
+    size = upload.file.tell()
+    upload.file.seek(0)
+    if size > IMAGE_MAX_BYTES:
+        raise ImageRejected(IMAGE_TOO_LARGE, status_code=413)
+
+    content_type = sniffContentType(upload.file.read(8))
+    upload.file.seek(0)
+    if content_type is None:
+        raise ImageRejected("Images must be png or jpg files.")
+    try:
+        with Image.open(upload.file) as image:
+            image.verify()  # reads through the file, so a corrupt one is refused now rather than failing its renditions
+    except (UnidentifiedImageError, SyntaxError, OSError, Image.DecompressionBombError):
+        raise ImageRejected("The image could not be read, it may be damaged.")
+    finally:
+        upload.file.seek(0)
+    return size, content_type
+
+
+def storeImage(storage_service, upload, username):
+    """Check an uploaded image and stream it to storage.
+
+    Each upload gets a directory of its own, so a new image never overwrites an older one.
+
+    Returns:
+        the image fields to save on the Tweet.
+    Raises:
+        ImageRejected: if the image is too large or not a png or jpg.
+    """
+    size, content_type = checkImage(upload)
+    blob_name = f"{username}/{uuid.uuid4().hex}/{PurePosixPath(upload.filename).name}"
+    image_url = storage_service.uploadFile(blob_name, upload.file, content_type, size)
+
+    image_fields = {
+        'image_url': image_url,  # public url of the original image
+        'blob_name': blob_name,  # name of the blob in the bucket, to be used when deleting an image
+        'thumbnail_url': '',  # public url of the thumbnail, set once it has been made
+        'display_url': '',  # public url of the display sized rendition, set once it has been made
+        'rendition_blob_names': [],  # names of the rendition blobs, to be used when deleting an image
+    }
+    return image_fields
+
+
+def renderImage(data, max_side):
+    """Scale an image down to fit within `max_side` pixels.
+
+    Returns:
+        a tuple of the encoded rendition and its content type.
+    """
+    with Image.open(io.BytesIO(data)) as image:
+        image = ImageOps.exif_transpose(image)  # apply the camera's orientation before it is stripped with the metadata
+        image.thumbnail((max_side, max_side))
+        output = io.BytesIO()
+        if image.mode in ('RGBA', 'LA', 'P'):
+            image.save(output, format='PNG', optimize=True)
+            return output.getvalue(), 'image/png'
+        image.convert('RGB').save(output, format='JPEG', quality=85, optimize=True, progressive=True)
+        return output.getvalue(), 'image/jpeg'
+
+
+@firestore.transactional
+def _save_renditions(transaction, tweet_ref, card_ref, blob_name, rendition_fields):
+    """Record the renditions on the tweet and its card, unless its image was replaced or it was deleted meanwhile."""
+    tweet = tweet_ref.get(transaction=transaction)
+    if not tweet.exists or tweet.get('blob_name') != blob_name:
+        return False
+    transaction.update(tweet_ref, rendition_fields)
+    transaction.set(card_ref, tweetCard(tweet.id, {**tweet.to_dict(), **rendition_fields}))
+    return True
+
+
+def recordRenditions(db, tweet_id, blob_name, rendition_fields):
+    """Record the renditions of a tweet's image on the Tweet document and its card.
+
+    Returns:
+        whether they were recorded, False if the image was replaced or the tweet deleted meanwhile.
+    """
+    try:
+        return _save_renditions(db.transaction(), db.collection('Tweet').document(tweet_id), cardRef(db, tweet_id), blob_name, rendition_fields)
+    except NotFound:
+        return False
+
+
+def makeRenditions(repository, storage_service, tweet_id, blob_name):
+    """Make, store and record the renditions of a tweet's image, read from the stored original.
+
+    Safe to run more than once, as the renditions are stored under names derived from the original's.
+
+    Returns:
+        whether they were recorded, False if the image was replaced or the tweet deleted meanwhile.
+    """
+    try:
+        data = storage_service.readFile(blob_name)
+    except (NotFound, FileNotFoundError):
+        return False  # deleted along with its tweet, or replaced, before its renditions were made
+    rendition_fields = {'rendition_blob_names': []}
+    for name, max_side in RENDITIONS.items():
+        rendition, content_type = renderImage(data, max_side)
+        rendition_blob_name = f"{blob_name}.{name}.{content_type.split('/')[1]}"
+        rendition_fields[f'{name}_url'] = storage_service.uploadFile(rendition_blob_name, io.BytesIO(rendition), content_type, len(rendition))
+        rendition_fields['rendition_blob_names'].append(rendition_blob_name)
+
+    if not repository.recordRenditions(tweet_id, blob_name, rendition_fields):
+        for rendition_blob_name in rendition_fields['rendition_blob_names']:
+            storage_service.deleteFile(rendition_blob_name)
+        return False
+    return True
+
+
+def deleteImage(storage_service, tweet_data):
+    """Delete the image of a tweet and all of its renditions.
+
+    Args:
+        tweet_data: the fields of the Tweet document.
+    """
+    for blob_name in [tweet_data.get('blob_name')] + tweet_data.get('rendition_blob_names', []):
+        if blob_name:
+            storage_service.deleteFile(blob_name)
@@ -0,0 +1,216 @@
+"""A durable background job queue for the side effects of requests.
+
+Routes enqueue slow side effects that the response does not need to wait for,
+such as deleting images from storage or fanning a tweet out to followers'
+timelines, and return straight away. Jobs are kept in a local SQLite database,
+so they survive a restart, and run on a pool of worker threads.
+
+A job that raises is retried with exponential backoff, up to `max_attempts`
+times, after which it is marked failed and kept for inspection. A job whose
+worker died mid-run is picked up again once its lease runs out, so handlers
+must be safe to run more than once. Jobs can be given an idempotency key, and a
+job is not enqueued again while one with the same key is kept: until it has
+been done for JOB_RETENTION_SECONDS, or for good once it has failed.
+
+The queue is configured with environment variables:
+
+- JOBS_DB_PATH: the SQLite database the jobs are kept in
+- JOB_WORKERS: the number of worker threads
+"""
+import functools
+import json
+import os
+import sqlite3
+import threading
+import time
+import traceback
+import uuid
+from lifecycle import Lazy
+from metrics import Counter, Histogram, registerCollected
+
+JOBS_DB_PATH = os.environ.get('JOBS_DB_PATH', 'jobs.sqlite3')
+JOB_WORKERS = int(os.environ.get('JOB_WORKERS', 4))
+JOB_MAX_ATTEMPTS = 8  # attempts before a job is marked failed
+JOB_LEASE_SECONDS = 300  # time a job may run before another worker takes it over
+JOB_MAX_BACKOFF = 600  # longest wait between attempts, in seconds
+JOB_RETENTION_SECONDS = 24 * 3600  # time finished jobs and their idempotency keys are kept
+POLL_SECONDS = 1.0  # how often idle workers look for jobs that became due
+
+JOB_LAG_SECONDS = Histogram('app_job_lag_seconds', 'Time from a job becoming due to a worker starting it.', ('kind',),
+                            buckets=(0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 30.0, 60.0, 300.0, 900.0))
+JOB_SECONDS = Histogram('app_job_seconds', 'Time taken to run a job.', ('kind',))
+JOBS = Counter('app_jobs_total', 'Jobs run, by outcome: done, retried or failed.', ('kind', 'outcome'))
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY,
+    key TEXT NOT NULL UNIQUE,  -- idempotency key
+    kind TEXT NOT NULL,
+    payload TEXT NOT NULL,  -- JSON keyword arguments of the handler
+    status TEXT NOT NULL DEFAULT 'pending',  -- pending, running, done or failed
+    attempts INTEGER NOT NULL DEFAULT 0,
+    run_at REAL NOT NULL,  -- when the job is next due
+    locked_until REAL,  -- when the lease of the worker running the job ends
+    created_at REAL NOT NULL,
+    finished_at REAL,
+    last_error TEXT
+);
+CREATE INDEX IF NOT EXISTS jobs_due ON jobs (status, run_at);
+"""
+
+
+def openSqlite(path, schema):
+    """Open a SQLite database shared by threads, creating its tables if they do not exist.
+
+    The connection is in autocommit mode, so callers open their transactions explicitly.
+    """
+    db = sqlite3.connect(path, timeout=30, isolation_level=None, check_same_thread=False)
+    db.execute('PRAGMA journal_mode=WAL')  # readers don't block the writer
+    db.executescript(schema)
+    return db
+
+
+class JobQueue:
+    """A SQLite backed job queue with a pool of worker threads.
+
+    Args:
+        path: the SQLite database to keep the jobs in.
+        workers: the number of worker threads.
+        max_attempts: the attempts made at a job before it is marked failed.
+    """
+
+    def __init__(self, path=JOBS_DB_PATH, workers=JOB_WORKERS, max_attempts=JOB_MAX_ATTEMPTS):
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self.handlers = {}
+        self._db = Lazy(functools.partial(openSqlite, path, SCHEMA))  # opened on first use, so creating the queue touches no files
+        self._lock = threading.Lock()  # one statement at a time on the shared connection
+        self._wakeup = threading.Condition()
+        self._stopping = threading.Event()
+        self._threads = []
+        registerCollected('app_jobs_pending', 'Jobs waiting to run.', lambda: self.stats()['pending'])
+        registerCollected('app_jobs_failed', 'Jobs that ran out of attempts.', lambda: self.stats()['failed'])
+        registerCollected('app_job_oldest_pending_seconds', 'Age of the oldest job that is due and waiting.', lambda: self.stats()['oldest_pending_seconds'])
+
+    def register(self, kind, handler):
+        """Set the function that runs jobs of a kind. It is called with the job's payload as keyword arguments."""
+        self.handlers[kind] = handler
+
+    def _execute(self, sql, parameters=()):
+        with self._lock:
+            return self._db.execute(sql, parameters).fetchall()
+
+    def enqueue(self, kind, key=None, delay=0, **payload):
+        """Add a job to the queue.
+
+        Args:
+            kind: the kind of job, which selects its handler.
+            key: the idempotency key of the job; it is not enqueued if a job with the same key is kept.
+            delay: the seconds to wait before running the job.
+            payload: the JSON serializable keyword arguments of the handler.
+        Returns:
+            True if the job was enqueued, False if a job with the same key already was.
+        """
+        if kind not in self.handlers:
+            raise ValueError(f"No handler for jobs of kind {kind}")
+        now = time.time()
+        rows = self._execute(
+            'INSERT OR IGNORE INTO jobs (key, kind, payload, run_at, created_at) VALUES (?, ?, ?, ?, ?) RETURNING id',
+            (key or uuid.uuid4().hex, kind, json.dumps(payload), now + delay, now),
+        )
+        if rows:
+            with self._wakeup:
+                self._wakeup.notify()
+        return bool(rows)
+
+    def _claim(self):
+        """Lease the job that has been due the longest, if any."""
+        now = time.time()
+        rows = self._execute(
+            """UPDATE jobs SET status = 'running', attempts = attempts + 1, locked_until = ?
+               WHERE id = (
+                   SELECT id FROM jobs
+                   WHERE (status = 'pending' AND run_at <= ?) OR (status = 'running' AND locked_until < ?)
+                   ORDER BY run_at LIMIT 1
+               )
+               RETURNING id, kind, payload, attempts, run_at""",
+            (now + JOB_LEASE_SECONDS, now, now),
+        )
+        return rows[0] if rows else None
+
+    def runOne(self):
+        """Run the job that has been due the longest, if any.
+
+        Returns:
+            True if a job was run.
+        """
+        job = self._claim()
+        if job is None:
+            return False
+        job_id, kind, payload, attempts, run_at = job
+        start = time.time()
+        JOB_LAG_SECONDS.observe((kind,), max(0.0, start - run_at))
+        try:
+            self.handlers[kind](**json.loads(payload))
+        except Exception:
+            error = traceback.format_exc()
+            if attempts >= self.max_attempts:
+                self._execute("UPDATE jobs SET status = 'failed', finished_at = ?, last_error = ? WHERE id = ?", (time.time(), error, job_id))
+                JOBS.inc((kind, 'failed'))
+                print(f"Job {job_id} ({kind}) failed after {attempts} attempts: {error}")
+            else:
+                backoff = min(JOB_MAX_BACKOFF, 2 ** attempts)
+                self._execute("UPDATE jobs SET status = 'pending', run_at = ?, last_error = ? WHERE id = ?", (time.time() + backoff, error, job_id))
+                JOBS.inc((kind, 'retried'))
+        else:
+            self._execute("UPDATE jobs SET status = 'done', finished_at = ? WHERE id = ?", (time.time(), job_id))
+            JOBS.inc((kind, 'done'))
+        finally:
+            JOB_SECONDS.observe((kind,), time.time() - start)
+        return True
+
+    def _work(self):
+        while not self._stopping.is_set():
+            try:
+                ran = self.runOne()
+            except sqlite3.Error as err:
+                print(f"Could not run jobs: {err}")
+                ran = False
+            if not ran:
+                with self._wakeup:
+                    self._wakeup.wait(POLL_SECONDS)
+
+    def prune(self):
+        """Delete finished jobs older than JOB_RETENTION_SECONDS, releasing their idempotency keys."""
+        self._execute("DELETE FROM jobs WHERE status = 'done' AND finished_at < ?", (time.time() - JOB_RETENTION_SECONDS,))
+
+    def start(self):
+        """Start the worker threads. Workers that cannot open the database log it and try again."""
+        self._stopping.clear()
+        for index in range(self.workers):
+            thread = threading.Thread(target=self._work, name=f'jobs-{index}', daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self, timeout=10):
+        """Stop the worker threads, waiting up to `timeout` seconds for running jobs to finish."""
+        self._stopping.set()
+        with self._wakeup:
+            self._wakeup.notify_all()
+        deadline = time.monotonic() + timeout
+        for thread in self._threads:
+            thread.join(max(0.0, deadline - time.monotonic()))
+        self._threads = []
+
+    def stats(self):
+        """Return the number of pending and failed jobs, and how long the oldest due job has waited."""
+        now = time.time()
+        (pending, failed, oldest), = self._execute(
+            """SELECT
+                   SUM(status IN ('pending', 'running')),
+                   SUM(status = 'failed'),
+                   MIN(CASE WHEN status = 'pending' AND run_at <= ? THEN run_at END)
+               FROM jobs""",
+            (now,),
+        )
+        return {'pending': pending or 0, 'failed': failed or 0, 'oldest_pending_seconds': now - oldest if oldest else 0.0}
@@ -0,0 +1,117 @@
+"""Starting the app quickly and reporting when it is ready to serve.
+
+Clients that are slow to create, because they discover credentials or open
+connections, are wrapped in `Lazy` and created on first use rather than when
+the app is imported, as are the local SQLite databases. Local directories are
+created by warm-up steps. A new instance imports fast without touching the
+disk, and a backend it cannot reach or a directory it cannot write shows up as
+a failing readiness probe instead of a crash on import.
+
+`WarmUp` runs the steps that make the first requests fast, such as creating
+the clients, opening their connections and compiling templates, when the app
+starts. A step that takes longer than WARMUP_TIMEOUT_SECONDS counts as failed,
+so a backend that cannot be reached does not hold up the start. The readiness
+probe reports the app ready once every step succeeded, and retries the failed
+ones in the background, at most every WARMUP_RETRY_SECONDS.
+"""
+import asyncio
+import inspect
+import threading
+import time
+from blocking import runBlocking
+
+WARMUP_TIMEOUT_SECONDS = 10  # longest a warm-up step may take before it counts as failed
+WARMUP_RETRY_SECONDS = 5  # least time between retries of failed warm-up steps
+
+
+class Lazy:
+    """Create an object on first use and share it, passing attribute access through to it.
+
+    Args:
+        factory: called without arguments to create the object.
+    """
+
+    def __init__(self, factory):
+        self._factory = factory
+        self._value = None
+        self._lock = threading.Lock()
+
+    def get(self):
+        """Return the object, creating it if this is the first use."""
+        if self._value is None:
+            with self._lock:
+                if self._value is None:
+                    self._value = self._factory()
+        return self._value
+
+    @property
+    def created(self):
+        """Whether the object has been created."""
+        return self._value is not None
+
+    def __getattr__(self, name):
+        return getattr(self.get(), name)
+
+
+def pingFirestore(db):
+    """Read one document, creating the client, fetching its credentials and opening its channel."""
+    db.collection('Warmup').document('ping').get(retry=None, timeout=WARMUP_TIMEOUT_SECONDS)  # failed warm-up steps are retried by the readiness probe
+
+
+class WarmUp:
+    """Named steps run when the app starts, which it needs to have succeeded to be ready."""
+
+    def __init__(self):
+        self._steps = {}  # name -> (function, args)
+        self._results = {}  # name -> None once the step succeeded, or the error it failed with
+        self._seconds = {}  # name -> seconds the last run of the step took
+        self._last_run = 0.0
+        self._lock = asyncio.Lock()
+        self._retry = None  # the task retrying failed steps, if any
+
+    def add(self, name, function, *args):
+        """Add a step. Coroutine functions are awaited, other functions run on the I/O thread pool."""
+        self._steps[name] = (function, args)
+
+    @property
+    def ready(self):
+        """Whether every step has succeeded."""
+        return all(name in self._results and self._results[name] is None for name in self._steps)
+
+    async def _run_step(self, name):
+        function, args = self._steps[name]
+        start = time.perf_counter()
+        try:
+            if inspect.iscoroutinefunction(function):
+                await asyncio.wait_for(function(*args), WARMUP_TIMEOUT_SECONDS)
+            else:
+                await asyncio.wait_for(runBlocking(function, *args), WARMUP_TIMEOUT_SECONDS)
+            self._results[name] = None
+        except Exception as err:
+            self._results[name] = err
+            print(f"Warm-up step {name} failed: {err!r}")
+        self._seconds[name] = time.perf_counter() - start
+
+    async def run(self):
+        """Run the steps that have not succeeded yet, concurrently."""
+        async with self._lock:
+            self._last_run = time.monotonic()
+            pending = [name for name in self._steps if name not in self._results or self._results[name] is not None]
+            start = time.perf_counter()
+            await asyncio.gather(*(self._run_step(name) for name in pending))
+            if pending:
+                steps = ', '.join(f"{name} {self._seconds[name] * 1000:.0f}ms" for name in pending)
+                print(f"Warmed up in {(time.perf_counter() - start) * 1000:.0f}ms: {steps}")
+
+    def check(self):
+        """Return whether the app is ready, retrying failed steps in the background if the last try was long enough ago."""
+        if not self.ready and time.monotonic() - self._last_run >= WARMUP_RETRY_SECONDS and not self._lock.locked():
+            self._retry = asyncio.get_running_loop().create_task(self.run())
+        return self.ready
+
+    def status(self):
+        """Describe the outcome of every step, for the readiness probe."""
+        return {
+            name: 'pending' if name not in self._results else 'ok' if self._results[name] is None else f'failed: {self._results[name]!r}'
+            for name in self._steps
+        }
@@ -0,0 +1,141 @@
+"""Pushing timeline changes to open pages over Server-Sent Events.
+
+A signed in user's home page keeps a connection open to `/live/timeline`, and
+`LiveBus` pushes it the tweets added to, changed on or removed from their
+timeline while it is open, so the page applies them in place instead of being
+reloaded. The bus is in-process: a change is pushed to the connections held by
+the instance that made it, by the background job fanning it out to followers'
+timelines or, for the author, by the route itself.
+
+Each connection has a bounded queue. A client that reads too slowly to keep up
+has its queued events dropped and is sent a `resync` event instead, telling it
+to fetch the top of its timeline again. A comment is sent when the connection
+has been idle for LIVE_HEARTBEAT_SECONDS so proxies keep it open, and each
+connection is closed after LIVE_MAX_SECONDS, for the browser to reconnect
+(possibly to another instance) after LIVE_RETRY_MS.
+
+The bus is configured with environment variables:
+
+- LIVE_MAX_CONNECTIONS: the most connections open on an instance
+- LIVE_MAX_PER_USER: the most connections open for one user on an instance
+"""
+import asyncio
+import json
+import os
+import time
+from collections import defaultdict
+
+LIVE_MAX_CONNECTIONS = int(os.environ.get('LIVE_MAX_CONNECTIONS', 1000))
+LIVE_MAX_PER_USER = int(os.environ.get('LIVE_MAX_PER_USER', 5))
+LIVE_QUEUE_SIZE = 100  # events queued for a connection before it is told to resync
+LIVE_HEARTBEAT_SECONDS = 15  # idle time before a heartbeat comment is sent
+LIVE_MAX_SECONDS = 30 * 60  # time a connection is kept open before the browser is made to reconnect
+LIVE_RETRY_MS = 3000  # time the browser waits before reconnecting
+
+RESYNC = 'event: resync\ndata: {}\n\n'
+HEARTBEAT = ': heartbeat\n\n'
+
+
+class TooManyConnections(Exception):
+    """The instance or the user already has as many live connections open as allowed."""
+
+
+def sseMessage(event, data):
+    """Format a Server-Sent Event carrying JSON data."""
+    return f'event: {event}\ndata: {json.dumps(data)}\n\n'
+
+
+class Subscription:
+    """One open live connection of a user."""
+
+    def __init__(self, bus, user_id, queue_size=LIVE_QUEUE_SIZE):
+        self.bus = bus
+        self.user_id = user_id
+        self.queue = asyncio.Queue(queue_size)
+
+    def offer(self, message):
+        """Queue a message, or make the client resync if it has fallen too far behind."""
+        try:
+            self.queue.put_nowait(message)
+        except asyncio.QueueFull:
+            while not self.queue.empty():
+                self.queue.get_nowait()
+            self.queue.put_nowait(RESYNC)
+            self.bus.dropped += 1
+
+    async def messages(self):
+        """Yield the messages to stream to the client until the connection has been open for LIVE_MAX_SECONDS."""
+        yield f'retry: {LIVE_RETRY_MS}\n\n'
+        deadline = time.monotonic() + LIVE_MAX_SECONDS
+        while (remaining := deadline - time.monotonic()) > 0:
+            try:
+                yield await asyncio.wait_for(self.queue.get(), min(LIVE_HEARTBEAT_SECONDS, remaining))
+            except asyncio.TimeoutError:
+                yield HEARTBEAT
+
+
+class LiveBus:
+    """Publish timeline events to the live connections of users.
+
+    Args:
+        max_connections: the most connections open at once.
+        max_per_user: the most connections one user may have open at once.
+    """
+
+    def __init__(self, max_connections=LIVE_MAX_CONNECTIONS, max_per_user=LIVE_MAX_PER_USER):
+        self.max_connections = max_connections
+        self.max_per_user = max_per_user
+        self.published = self.dropped = 0
+        self._subscriptions = defaultdict(set)  # user id -> open subscriptions, only touched on the event loop
+        self._connections = 0
+        self._loop = None
+
+    def subscribe(self, user_id):
+        """Open a subscription to the events of a user's timeline. Must be called on the event loop.
+
+        Raises:
+            TooManyConnections: if the instance or the user is at their limit of connections.
+        """
+        if self._connections >= self.max_connections:
+            raise TooManyConnections("Too many live connections, try again later")
+        if len(self._subscriptions.get(user_id, ())) >= self.max_per_user:
+            raise TooManyConnections("Too many live connections open for this user")
+        self._loop = asyncio.get_running_loop()
+        subscription = Subscription(self, user_id)
+        self._subscriptions[user_id].add(subscription)
+        self._connections += 1
+        return subscription
+
+    def unsubscribe(self, subscription):
+        """Close a subscription."""
+        subscriptions = self._subscriptions.get(subscription.user_id)
+        if subscriptions and subscription in subscriptions:
+            subscriptions.remove(subscription)
+            self._connections -= 1
+            if not subscriptions:
+                del self._subscriptions[subscription.user_id]
+
+    def _deliver(self, user_ids, message):
+        for user_id in user_ids:
+            for subscription in self._subscriptions.get(user_id, ()):
+                subscription.offer(message)
+
+    def publish(self, user_ids, event, data):
+        """Send an event to the live connections of the given users. Safe to call from any thread.
+
+        Args:
+            event: the type of the event, `tweet`, `update` or `remove`.
+            data: the JSON serializable data of the event.
+        """
+        listening = [user_id for user_id in user_ids if user_id in self._subscriptions]
+        if not listening or self._loop is None:
+            return
+        self.published += 1
+        try:
+            self._loop.call_soon_threadsafe(self._deliver, listening, sseMessage(event, data))
+        except RuntimeError:
+            pass  # the event loop has been closed, the app is shutting down
+
+    def stats(self):
+        """Return the open connections and the events published and dropped."""
+        return {'connections': self._connections, 'published': self.published, 'dropped': self.dropped}
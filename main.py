@@ -1,660 +1,676 @@
-from fastapi import FastAPI, Request, HTTPException
-from fastapi.responses import HTMLResponse, RedirectResponse
-from fastapi.staticfiles import StaticFiles
+from fastapi import Depends, FastAPI, Request, HTTPException
+from fastapi.responses import HTMLResponse, JSONResponse, PlainTextResponse, RedirectResponse, Response, StreamingResponse
 from fastapi.templating import Jinja2Templates
-import google.oauth2.id_token
-from google.auth.transport import requests
 import starlette.status as status
-from google.cloud import firestore, storage
-from google.cloud.firestore_v1.base_query import FieldFilter, Or
+from starlette.concurrency import run_in_threadpool
+import functools
+from contextlib import asynccontextmanager
 from datetime import datetime
 import local_constants
-
-# define the app that will contain all of our routing for Fast API
-app = FastAPI()
-
-# Initialize Firestore client for database operations
-firestore_db = firestore.Client()
-
-# Set up request adapter for Firebase authentication
-firebase_request_adapter = requests.Request()
-
-# Define the static and templates directories
-app.mount('/static', StaticFiles(directory='static'), name='static')
-templates = Jinja2Templates(directory="templates")
-
-# cloud storage code
-def addDirectory(directory_name: str):
-    """Add an empty directory to the cloud storage bucket.
-    
-    Args:
-        directory_name: the name of the directory to add. Must have a trailing '/' in the name.
-    """
-    storage_client = storage.Client(project=local_constants.PROJECT_NAME)  # get the storage client using the specified project name
-    bucket = storage_client.bucket(local_constants.PROJECT_STORAGE_BUCKET)  # list the bucket we need to use using the specified bucket name
-
-    directory_name = directory_name + '/'  # dir names must end with a /
-    # make an empty directory and upload it to the bucket
-    blob = bucket.blob(directory_name)
-    blob.upload_from_string("", content_type="application/x-www-form-urlencoded:charset=UTF-8")
-
-def addFile(file, directory_name: str):
-    """Add a file to the cloud storage bucket.
-    
-    Args:
-        file: the name of the file to add.
-        directory_name: the name of the directory GCS directory to upload the file to
-    Returns:
-        a tuple of the blob name, and the public url of the image.
+from blocking import gatherBlocking, runBlocking
+from firebase_auth import TokenVerifier
+from metrics import InstrumentedBackend, MetricsMiddleware, registerCollected, renderMetrics, timedCall
+from jobs import JobQueue
+from admission import ADMISSIONS, SEARCH_LIMIT, SHED_RETRY_SECONDS, UPLOAD_LIMIT, ConcurrencyLimiter, Overloaded, RateLimit, RateLimiter, retryAfter
+from lifecycle import WarmUp
+from live import LIVE_RETRY_MS, LiveBus, TooManyConnections
+from repository import TweetChanged, createRepository
+from images import IMAGE_MAX_BYTES, IMAGE_TOO_LARGE, ImageRejected, deleteImage, makeRenditions, storeImage
+from storage_service import LocalBackend, createStorageService
+from search_index import decodeUsernameCursor
+from tweets import decodeCursor, tweetJson
+from read_cache import ReadCache
+from users import CurrentUser, UsernameRejected
+from views import ProfileHeader, TweetView, tweetViews
+from rendering import AnonymousPageCache, PageCompressionMiddleware, precompileTemplates, templateOptions
+from assets import AssetFiles, ImmutableFiles, StaticAssets
+
+FORM_OVERHEAD_BYTES = 64 * 1024  # room for the text fields and multipart framing of a form carrying an image
+UPLOAD_MAX_BYTES = IMAGE_MAX_BYTES + FORM_OVERHEAD_BYTES  # largest body of a form posting a tweet
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Warm up the clients and start the background jobs before serving, and stop the jobs on shutdown.
+
+    A failed warm-up step does not stop the app from starting, it keeps the readiness probe failing.
     """
-    storage_client = storage.Client(project=local_constants.PROJECT_NAME)  # get the storage client using the specified project name
-    bucket = storage_client.bucket(local_constants.PROJECT_STORAGE_BUCKET)  # list the bucket we need to use using the specified bucket name
+    await warm_up.run()
+    job_queue.start()
+    yield
+    job_queue.stop()
 
-    blob = bucket.blob(directory_name + '/' + file.filename)
-    blob.upload_from_file(file.file)
-    return (directory_name + '/' + file.filename, blob.public_url)
-
-def deleteFile(blob_name:  str):
-    """Delete a file in the cloud storage bucket.
-    
-    Args:
-        blob_name: the name of the blob to be deleted in GCS
-    """
-    storage_client = storage.Client(project=local_constants.PROJECT_NAME)  # get the storage client using the specified project name
-    bucket = storage_client.bucket(local_constants.PROJECT_STORAGE_BUCKET)  # list the bucket we need to use using the specified bucket name
-    
-    bucket.delete_blob(blob_name)
-
-def getUser(user_token):
-    """Function to retrieve user data from Firestore or create a default user if not found.
-    
-    If the user does not exist, create a document with blank fields.
-    """
-    user = firestore_db.collection('User').document(user_token['user_id'])
-    if not user.get().exists:
-        user_data = {
-            "username": "",  # username for this user
-            "tweets": [],  # a list of the tweets associated with this user
-            "following": [],  # a list of usernames of the users this user follows
-            "followers": [],  # a list of usernames of the users who follow this user
-        }
-        firestore_db.collection('User').document(user_token['user_id']).set(user_data)
-    return user
-
-def validateFirebaseToken(id_token):
+# define the app that will contain all of our routing for Fast API
+app = FastAPI(lifespan=lifespan)
+app.add_middleware(MetricsMiddleware)  # time every request, and log the backend calls of slow ones
+app.add_middleware(PageCompressionMiddleware)  # gzip the pages and JSON
+
+# Cache recently read users and tweets across requests, invalidated by the repository when it writes them
+read_cache = ReadCache()
+for name, kind in (('hits', 'counter'), ('shared_hits', 'counter'), ('misses', 'counter'), ('invalidations', 'counter'), ('evictions', 'counter'), ('size', 'gauge')):
+    registerCollected(f'app_read_cache_{name}', f'Read cache {name.replace("_", " ")}.', lambda name=name: read_cache.stats()[name], kind)
+
+# The users, follows and tweets, kept in Firestore or a local SQLite database (see `repository.py`)
+repository = createRepository(read_cache)
+
+# Set up the verifier for Firebase ID tokens, which caches Google's certificates and verified tokens
+token_verifier = TokenVerifier(local_constants.PROJECT_NAME)
+
+# Create the storage service shared by every request for uploading and deleting images
+storage_service = createStorageService(local_constants.PROJECT_NAME, local_constants.PROJECT_STORAGE_BUCKET)
+
+# Define the static and templates directories, serving static assets fingerprinted and precompressed once built
+static_assets = StaticAssets('static')
+app.mount('/static', AssetFiles(static_assets), name='static')
+if isinstance(storage_service.backend, LocalBackend):
+    app.mount('/media', ImmutableFiles(directory=storage_service.backend.root, check_dir=False), name='media')  # serve images stored locally, which never change
+storage_service.backend = InstrumentedBackend(storage_service.backend)  # time and count every storage call
+
+# Push the changes of users' timelines to the pages they have open
+live_bus = LiveBus()
+for name, kind in (('connections', 'gauge'), ('published', 'counter'), ('dropped', 'counter')):
+    registerCollected(f'app_live_{name}', f'Live timeline {name}.', lambda name=name: live_bus.stats()[name], kind)
+
+def publishTimelineChange(user_ids: list[str], event: str, data: dict):
+    """Push a change of the timelines of the given users to their open pages: a tweet card, or the ids of removed tweets."""
+    live_bus.publish(user_ids, event, data if event == 'remove' else tweetJson(data))
+
+def makeTweetRenditions(user_id: str, tweet_id: str, blob_name: str):
+    """Make the thumbnail and display sized image of a tweet's image, run as a background job after responding."""
+    if makeRenditions(repository, storage_service, tweet_id, blob_name):
+        enqueueCardRefresh(user_id, tweet_id)  # the renditions are recorded on the tweet's card
+
+# Run the side effects responses don't wait for on a durable background job queue
+job_queue = JobQueue()
+job_queue.register('addDirectory', storage_service.addDirectory)
+job_queue.register('deleteImage', functools.partial(deleteImage, storage_service))
+job_queue.register('makeRenditions', makeTweetRenditions)
+job_queue.register('pushToFollowerTimelines', functools.partial(repository.pushToFollowerTimelines, notify=publishTimelineChange))
+job_queue.register('refreshCardInTimelines', functools.partial(repository.refreshCardInTimelines, notify=publishTimelineChange))
+job_queue.register('removeFromFollowerTimelines', functools.partial(repository.removeFromFollowerTimelines, notify=publishTimelineChange))
+
+# Let requests to the expensive routes in at a rate per user and a number in flight per worker
+rate_limiter = RateLimiter()
+expensive_requests = ConcurrencyLimiter()
+registerCollected('app_admission_in_flight', 'Expensive requests in flight.', lambda: expensive_requests.in_flight)
+
+templates = Jinja2Templates(directory="templates", **templateOptions())
+templates.env.globals['asset_path'] = static_assets.path  # link static assets by their fingerprinted names
+anonymous_pages = AnonymousPageCache(templates)  # pages shown to signed out visitors are the same for all of them
+
+# Make the first requests fast by doing the slow parts of setting up when the app starts
+warm_up = WarmUp()
+warm_up.add('static_assets', static_assets.build)  # before the first page links them
+warm_up.add('templates', precompileTemplates, templates.env)  # compile every template rather than on the first request to use it
+warm_up.add('database', repository.ping)
+warm_up.add('jobs', job_queue.prune)  # opens the job database, dropping jobs finished long ago
+warm_up.add('firebase_certs', token_verifier.certs)
+warm_up.add('storage', storage_service.warm)
+warm_up.add('request_threads', run_in_threadpool, lambda: None)  # load the thread pool plain `def` dependencies run on, which first costs about 20ms
+
+async def validateFirebaseToken(id_token):
     """Function to validate Firebase ID token and retrieve user information."""
     if not id_token:
         return None
     
     user_token = None
     try:
-        user_token = google.oauth2.id_token.verify_firebase_token(id_token, firebase_request_adapter)
+        with timedCall('firebase', 'verify_token'):
+            user_token = await token_verifier.verify(id_token)
     except ValueError as err:
         print(str(err))
 
     return user_token
 
-def sort_tweets(tweet):
-    """Return the key for sorting the tweets according to the date."""
+async def currentUser(request: Request) -> CurrentUser | None:
+    """Dependency verifying the request's Firebase token and loading the signed in user once per request.
+
+    Returns None if there is no valid login, in which case routes show the login box.
+    """
+    user_token = await validateFirebaseToken(request.cookies.get("token"))
+    if not user_token:
+        return None
+    return await runBlocking(repository.loadUser, user_token)
+
+def admission(route: str, limit: RateLimit):
+    """Dependency letting a signed in user's request to an expensive route in, before its body is read.
+
+    Answers 429 if the user is over their rate for the route, and 503 if the worker has too many
+    expensive requests in flight, both with a Retry-After header.
+    """
+    async def admit(user: CurrentUser | None = Depends(currentUser)):
+        if not user:
+            yield  # the route shows the login box
+            return
+        if rate_limiter.tier is None:
+            wait = rate_limiter.take(user.user_id, route, limit)
+        else:
+            wait = await runBlocking(rate_limiter.take, user.user_id, route, limit)  # a round trip to the shared tier
+        if wait:
+            ADMISSIONS.inc((route, 'rate_limited'))
+            raise HTTPException(status_code=status.HTTP_429_TOO_MANY_REQUESTS, detail="Too many requests, please slow down", headers={'Retry-After': retryAfter(wait)})
+        try:
+            expensive_requests.acquire()
+        except Overloaded as err:
+            ADMISSIONS.inc((route, 'shed'))
+            raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail=str(err), headers={'Retry-After': retryAfter(SHED_RETRY_SECONDS)})
+        ADMISSIONS.inc((route, 'admitted'))
+        try:
+            yield
+        finally:
+            expensive_requests.release()
+    return admit
+
+def loginPage(request: Request):
+    """Return the main page with empty data, which shows the login box.
+
+    The page is rendered once and answered with 304 Not Modified when the browser already has it.
+    """
+    body, etag = anonymous_pages.render(request, 'main.html', user_token=None, errors=None, user_info=None)
+    headers = {'ETag': etag, 'Cache-Control': 'no-cache', 'Vary': 'Cookie'}  # signed in visitors get their timeline at the same URL
+    if request.method in ('GET', 'HEAD') and etag in request.headers.get('if-none-match', ''):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+    return HTMLResponse(body, headers=headers)
+
+def pageCursor(cursor: str | None = None):
+    """Dependency reading the `cursor` query parameter of a paginated page, rejecting malformed cursors."""
+    if cursor:
+        try:
+            decodeCursor(cursor)
+        except ValueError:
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid cursor")
+    return cursor
+
+def searchPage(page: str | None):
+    """Read the page number of a search form, answering 400 unless it is a positive integer."""
     try:
-        return tweet.get("date")
+        page = int(page or 1)
     except ValueError:
-        return tweet.get().get("date")
+        page = 0
+    if page < 1:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid page")
+    return page
+
+def apiUser(user: CurrentUser | None = Depends(currentUser)):
+    """Dependency for the JSON API, which answers 401 instead of showing the login box."""
+    if not user:
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Not signed in")
+    return user
 
-async def generate_timeline(user_token):
-    """Generate a timeline for the user of the 20 latest tweets from the user's tweets and the people the user is following."""
-    user = firestore_db.collection('User').document(user_token['user_id'])
-    following = user.get().get("following")
-    following.append(user.get().get("username"))
-    tweets_ref = firestore_db.collection('Tweet')
-    tweets_query = tweets_ref.where("username", "in", following).order_by("username", direction=firestore.Query.ASCENDING).order_by("date", direction=firestore.Query.DESCENDING)
+async def personId(username: str):
+    """Return the User document id of a username, answering 404 if nobody has it."""
+    person_id = await runBlocking(repository.userIdForUsername, username)
+    if person_id is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="User not found")
+    return person_id
+
+async def ownTweet(user: CurrentUser, tweet_id: str):
+    """Load a tweet posted by the signed in user, answering 404 if it does not exist or belongs to someone else."""
+    tweet = await runBlocking(repository.getTweet, tweet_id)
+    if tweet is None or tweet.data.get('author_id') != user.user_id:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Tweet not found")
+    return tweet
+
+def enqueueImageDeletion(tweet_data: dict):
+    """Queue the deletion of the image of a tweet and its renditions, if it has one."""
+    if not tweet_data.get('blob_name'):
+        return
+    image_fields = {'blob_name': tweet_data['blob_name'], 'rendition_blob_names': tweet_data.get('rendition_blob_names', [])}
+    job_queue.enqueue('deleteImage', key=f"deleteImage:{tweet_data['blob_name']}", tweet_data=image_fields)
+
+def enqueueCardRefresh(user_id: str, tweet_id: str):
+    """Queue replacing the card of a tweet in the timelines of its author and their followers."""
+    job_queue.enqueue('refreshCardInTimelines', user_id=user_id, tweet_id=tweet_id)
+
+def enqueueRenditions(user_id: str, tweet_id: str, blob_name: str):
+    """Queue making the renditions of a tweet's image, once per image."""
+    job_queue.enqueue('makeRenditions', key=f'makeRenditions:{tweet_id}:{blob_name}', user_id=user_id, tweet_id=tweet_id, blob_name=blob_name)
+
+async def saveTweetChange(tweet_data: dict, change, *args):
+    """Make a change to a tweet with `change(*args)` and return its result.
+
+    Answers 409 if the tweet changed since it was read, deleting any image uploaded for the change.
+    """
+    try:
+        return await runBlocking(change, *args)
+    except TweetChanged:
+        await runBlocking(enqueueImageDeletion, tweet_data)  # nothing points to the uploaded image
+        raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail="The tweet was changed meanwhile, please try again")
+    except Exception:
+        await runBlocking(enqueueImageDeletion, tweet_data)
+        raise
+
+async def ownProfile(request: Request, user: CurrentUser, errors: str | None = None, cursor: str | None = None, status_code: int = status.HTTP_200_OK):
+    """Render a page of the profile of the signed in user."""
+    tweets, next_cursor = await runBlocking(repository.tweetsByAuthor, user.user_id, cursor)
+    context = dict(
+        request=request,
+        user_token=user.token,
+        errors=errors,
+        user_info=user,
+        profile=ProfileHeader(username=user.username, following=user.following_count, followers=user.followers_count, is_own=True),
+        tweets=tweetViews(tweets),
+        next_cursor=next_cursor,
+    )
+    return templates.TemplateResponse('view-profile.html', context=context, status_code=status_code)
 
-    tweets = tweets_query.get()
-    sorted_tweets = sorted(tweets, key=sort_tweets, reverse=True)
-    #return reversed(sorted_tweets[-20:])
-    return sorted_tweets[:19]
+async def generate_timeline(user: CurrentUser, cursor: str | None = None):
+    """Generate a page of the timeline of the user, from the user's tweets and the people the user is following.
+
+    Returns:
+        a tuple of the tweet cards on the page and the cursor of the next page, or None if it is the last.
+    """
+    return await runBlocking(repository.timeline, user.user_id, user.username, cursor)
 
 @app.get('/set-username', response_class=HTMLResponse)
-async def setUsername(request: Request):
+async def setUsername(request: Request, user: CurrentUser | None = Depends(currentUser)):
     """Route (GET) for setting the username when a user logs in for the first time."""
-    id_token = request.cookies.get("token")
-    errors: str | None = None
-    user_token = None
-    user = None
-
-    user_token = validateFirebaseToken(id_token)
-    user = getUser(user_token).get()
-
     # Validate user token - check if we have a valid firebase login if not return the template with empty data as we will show the login box
-    if not user_token:
-        context = dict(
-            request=request,
-            user_token=None,
-            errors=errors,
-            user_info=None
-        )
-        return templates.TemplateResponse('main.html', context=context)
+    if not user:
+        return loginPage(request)
 
     context = dict(
         request=request,
-        user_token=user_token,
-        error_message=errors,
+        user_token=user.token,
+        errors=None,
         user_info=user,
     )
 
     return templates.TemplateResponse('set-username.html', context=context)
 
 @app.post('/set-username', response_class=HTMLResponse)
-async def setUsername(request: Request):
+async def setUsername(request: Request, user: CurrentUser | None = Depends(currentUser)):
     """Route (POST) for setting the username.
     
     If the username is taken, redisplay the form with the error message.
     """
-    id_token = request.cookies.get("token")
-    user_token = None
-    errors: str | None = None
-
-    user_token = validateFirebaseToken(id_token)
+    if not user:
+        return loginPage(request)
 
     form = await request.form()
 
-    user_exists = firestore_db.collection("User").where(filter=FieldFilter('username', '==', form['username'])).get()
-    if user_exists:
-        errors = 'This username is already taken.'
+    try:
+        await runBlocking(repository.claimUsername, user.user_id, form['username'])
+    except UsernameRejected as err:
         context = dict(
             request=request,
             user_token=None,
-            errors=errors,
+            errors=str(err),
             user_info=None
         )
         return templates.TemplateResponse('set-username.html', context=context)
 
-    firestore_db.collection('User').document(user_token['user_id']).update({"username": form["username"]})
-    addDirectory(form['username'])
+    await runBlocking(job_queue.enqueue, 'addDirectory', key=f"addDirectory:{form['username']}", directory_name=form['username'])
     return RedirectResponse("/", status_code=status.HTTP_302_FOUND)
 
 @app.get("/", response_class=HTMLResponse)
-async def root(request: Request):
+async def root(request: Request, user: CurrentUser | None = Depends(currentUser), cursor: str | None = Depends(pageCursor)):
     """Route (GET) for the main page, handling user authentication, setting username for first time login, and displaying timeline."""
-    # Query firebase for the request token. An error message is set in case we want to output an error to 
-    # the user in the template.
-    id_token = request.cookies.get("token")
-    errors: str | None = None
-    user_token = None
-    user = None
-
-    user_token = validateFirebaseToken(id_token)
-
     # Validate user token - check if we have a valid firebase login if not return the template with empty data as we will show the login box
-    if not user_token:
-        context = dict(
-            request=request,
-            user_token=None,
-            errors=errors,
-            user_info=None
-        )
-        return templates.TemplateResponse('main.html', context=context)
-    
-    user = getUser(user_token).get()
-    if not user.get("username"):
+    if not user:
+        return loginPage(request)
+
+    if not user.username:
         context = dict(
             request=request,
-            user_token=user_token,
-            errors=errors,
+            user_token=user.token,
+            errors=None,
             user_info=user
         )
         return templates.TemplateResponse('set-username.html', context=context)
 
+    tweets, next_cursor = await generate_timeline(user, cursor)
     context = dict(
         request=request,
-        user_token=user_token,
-        errors=errors,
+        user_token=user.token,
+        errors=None,
         user_info=user,
-        tweets= await generate_timeline(user_token)
+        tweets=tweetViews(tweets),
+        next_cursor=next_cursor,
+        live=not cursor,  # the first page is kept up to date as tweets are posted
     )
 
     return templates.TemplateResponse('main.html', context=context)
 
 @app.get("/profile", response_class=HTMLResponse)
-async def viewYourProfile(request: Request):
+async def viewYourProfile(request: Request, user: CurrentUser | None = Depends(currentUser), cursor: str | None = Depends(pageCursor)):
     """Route (GET) for displaying the user's own profile."""
-    id_token = request.cookies.get("token")
-    errors: str | None = None
-    user_token = None
-    user = None
+    if not user:
+        return loginPage(request)
 
-    user_token = validateFirebaseToken(id_token)
-
-    # Validate user token - check if we have a valid firebase login if not return the template with empty data as we will show the login box
-    if not user_token:
-        context = dict(
-            request=request,
-            user_token=None,
-            errors=errors,
-            user_info=None
-        )
-        return templates.TemplateResponse('main.html', context=context)
-    
-    user = getUser(user_token).get()
+    return await ownProfile(request, user, cursor=cursor)
 
+def addTweetForm(request: Request, user: CurrentUser, errors: str | None = None, status_code: int = status.HTTP_200_OK):
+    """Render the form for adding a tweet, with an error message if the last attempt failed."""
     context = dict(
         request=request,
-        user_token=user_token,
-        error=errors,
+        user_token=user.token,
+        errors=errors,
         user_info=user,
-        personal_info=user.get("username"),
-        following=len(user.get("following")),
-        followers=len(user.get("followers")),
-        tweets=sorted(user.get('tweets'), key=sort_tweets, reverse=True),
     )
-    return templates.TemplateResponse('view-profile.html', context=context)
+    return templates.TemplateResponse('add-tweet.html', context=context, status_code=status_code)
+
+class BodyTooLarge(Exception):
+    """A request body larger than its route accepts."""
+
+async def readUploadForm(request: Request, max_bytes: int = UPLOAD_MAX_BYTES):
+    """Read a form carrying an upload, counting the bytes of its body as they are received.
+
+    A body declaring a larger Content-Length is refused before any of it is read, and a chunked one
+    as soon as it goes past the limit, so an oversized upload is never spooled in full.
+
+    Raises:
+        BodyTooLarge: if the body is larger than `max_bytes`.
+    """
+    if int(request.headers.get('content-length') or 0) > max_bytes:
+        raise BodyTooLarge()
+    received = 0
+
+    async def receive():
+        nonlocal received
+        message = await request.receive()
+        received += len(message.get('body', b''))
+        if received > max_bytes:
+            raise BodyTooLarge()
+        return message
+
+    return await Request(request.scope, receive).form()
 
 @app.get("/post", response_class=HTMLResponse)
-async def addTweet(request: Request):
+async def addTweet(request: Request, user: CurrentUser | None = Depends(currentUser)):
     """Route (GET) for adding a tweet.
 
     Return the html form where user types the tweet.
     """
-    id_token = request.cookies.get("token")
-    errors: str | None = None
-    user_token = None
-    user = None
-
-    user_token = validateFirebaseToken(id_token)
-    user = getUser(user_token).get()
-
-    # Validate user token - check if we have a valid firebase login if not return the template with empty data as we will show the login box
-    if not user_token:
-        context = dict(
-            request=request,
-            user_token=user_token,
-            error_message=errors,
-            user_info=user,
-        )
-        return templates.TemplateResponse('main.html', context=context)
-    
-    context = dict(
-        request=request,
-        user_token=user_token,
-        errors=None,
-        user_info=user,
-    )
+    if not user:
+        return loginPage(request)
 
-    return templates.TemplateResponse('add-tweet.html', context=context)
+    return addTweetForm(request, user)
 
-@app.post("/post", response_class=HTMLResponse)
-async def addTweet(request: Request):
+@app.post("/post", response_class=HTMLResponse, dependencies=[Depends(admission('post', UPLOAD_LIMIT))])
+async def addTweet(request: Request, user: CurrentUser | None = Depends(currentUser)):
     """Route (POST) for adding a tweet.
 
     Saves the associated tweet to the db.
     """
-    id_token = request.cookies.get("token")
-    errors: str | None = None
-    user_token = None
-    user = None
+    if not user:
+        return loginPage(request)
 
-    user_token = validateFirebaseToken(id_token)
-    user = getUser(user_token)
-
-    # Validate user token - check if we have a valid firebase login if not return the template with empty data as we will show the login box
-    if not user_token:
-        context = dict(
-            request=request,
-            user_token=user_token,
-            error_message=errors,
-            user_info=user,
-        )
-        return templates.TemplateResponse('main.html', context=context)
-
-    user_name = user.get().get("username")
-    image_url = ''
-    blob_name = ''
-
-    form = await request.form()
-    if form['tweetImage'] and form['tweetImage'].filename:
-        blob_name, image_url = addFile(form["tweetImage"], user_name)
-    
+    try:
+        form = await readUploadForm(request)
+    except BodyTooLarge:
+        return addTweetForm(request, user, IMAGE_TOO_LARGE, status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE)
     tweet_data = {
-        'username': user_name,  # the username of the user who posted the tweet
+        'author_id': user.user_id,  # the id of the User document of the user who posted the tweet
+        'username': user.username,  # the username of the user who posted the tweet
         'date': datetime.strptime(datetime.now().strftime("%Y-%m-%d %H:%M:%S"), "%Y-%m-%d %H:%M:%S"),  # a timestamp of the time the tweet was posted
         'body': form['tweet'],  # the main content of the tweet
-        'image_url': image_url,  # public url of the image associated with this tweet
-        'blob_name': blob_name,  # name of the blob in the bucket, to be used when deleting an image
+        'image_url': '',  # public url of the image associated with this tweet
+        'blob_name': '',  # name of the blob in the bucket, to be used when deleting an image
     }
-    tweet_ref = firestore_db.collection('Tweet').document()
-    tweet_ref.set(tweet_data)
-    tweets_list = user.get().get('tweets')
-    tweets_list.append(tweet_ref)
-    user.update({'tweets': tweets_list})
+    if form['tweetImage'] and form['tweetImage'].filename:
+        try:
+            image_fields = await runBlocking(storeImage, storage_service, form["tweetImage"], user.username)
+        except ImageRejected as err:
+            return addTweetForm(request, user, str(err), status_code=err.status_code)
+        tweet_data.update(image_fields)
+
+    card = await saveTweetChange(tweet_data, repository.addTweet, tweet_data)  # the author sees the tweet on their timeline straight away
+    publishTimelineChange([user.user_id], 'tweet', card)  # on their other open pages too
+    await runBlocking(job_queue.enqueue, 'pushToFollowerTimelines', key=f"pushToFollowerTimelines:{card['id']}", user_id=user.user_id, tweet_id=card['id'])  # and their followers a moment later
+    if tweet_data['blob_name']:
+        await runBlocking(enqueueRenditions, user.user_id, card['id'], tweet_data['blob_name'])
     
     return RedirectResponse('/', status_code=status.HTTP_302_FOUND)
 
-@app.post("/search-username", response_class=HTMLResponse)
-async def searchUsername(request: Request):
+@app.post("/search-username", response_class=HTMLResponse, dependencies=[Depends(admission('search-username', SEARCH_LIMIT))])
+async def searchUsername(request: Request, user: CurrentUser | None = Depends(currentUser)):
     """Route (POST) for searching a username in the database."""
-    id_token = request.cookies.get("token")
-    errors: str | None = None
-    user_token = None
-    user = None
-
-    user_token = validateFirebaseToken(id_token)
-    user = getUser(user_token).get()
-
-    # Validate user token - check if we have a valid firebase login if not return the template with empty data as we will show the login box
-    if not user_token:
-        context = dict(
-            request=request,
-            user_token=user_token,
-            errors=errors,
-            user_info=user,
-        )
-        return templates.TemplateResponse('main.html', context=context)
+    if not user:
+        return loginPage(request)
     
     form = await request.form()
     username_query = form['username']
+    cursor = form.get('cursor')
+    if cursor:
+        try:
+            decodeUsernameCursor(cursor)
+        except ValueError:
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid cursor")
 
-    matched_users = []
-    for user in firestore_db.collection('User').stream():
-        if user.get('username')[:len(username_query)].lower() == username_query.lower():
-            matched_users.append(user)
+    matched_users, next_cursor = await runBlocking(repository.searchUsernames, username_query, cursor)
 
     context = dict(
         request=request,
-        user_token=user_token,
-        errors=errors,
+        user_token=user.token,
+        errors=None,
         user_info=user,
         user_results=matched_users,
+        username_query=username_query,
+        next_cursor=next_cursor,
     )
 
     return templates.TemplateResponse('user-search-results.html', context=context)
 
-@app.post("/search-tweet", response_class=HTMLResponse)
-async def searchTweet(request: Request):
+@app.post("/search-tweet", response_class=HTMLResponse, dependencies=[Depends(admission('search-tweet', SEARCH_LIMIT))])
+async def searchTweet(request: Request, user: CurrentUser | None = Depends(currentUser)):
     """Route (POST) for searching content in tweets."""
-    id_token = request.cookies.get("token")
-    errors: str | None = None
-    user_token = None
-    user = None
-
-    user_token = validateFirebaseToken(id_token)
-    user = getUser(user_token).get()
-
-    # Validate user token - check if we have a valid firebase login if not return the template with empty data as we will show the login box
-    if not user_token:
-        context = dict(
-            request=request,
-            user_token=user_token,
-            errors=errors,
-            user_info=user,
-        )
-        return templates.TemplateResponse('main.html', context=context)
+    if not user:
+        return loginPage(request)
     
     form = await request.form()
     content_query = form['content']
+    page = searchPage(form.get('page'))
 
-    matched_content = [tweet for tweet in firestore_db.collection('Tweet').stream() if tweet.get('body')[:len(content_query)].lower() == content_query.lower()]
+    matched_content, has_next_page = await runBlocking(repository.searchTweets, content_query, page)
 
     context = dict(
         request=request,
-        user_token=user_token,
-        errors=errors,
+        user_token=user.token,
+        errors=None,
         user_info=user,
-        tweet_results=sorted(matched_content, key=sort_tweets, reverse=True),
+        tweet_results=tweetViews(matched_content),
+        content_query=content_query,
+        page=page,
+        has_next_page=has_next_page,
     )
     return templates.TemplateResponse('tweet-search-results.html', context=context)
 
 @app.get("/view-profile/{person}", response_class=HTMLResponse)
-async def viewOthersProfile(request: Request, person):
+async def viewOthersProfile(request: Request, person, user: CurrentUser | None = Depends(currentUser), cursor: str | None = Depends(pageCursor)):
     """Route (GET) for viewing the profile of another user given their username.
     
     Args:
         person -> str: the username of the user's profile to view.
     """
-    id_token = request.cookies.get("token")
-    errors: str | None = None
-    user_token = None
-    user = None
-
-    user_token = validateFirebaseToken(id_token)
-    user = getUser(user_token).get()
-
-    # Validate user token - check if we have a valid firebase login if not return the template with empty data as we will show the login box
-    if not user_token:
-        context = dict(
-            request=request,
-            user_token=user_token,
-            errors=errors,
-            user_info=user,
-        )
-        return templates.TemplateResponse('main.html', context=context)
-
-    *_, person_query = firestore_db.collection('User').where(filter=FieldFilter('username', '==', person)).get()
+    if not user:
+        return loginPage(request)
+
+    person_id = await personId(person)
+    (tweets, next_cursor), is_following, person_data = await gatherBlocking(
+        (repository.tweetsByAuthor, person_id, cursor),
+        (repository.isFollowing, user.user_id, person_id),
+        (repository.userData, person_id),
+    )
 
     context = dict(
         request=request,
-        user_token=user_token,
-        errors=errors,
+        user_token=user.token,
+        errors=None,
         user_info=user,
-        personal_info=person_query.get("username"),
-        is_following=person in user.get("following"),
-        following=len(person_query.get("following")),
-        followers=len(person_query.get("followers")),
-        tweets=sorted(person_query.get("tweets")[-10] if len(person_query.get('tweets')) > 10 else person_query.get('tweets'), key=sort_tweets, reverse=True),
+        profile=ProfileHeader(
+            username=person_data["username"],
+            following=person_data.get("following_count", 0),
+            followers=person_data.get("followers_count", 0),
+            is_own=person_id == user.user_id,
+            is_following=is_following,
+        ),
+        tweets=tweetViews(tweets),
+        next_cursor=next_cursor,
     )
     return templates.TemplateResponse('view-profile.html', context=context)
 
 @app.post("/follow/{person}", response_class=HTMLResponse)
-async def follow(request: Request, person):
+async def follow(request: Request, person, user: CurrentUser | None = Depends(currentUser)):
     """Route (POST) for following another user.
     Args:
         person -> str: the username of the user to follow.
     """
-    id_token = request.cookies.get("token")
-    errors: str | None = None
-    user_token = None
-    user = None
+    if not user:
+        return loginPage(request)
 
-    user_token = validateFirebaseToken(id_token)
-    user = getUser(user_token)
-
-    # Validate user token - check if we have a valid firebase login if not return the template with empty data as we will show the login box
-    if not user_token:
-        context = dict(
-            request=request,
-            user_token=user_token,
-            errors=errors,
-            user_info=user,
-        )
-        return templates.TemplateResponse('main.html', context=context)
-
-    *_, person_query = firestore_db.collection('User').where(filter=FieldFilter('username', '==', person)).get()  # query the user snapshot document matching the name given, and unpack the list elements taking only the last element and discarding the rest
-    person_followers = person_query.get("followers")  # get the followers list associated with the user
-    person_followers.append(user.get().get("username"))  # add a new element to the list of followers
-    person_query.reference.update({"followers": person_followers})  # on the user snapshot document, get the reference to the DocumentReference which will be used to update the list of followers on the user document
-    following_list = user.get().get("following")  # get the list of the users the signed in user is following
-    following_list.append(person)  # add a new element to this list for the other user to start following
-    user.update({'following': following_list})  # update the list of following users in the user document
+    person_id = await personId(person)
+    if person_id != user.user_id:
+        await runBlocking(repository.addFollow, user.user_id, user.username, person_id, person)  # also merges the followed user's latest tweets into this user's timeline
 
     return RedirectResponse(f"/view-profile/{person}/", status_code=status.HTTP_302_FOUND)
 
 @app.post("/unfollow/{person}", response_class=HTMLResponse)
-async def unfollow(request: Request, person):
+async def unfollow(request: Request, person, user: CurrentUser | None = Depends(currentUser)):
     """Route (POST) for unfollowing a followed user.
     
     Args:
         person -> str: the username of the user to unfollow.
     """
-    id_token = request.cookies.get("token")
-    user_token = None
-    user = None
-    errors: str | None = None
-
-    user_token = validateFirebaseToken(id_token)
-    user = getUser(user_token)
-
-    # Validate user token - check if we have a valid firebase login if not return the template with empty data as we will show the login box
-    if not user_token:
-        context = dict(
-            request=request,
-            user_token=user_token,
-            errors=errors,
-            user_info=user,
-        )
-        return templates.TemplateResponse('main.html', context=context)
+    if not user:
+        return loginPage(request)
 
-    *_, person_query = firestore_db.collection('User').where(filter=FieldFilter('username', '==', person)).get()  # query the user snapshot document matching the name given, and unpack the list elements taking only the last element and discarding the rest
-    person_followers = person_query.get("followers")  # get the followers list associated with the user
-    person_followers.remove(user.get().get("username"))  # remove the username of this user from the list of followers
-    person_query.reference.update({"followers": person_followers})  # on the user snapshot document, get the reference to the DocumentReference which will be used to update the list of followers on the user document
-    following_list = user.get().get("following")  # get the list of the users the signed in user is following
-    following_list.remove(person)   # add a new element to this list for the other user to start following
-    user.update({'following': following_list})  # update the list of following users in the user document
+    person_id = await personId(person)
+    await runBlocking(repository.removeFollow, user.user_id, person_id, person)  # also drops the unfollowed user's tweets from this user's timeline
 
     return RedirectResponse(f"/view-profile/{person}/", status_code=status.HTTP_302_FOUND)
 
-@app.get('/edit-tweet/{tweet_index}', response_class=HTMLResponse)
-async def editTweet(request: Request, tweet_index):
+@app.get('/edit-tweet/{tweet_id}', response_class=HTMLResponse)
+async def editTweet(request: Request, tweet_id, user: CurrentUser | None = Depends(currentUser)):
     """Route (GET) for editing a tweet.
     
     Args:
-        tweet_index -> str: the index of the tweet in the `tweets` list associated with each user account.
+        tweet_id -> str: the document id of the tweet.
 
     Return a form prefilled with the current tweet content."""
-    id_token = request.cookies.get("token")
-    errors: str | None = None
-    user_token = None
-    user = None
-
-    user_token = validateFirebaseToken(id_token)
-    user = getUser(user_token).get()
-
-    # Validate user token - check if we have a valid firebase login if not return the template with empty data as we will show the login box
-    if not user_token:
-        context = dict(
-            request=request,
-            user_token=user_token,
-            errors=errors,
-            user_info=user,
-        )
-        return templates.TemplateResponse('main.html', context=context)
+    if not user:
+        return loginPage(request)
 
     context = dict(
         request=request,
-        user_token=user_token,
-        errors=errors,
+        user_token=user.token,
+        errors=None,
         user_info=user,
-        index=len(user.get("tweets")) - 1 - int(tweet_index),
-        tweet=user.get("tweets")[len(user.get("tweets")) - 1 - int(tweet_index)],
+        tweet=TweetView.fromRecord((await ownTweet(user, tweet_id)).record),
     )
     
     return templates.TemplateResponse('edit-tweet.html', context=context)
 
-@app.post('/edit-tweet', response_class=HTMLResponse)
-async def editTweet(request: Request):
+@app.post('/edit-tweet', response_class=HTMLResponse, dependencies=[Depends(admission('edit-tweet', UPLOAD_LIMIT))])
+async def editTweet(request: Request, user: CurrentUser | None = Depends(currentUser)):
     """Route (POST) for editing a tweet.
     
     Saves the updated tweet content to the datatbase.
     """
-    id_token = request.cookies.get("token")
-    errors: str | None = None
-    user_token = None
-    user = None
+    if not user:
+        return loginPage(request)
 
-    user_token = validateFirebaseToken(id_token)
-    user = getUser(user_token)
-
-    # Validate user token - check if we have a valid firebase login if not return the template with empty data as we will show the login box
-    if not user_token:
-        context = dict(
-            request=request,
-            user_token=user_token,
-            error=errors,
-            user_info=user,
-        )
-        return templates.TemplateResponse('main.html', context=context)
-
-    users_tweets = user.get().get('tweets')
-    form = await request.form()
-    tweet_index = int(form['index'])
+    try:
+        form = await readUploadForm(request)
+    except BodyTooLarge:
+        return await ownProfile(request, user, IMAGE_TOO_LARGE, status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE)
+    tweet = await ownTweet(user, form['tweet_id'])
     updated_tweet = form['tweet']
-    image_url = ''
-    blob_name = users_tweets[tweet_index].get().get("blob_name")
+    tweet_data = {
+        'body': updated_tweet
+    }
 
     if form['tweetImage'] and form['tweetImage'].filename:
         """A new image has been uploaded with the tweet"""
-        if blob_name:
-            deleteFile(blob_name)  # delete the old image associated with this tweet
-        blob_name, image_url = addFile(form["tweetImage"], user.get().get("username"))  # set the new image
-        tweet_data = {
-            'body': updated_tweet,
-            'image_url': image_url,
-            'blob_name': blob_name,
-        }
-    else:
-        tweet_data = {
-            'body': updated_tweet
-        }
-    
-    users_tweets[tweet_index].update(tweet_data)
-
-    context = dict(
-        request=request,
-        user_token=user_token,
-        errors=errors,
-        user_info=user.get(),
-        personal_info=user.get().get("username"),
-        following=len(user.get().get("following")),
-        followers=len(user.get().get("followers")),
-        tweets=user.get().get('tweets'),
-    )
-    return templates.TemplateResponse('view-profile.html', context=context)
+        try:
+            image_fields = await runBlocking(storeImage, storage_service, form["tweetImage"], user.username)  # set the new image
+        except ImageRejected as err:
+            context = dict(
+                request=request,
+                user_token=user.token,
+                errors=str(err),
+                user_info=user,
+                tweet=TweetView.fromRecord(tweet.record),
+            )
+            return templates.TemplateResponse('edit-tweet.html', context=context, status_code=err.status_code)
+        tweet_data.update(image_fields)
+
+    await saveTweetChange(tweet_data, repository.editTweet, tweet, tweet_data)  # unless the tweet changed since it was read
+    await runBlocking(enqueueCardRefresh, user.user_id, tweet.id)  # show the new card in the timelines of the author's followers too
+    if 'blob_name' in tweet_data:
+        await runBlocking(enqueueImageDeletion, tweet.data)  # delete the old image associated with this tweet, now nothing points to it
+        await runBlocking(enqueueRenditions, user.user_id, tweet.id, tweet_data['blob_name'])
+
+    return await ownProfile(request, user)
 
 @app.post('/delete-tweet', response_class=HTMLResponse)
-async def deleteTweet(request: Request):
+async def deleteTweet(request: Request, user: CurrentUser | None = Depends(currentUser)):
     """Route (POST) for deleting a tweet.
     
-    Deletes the tweet from the database and from the `tweets` list associated with the user.
+    Deletes the tweet from the database, the search index and the timelines it was fanned out to.
     """
-    id_token = request.cookies.get("token")
-    errors: str | None = None
-    user_token = None
-    user = None
-
-    user_token = validateFirebaseToken(id_token)
-    user = getUser(user_token)
-
-    # Validate user token - check if we have a valid firebase login if not return the template with empty data as we will show the login box
-    if not user_token:
-        context = dict(
-            request=request,
-            user_token=user_token,
-            errors=errors,
-            user_info=user,
-        )
-        return templates.TemplateResponse('main.html', context=context)
+    if not user:
+        return loginPage(request)
     
     form = await request.form()
 
-    tweet_index = len(user.get().get("tweets")) - 1 - int(form['index'])
-    user_tweets = user.get().get('tweets')
+    tweet = await ownTweet(user, form['tweet_id'])
+    await saveTweetChange({}, repository.deleteTweet, tweet)  # unless the tweet changed since it was read
+    publishTimelineChange([user.user_id], 'remove', {'ids': [tweet.id]})
+    await runBlocking(job_queue.enqueue, 'removeFromFollowerTimelines', key=f'removeFromFollowerTimelines:{tweet.id}', user_id=user.user_id, tweet_ids=[tweet.id])
+    await runBlocking(enqueueImageDeletion, tweet.data)  # delete the image associated with this tweet and its renditions, if any
 
-    blob_name = user_tweets[tweet_index].get().get("blob_name")
-    if blob_name:
-        """The tweet has an image associated with it, delete the image too."""
-        deleteFile(blob_name)  # delete the old image associated with this tweet
+    return await ownProfile(request, user)
 
-    user_tweets[tweet_index].delete()
-    del user_tweets[tweet_index]
-    user.update({'tweets': user_tweets})
+@app.get('/api/timeline')
+async def timelineApi(user: CurrentUser = Depends(apiUser), cursor: str | None = Depends(pageCursor)):
+    """Route (GET) returning a page of the signed in user's timeline as JSON, for loading more tweets without a reload."""
+    tweets, next_cursor = await generate_timeline(user, cursor)
+    return JSONResponse({'tweets': [tweetJson(tweet) for tweet in tweets], 'next_cursor': next_cursor})
 
-    context = dict(
-        request=request,
-        user_token=user_token,
-        errors=errors,
-        user_info=user.get(),
-        personal_info=user.get().get("username"),
-        following=len(user.get().get("following")),
-        followers=len(user.get().get("followers")),
-        tweets=user.get().get('tweets'),
-    )
-    return templates.TemplateResponse('view-profile.html', context=context)
\ No newline at end of file
+@app.get('/api/profile/{person}')
+async def profileApi(person, user: CurrentUser = Depends(apiUser), cursor: str | None = Depends(pageCursor)):
+    """Route (GET) returning a page of the tweets posted by a user as JSON, for loading more tweets without a reload.
+
+    Args:
+        person -> str: the username of the user whose tweets to return.
+    """
+    tweets, next_cursor = await runBlocking(repository.tweetsByAuthor, await personId(person), cursor)
+    return JSONResponse({'tweets': [tweetJson(tweet) for tweet in tweets], 'next_cursor': next_cursor})
+
+@app.get('/live/timeline')
+async def liveTimeline(user: CurrentUser = Depends(apiUser)):
+    """Route (GET) streaming the changes of the signed in user's timeline as Server-Sent Events.
+
+    Events are `tweet` for a new tweet, `update` for a changed one and `remove` with the ids of
+    deleted ones, and `resync` when the page fell behind and should fetch the top of its timeline.
+    """
+    try:
+        subscription = live_bus.subscribe(user.user_id)
+    except TooManyConnections as err:
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail=str(err), headers={'Retry-After': str(LIVE_RETRY_MS // 1000)})
+
+    async def stream():
+        try:
+            async for message in subscription.messages():
+                yield message
+        finally:
+            live_bus.unsubscribe(subscription)  # also when the client disconnects and the stream is cancelled
+
+    headers = {'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}  # don't let proxies buffer the events
+    return StreamingResponse(stream(), media_type='text/event-stream', headers=headers)
+
+@app.get('/metrics', response_class=PlainTextResponse)
+async def metrics():
+    """Route (GET) exporting request and backend call metrics in the Prometheus text format."""
+    return PlainTextResponse(renderMetrics(), media_type='text/plain; version=0.0.4')
+
+@app.get('/healthz', response_class=PlainTextResponse)
+async def healthz():
+    """Route (GET) for the liveness probe, answering as long as the worker serves requests."""
+    return PlainTextResponse('ok')
+
+@app.get('/readyz')
+async def readyz():
+    """Route (GET) for the readiness probe, answering 503 until every warm-up step has succeeded."""
+    ready = warm_up.check()
+    return JSONResponse(warm_up.status(), status_code=status.HTTP_200_OK if ready else status.HTTP_503_SERVICE_UNAVAILABLE)
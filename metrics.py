@@ -0,0 +1,314 @@
+"""Request and backend call metrics, exported in the Prometheus text format.
+
+`MetricsMiddleware` times every request and labels it with the route that
+handled it. The Firestore client and the storage backend are wrapped so each
+call they make is timed and its document reads, writes and bytes are counted,
+both in the process-wide metrics and in the stats of the request it was made
+for. Requests slower than SLOW_REQUEST_SECONDS are logged with that per-call
+breakdown.
+
+The request a backend call belongs to is tracked with a context variable, which
+`runBlocking` carries over to the I/O thread pool.
+"""
+import contextvars
+import os
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+SLOW_REQUEST_SECONDS = float(os.environ.get('SLOW_REQUEST_SECONDS', 1.0))  # requests slower than this are logged
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)  # upper bounds in seconds
+
+FIRESTORE_METHODS = (
+    'batch_get_documents', 'batch_write', 'begin_transaction', 'commit', 'list_collection_ids',
+    'list_documents', 'partition_query', 'rollback', 'run_aggregation_query', 'run_query',
+)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _labels(names, values):
+    if not names:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in zip(names, values)) + '}'
+
+
+_registered = []  # every Counter and Histogram, in the order they were created
+
+
+class Counter:
+    """A monotonically increasing count, by label values."""
+
+    def __init__(self, name, help, label_names=()):
+        self.name, self.help, self.label_names = name, help, label_names
+        self._values = defaultdict(float)
+        self._lock = threading.Lock()
+        _registered.append(self)
+
+    def inc(self, labels=(), amount=1):
+        with self._lock:
+            self._values[labels] += amount
+
+    def snapshot(self):
+        """Return the current counts, by label values."""
+        with self._lock:
+            return dict(self._values)
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} counter']
+        with self._lock:
+            for labels, value in sorted(self._values.items()):
+                lines.append(f'{self.name}{_labels(self.label_names, labels)} {value:g}')
+        return lines
+
+
+class Histogram:
+    """A distribution of observed values in cumulative buckets, by label values."""
+
+    def __init__(self, name, help, label_names=(), buckets=LATENCY_BUCKETS):
+        self.name, self.help, self.label_names, self.buckets = name, help, label_names, buckets
+        self._values = {}  # labels -> [bucket counts..., sum, count]
+        self._lock = threading.Lock()
+        _registered.append(self)
+
+    def observe(self, labels, value):
+        with self._lock:
+            values = self._values.setdefault(labels, [0] * len(self.buckets) + [0.0, 0])
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    values[index] += 1
+            values[-2] += value
+            values[-1] += 1
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} histogram']
+        names = self.label_names + ('le',)
+        with self._lock:
+            for labels, values in sorted(self._values.items()):
+                for bound, count in zip(self.buckets, values):
+                    lines.append(f'{self.name}_bucket{_labels(names, labels + (f"{bound:g}",))} {count}')
+                lines.append(f'{self.name}_bucket{_labels(names, labels + ("+Inf",))} {values[-1]}')
+                lines.append(f'{self.name}_sum{_labels(self.label_names, labels)} {values[-2]:g}')
+                lines.append(f'{self.name}_count{_labels(self.label_names, labels)} {values[-1]}')
+        return lines
+
+
+REQUEST_SECONDS = Histogram('app_request_seconds', 'Time taken to handle a request.', ('route', 'method', 'status'))
+BACKEND_CALL_SECONDS = Histogram('app_backend_call_seconds', 'Time taken by a backend call.', ('backend', 'call'))
+BACKEND_READS = Counter('app_backend_reads_total', 'Documents or files read from a backend.', ('route', 'backend'))
+BACKEND_WRITES = Counter('app_backend_writes_total', 'Documents or files written to a backend.', ('route', 'backend'))
+BACKEND_BYTES = Counter('app_backend_bytes_total', 'Bytes sent to or received from a backend.', ('route', 'backend'))
+BACKEND_CALLS = Counter('app_backend_calls_total', 'Calls made to a backend.', ('route', 'backend', 'call'))
+
+_collected = {}  # name -> (help, type, function returning the current value)
+
+
+def registerCollected(name, help, read, kind='gauge'):
+    """Export a value kept elsewhere and read when the metrics are scraped, e.g. the hits of a cache.
+
+    Args:
+        read: returns the current value.
+        kind: the Prometheus type of the value, `gauge` or `counter`.
+    """
+    _collected[name] = (help, kind, read)
+
+
+def renderMetrics():
+    """Return every metric in the Prometheus text exposition format."""
+    lines = []
+    for metric in _registered:  # including those defined by other modules, such as the job queue's
+        lines.extend(metric.render())
+    for name, (help, kind, read) in sorted(_collected.items()):
+        try:
+            value = read()
+        except Exception as err:  # e.g. the job database cannot be opened, which the readiness probe reports
+            print(f"Could not read metric {name}: {err}")
+            continue
+        lines.extend([f'# HELP {name} {help}', f'# TYPE {name} {kind}', f'{name} {value:g}'])
+    return '\n'.join(lines) + '\n'
+
+
+class RequestStats:
+    """The backend calls made while handling one request.
+
+    Args:
+        scope: the ASGI scope of the request, which routing fills in with the endpoint handling it.
+    """
+
+    def __init__(self, scope):
+        self.scope = scope
+        self.calls = defaultdict(lambda: [0, 0.0])  # 'backend.call' -> [count, seconds]
+        self.reads = self.writes = self.bytes = 0
+        self._lock = threading.Lock()  # calls made with gatherBlocking finish on different threads
+
+    @property
+    def route(self):
+        """The name of the endpoint handling the request."""
+        endpoint = self.scope.get('endpoint')
+        if endpoint is None:
+            return 'unmatched'
+        return getattr(endpoint, '__name__', type(endpoint).__name__)
+
+    def record(self, name, seconds, reads, writes, nbytes):
+        with self._lock:
+            self.calls[name][0] += 1
+            self.calls[name][1] += seconds
+            self.reads += reads
+            self.writes += writes
+            self.bytes += nbytes
+
+    def breakdown(self):
+        """Describe the calls, slowest first, for the slow request log."""
+        calls = sorted(self.calls.items(), key=lambda item: item[1][1], reverse=True)
+        return ', '.join(f'{name} x{count} {seconds * 1000:.0f}ms' for name, (count, seconds) in calls)
+
+
+_request_stats = contextvars.ContextVar('request_stats', default=None)
+
+
+def recordCall(backend, call, seconds, reads=0, writes=0, nbytes=0):
+    """Record a backend call in the process-wide metrics and the stats of the current request."""
+    stats = _request_stats.get()
+    route = stats.route if stats is not None else 'background'
+    BACKEND_CALL_SECONDS.observe((backend, call), seconds)
+    BACKEND_CALLS.inc((route, backend, call))
+    if reads:
+        BACKEND_READS.inc((route, backend), reads)
+    if writes:
+        BACKEND_WRITES.inc((route, backend), writes)
+    if nbytes:
+        BACKEND_BYTES.inc((route, backend), nbytes)
+    if stats is not None:
+        stats.record(f'{backend}.{call}', seconds, reads, writes, nbytes)
+
+
+@contextmanager
+def timedCall(backend, call):
+    """Record the block it wraps as a backend call, e.g. verifying a token."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        recordCall(backend, call, time.perf_counter() - start)
+
+
+def _message_size(message):
+    """Return the serialized size of a protobuf or proto-plus message."""
+    if hasattr(message, 'ByteSize'):
+        return message.ByteSize()
+    return type(message).pb(message).ByteSize()
+
+
+def _field(request, name):
+    return request.get(name, []) if isinstance(request, dict) else getattr(request, name, [])
+
+
+def _wrap_firestore_call(call, method):
+    def unary(request=None, **kwargs):
+        start = time.perf_counter()
+        try:
+            return method(request=request, **kwargs)
+        finally:
+            writes = _field(request, 'writes') if call in ('commit', 'batch_write') else []
+            recordCall('firestore', call, time.perf_counter() - start, writes=len(writes), nbytes=sum(map(_message_size, writes)))
+
+    def streaming(request=None, **kwargs):
+        start = time.perf_counter()
+        reads = nbytes = 0
+        try:
+            for response in method(request=request, **kwargs):
+                pb = type(response).pb(response)
+                if (call == 'run_query' and pb.HasField('document')) or (call == 'batch_get_documents' and pb.HasField('found')) or call == 'run_aggregation_query':
+                    reads += 1
+                nbytes += pb.ByteSize()
+                yield response
+        finally:
+            recordCall('firestore', call, time.perf_counter() - start, reads=reads, nbytes=nbytes)
+
+    return streaming if call in ('batch_get_documents', 'run_query', 'run_aggregation_query') else unary
+
+
+def instrumentFirestore(client):
+    """Wrap the calls a Firestore client makes to the Firestore API so they are timed and counted.
+
+    Returns:
+        the client, for chaining.
+    """
+    api = client._firestore_api  # the generated API client every Firestore call goes through
+    for call in FIRESTORE_METHODS:
+        setattr(api, call, _wrap_firestore_call(call, getattr(api, call)))
+    return client
+
+
+class InstrumentedBackend:
+    """Wrap a storage backend so its calls are timed and counted."""
+
+    def __init__(self, backend):
+        self.backend = backend
+
+    def __getattr__(self, name):
+        return getattr(self.backend, name)  # e.g. the root directory of a local backend
+
+    def _timed(self, call, function, *args, writes=0, nbytes=0, **kwargs):
+        start = time.perf_counter()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            recordCall('storage', call, time.perf_counter() - start, writes=writes, nbytes=nbytes)
+
+    def upload(self, name, file_obj, content_type=None, size=None, cache_control=None):
+        return self._timed('upload', self.backend.upload, name, file_obj, content_type=content_type, size=size, cache_control=cache_control, writes=1, nbytes=size or 0)
+
+    def uploadString(self, name, data, content_type):
+        return self._timed('upload', self.backend.uploadString, name, data, content_type, writes=1, nbytes=len(data))
+
+    def download(self, name):
+        start, data = time.perf_counter(), b''
+        try:
+            data = self.backend.download(name)
+            return data
+        finally:
+            recordCall('storage', 'download', time.perf_counter() - start, reads=1, nbytes=len(data))
+
+    def delete(self, name):
+        return self._timed('delete', self.backend.delete, name, writes=1)
+
+    def publicUrl(self, name):
+        return self.backend.publicUrl(name)
+
+
+class MetricsMiddleware:
+    """ASGI middleware timing each request and logging the backend calls of slow ones."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            return await self.app(scope, receive, send)
+
+        stats = RequestStats(scope)
+        token = _request_stats.set(stats)
+        status = 500
+        streaming = False  # event streams stay open by design, so they are never slow
+
+        async def sendWithStatus(message):
+            nonlocal status, streaming
+            if message['type'] == 'http.response.start':
+                status = message['status']
+                streaming = any(name == b'content-type' and value.startswith(b'text/event-stream') for name, value in message.get('headers', []))
+            await send(message)
+
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, sendWithStatus)
+        finally:
+            seconds = time.perf_counter() - start
+            _request_stats.reset(token)
+            REQUEST_SECONDS.observe((stats.route, scope['method'], str(status)), seconds)
+            if seconds >= SLOW_REQUEST_SECONDS and not streaming:
+                print(f"Slow request: {scope['method']} {scope['path']} {status} took {seconds * 1000:.0f}ms, "
+                      f"{stats.reads} reads, {stats.writes} writes, {stats.bytes} bytes: {stats.breakdown()}")
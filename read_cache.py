@@ -0,0 +1,195 @@
+"""An in-process read cache for hot User and Tweet documents.
+
+Profiles, tweets and username lookups are read again and again across
+requests, so `ReadCache` keeps recently read ones in a bounded LRU with a
+time to live. The routes that write those documents invalidate or overwrite
+their entries, so this worker never serves data older than its own writes.
+
+Other workers do not see those invalidations, only the time to live bounds how
+stale their copies get. For tighter coherence across workers the cache can be
+backed by a shared tier (e.g. Redis or Memcached) implementing `CacheTier`.
+It is read on a local miss and invalidated on every write, and the local tier
+then keeps entries for only `local_ttl` seconds.
+
+Cached values are plain dicts and strings. They are shared between requests, so
+callers must not modify them.
+
+The cache is configured with environment variables:
+
+- READ_CACHE_SIZE: the most entries kept by each worker
+- READ_CACHE_TTL: the seconds an entry is kept
+"""
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Protocol
+
+READ_CACHE_SIZE = int(os.environ.get('READ_CACHE_SIZE', 10000))  # most entries kept per worker process
+READ_CACHE_TTL = float(os.environ.get('READ_CACHE_TTL', 60))  # seconds an entry is kept
+SHARED_LOCAL_TTL = 5  # seconds the local tier keeps entries when a shared tier is in use
+
+_MISSING = object()
+
+
+def userKey(user_id):
+    """Return the cache key of the fields of a User document."""
+    return f'user:{user_id}'
+
+
+def tweetKey(tweet_id):
+    """Return the cache key of the card of a tweet."""
+    return f'tweet:{tweet_id}'
+
+
+def usernameKey(username):
+    """Return the cache key of the User document id of a username."""
+    return f'username:{username}'
+
+
+class CacheTier(Protocol):
+    """A store of cache entries shared by every worker."""
+
+    def get(self, key):
+        """Return the value stored under `key`, or None if there is none."""
+
+    def set(self, key, value, ttl):
+        """Store a value under `key` for `ttl` seconds."""
+
+    def delete(self, keys):
+        """Delete the values stored under `keys`."""
+
+
+class LocalTier:
+    """Keep cache entries in this process, evicting the least recently used and expired ones.
+
+    Args:
+        size: the most entries kept.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.evictions = 0
+        self._entries = OrderedDict()  # key -> (expiry, value), least recently used first
+        self._lock = threading.Lock()  # the cache is used from the I/O thread pool
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry[0] <= time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return entry[1]
+
+    def set(self, key, value, ttl):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def delete(self, keys):
+        with self._lock:
+            for key in keys:
+                self._entries.pop(key, None)
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class ReadCache:
+    """A read-through, write-through cache in front of Firestore.
+
+    Args:
+        size: the most entries kept by the local tier.
+        ttl: the seconds an entry is kept.
+        shared: a tier shared by every worker, if any.
+        local_ttl: the seconds the local tier keeps entries, by default `ttl`, or
+            `SHARED_LOCAL_TTL` when there is a shared tier.
+    """
+
+    def __init__(self, size=READ_CACHE_SIZE, ttl=READ_CACHE_TTL, shared: CacheTier | None = None, local_ttl=None):
+        self.local = LocalTier(size)
+        self.shared = shared
+        self.ttl = ttl
+        self.local_ttl = local_ttl if local_ttl is not None else (min(ttl, SHARED_LOCAL_TTL) if shared else ttl)
+        self.hits = 0
+        self.shared_hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def _lookup(self, key):
+        value = self.local.get(key)
+        if value is not None:
+            self.hits += 1
+            return value
+        if self.shared is not None:
+            value = self.shared.get(key)
+            if value is not None:
+                self.shared_hits += 1
+                self.local.set(key, value, self.local_ttl)
+                return value
+        self.misses += 1
+        return _MISSING
+
+    def get(self, key, load):
+        """Return the value cached under `key`, calling `load()` to read it on a miss.
+
+        A `load` returning None means there is nothing to cache, e.g. the document does not exist.
+        """
+        value = self._lookup(key)
+        if value is _MISSING:
+            value = load()
+            if value is not None:
+                self.set(key, value)
+        return value
+
+    def getMany(self, keys, load):
+        """Return the values cached under `keys`, calling `load(missing_keys)` once for all misses.
+
+        Args:
+            load: returns a dict of the values of the keys it was given, leaving out the ones that do not exist.
+        Returns:
+            a dict of the values found, by key.
+        """
+        values, missing = {}, []
+        for key in keys:
+            value = self._lookup(key)
+            if value is _MISSING:
+                missing.append(key)
+            else:
+                values[key] = value
+        if missing:
+            loaded = load(missing)
+            for key, value in loaded.items():
+                self.set(key, value)
+            values.update(loaded)
+        return values
+
+    def set(self, key, value):
+        """Cache a value under `key`, for the write paths to keep the cache in step with what they wrote."""
+        self.local.set(key, value, self.local_ttl)
+        if self.shared is not None:
+            self.shared.set(key, value, self.ttl)
+
+    def invalidate(self, *keys):
+        """Drop the values cached under `keys`, after the documents they were read from have changed."""
+        self.invalidations += len(keys)
+        self.local.delete(keys)
+        if self.shared is not None:
+            self.shared.delete(keys)
+
+    def stats(self):
+        """Return the hit, miss and size counters of the cache."""
+        return {
+            'hits': self.hits,
+            'shared_hits': self.shared_hits,
+            'misses': self.misses,
+            'invalidations': self.invalidations,
+            'evictions': self.local.evictions,
+            'size': len(self.local),
+        }
@@ -0,0 +1,90 @@
+"""Compiling and caching the rendering of templates.
+
+Every template is compiled when the app starts, and the compiled bytecode is
+kept in TEMPLATE_CACHE_DIR (the system temporary directory by default), so
+workers after the first load it instead of parsing the templates again.
+Templates are not checked for changes while the app runs.
+
+Pages shown to signed out visitors do not depend on who asks for them, so
+`AnonymousPageCache` renders each once and gives it an ETag, letting browsers
+revalidate it with a 304 instead of downloading it again.
+
+`PageCompressionMiddleware` gzips the pages and JSON the app renders.
+"""
+import hashlib
+import os
+import threading
+from jinja2 import FileSystemBytecodeCache
+from starlette.middleware.gzip import GZipMiddleware
+
+TEMPLATE_CACHE_DIR = os.environ.get('TEMPLATE_CACHE_DIR') or None  # where compiled templates are kept between runs
+ANONYMOUS_PAGES_MAX = 64  # most pages kept, bounding the cache however many host names the app is reached by
+PAGE_COMPRESSION_LEVEL = 6  # pages are compressed on every request, so trade a little size for much less CPU than level 9
+UNCOMPRESSED_PREFIXES = ('/live/', '/static/', '/media/')  # paths of responses left for PageCompressionMiddleware to pass through
+
+
+def templateOptions():
+    """Return the options of the Jinja environment of the app's templates."""
+    return {
+        'auto_reload': False,  # templates are not edited while the app runs, so skip checking them on each render
+    }
+
+
+def precompileTemplates(env):
+    """Compile every template of a Jinja environment into its template cache, backed by TEMPLATE_CACHE_DIR.
+
+    Returns:
+        the number of templates compiled.
+    """
+    if TEMPLATE_CACHE_DIR:
+        os.makedirs(TEMPLATE_CACHE_DIR, exist_ok=True)
+    env.bytecode_cache = FileSystemBytecodeCache(TEMPLATE_CACHE_DIR)  # set once its directory exists, templates compile without it until then
+    names = env.list_templates()
+    for name in names:
+        env.get_template(name)
+    return len(names)
+
+
+class AnonymousPageCache:
+    """Render pages that are the same for every signed out visitor once, with an ETag.
+
+    Args:
+        templates: the Jinja2Templates of the app.
+    """
+
+    def __init__(self, templates):
+        self.templates = templates
+        self._pages = {}  # (template name, base url) -> (body, etag)
+        self._lock = threading.Lock()
+
+    def render(self, request, name, **context):
+        """Return the rendered page and its ETag.
+
+        The page's URLs are built from the request's base URL, so a page is kept for each one.
+        """
+        key = (name, str(request.base_url))
+        page = self._pages.get(key)
+        if page is None:
+            body = self.templates.get_template(name).render(request=request, **context).encode('utf-8')
+            page = (body, f'"{hashlib.sha256(body).hexdigest()[:32]}"')
+            with self._lock:
+                if len(self._pages) >= ANONYMOUS_PAGES_MAX:
+                    self._pages.clear()
+                self._pages[key] = page
+        return page
+
+
+class PageCompressionMiddleware(GZipMiddleware):
+    """Gzip responses for browsers that accept it, except those under `UNCOMPRESSED_PREFIXES`.
+
+    Event streams would be held back until the compressor filled a block, static assets are
+    served precompressed (see `assets.py`) and images do not compress.
+    """
+
+    def __init__(self, app, minimum_size=500, compresslevel=PAGE_COMPRESSION_LEVEL):
+        super().__init__(app, minimum_size=minimum_size, compresslevel=compresslevel)
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'http' and scope['path'].startswith(UNCOMPRESSED_PREFIXES):
+            return await self.app(scope, receive, send)
+        await super().__call__(scope, receive, send)
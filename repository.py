@@ -0,0 +1,287 @@
+"""The data the app keeps about users, follows and tweets, behind one interface.
+
+Routes and background jobs read and write through a `Repository` instead of
+calling Firestore themselves, so the app can run on either of two backends:
+
+- `FirestoreRepository` keeps the data in Firestore, composing the modules
+  that own each part of it (`users.py`, `follows.py`, `cards.py`,
+  `search_index.py`, `timeline.py`) and committing each change to a tweet in
+  one `UnitOfWork`. It reads users and tweets through the read cache.
+- `SqliteRepository` (see `sqlite_repository.py`) keeps it in a SQLite
+  database on local disk, for single node deployments and CI, where every
+  read is a local query instead of a network round trip.
+
+Images are kept by the storage service either way (see `storage_service.py`);
+only the URLs and blob names of a tweet's image and renditions are part of its
+data here. With the SQLite backend the storage service defaults to the local
+directory backend.
+
+Changes that follow a tweet to its author's followers are made by background
+jobs calling `pushToFollowerTimelines`, `refreshCardInTimelines` and
+`removeFromFollowerTimelines`, which report the users whose timelines changed
+to `notify`, whether or not the backend stores timelines.
+
+`python -m benchmarks.repositories` checks that a backend behaves as this
+interface describes, and times its operations.
+
+The backend is chosen with environment variables:
+
+- DATA_BACKEND: `firestore` (the default) or `sqlite`
+- SQLITE_DB_PATH: the database file of the SQLite backend
+"""
+import os
+from dataclasses import dataclass
+from typing import Any, Callable, Mapping, Protocol
+from google.api_core.exceptions import FailedPrecondition, NotFound
+from google.cloud import firestore
+from cards import cardRef, tweetCard
+from follows import addFollow, isFollowing, removeFollow
+from images import recordRenditions
+from lifecycle import Lazy, pingFirestore
+from metrics import instrumentFirestore
+from read_cache import tweetKey, userKey, usernameKey
+from search_index import indexTweet, searchTweets, searchUsernames, unindexTweet
+from timeline import (addAuthorToTimeline, pushToFollowerTimelines, pushToTimelines, readTimeline, refreshCardInTimelines,
+                      removeAuthorFromTimeline, removeFromFollowerTimelines, removeFromTimelines, replaceInTimelines, timelinePage)
+from tweets import tweetsByAuthor
+from unit_of_work import UnitOfWork
+from users import CurrentUser, claimUsername, loadUser, userData, userIdForUsername
+from views import UserCard
+
+DATA_BACKEND = os.environ.get('DATA_BACKEND', 'firestore')
+SQLITE_DB_PATH = os.environ.get('SQLITE_DB_PATH', 'data.sqlite3')
+
+Notify = Callable[[list, str, dict], Any]  # called with the ids of the users whose timelines changed, the event and its data
+
+
+class TweetChanged(Exception):
+    """The tweet was changed or deleted since it was read, so the change was not made."""
+
+
+@dataclass(frozen=True)
+class StoredTweet:
+    """A tweet as read from the repository, to be shown or changed."""
+    id: str
+    data: Mapping  # the fields of the tweet
+    version: Any  # what the backend compares to tell whether the tweet changed since it was read
+
+    @property
+    def record(self):
+        """The tweet as a plain record: its fields, plus its id under `id`."""
+        return {**self.data, 'id': self.id}
+
+
+class Repository(Protocol):
+    """The reads and writes of users, follows and tweets the app makes.
+
+    Pages of tweets are lists of tweet cards (see `cards.py`), newest first, with the
+    cursor of the next page or None if it is the last.
+    """
+
+    def loadUser(self, user_token) -> CurrentUser:
+        """Load the signed in user from the claims of their ID token, creating them on first login."""
+
+    def userData(self, user_id) -> dict | None:
+        """Return the fields of a user, or None if there is no such user."""
+
+    def userIdForUsername(self, username) -> str | None:
+        """Return the id of the user with a username, or None if nobody has it."""
+
+    def claimUsername(self, user_id, username):
+        """Give a user a username, raising `users.UsernameRejected` if it is invalid or taken or they have one."""
+
+    def searchUsernames(self, prefix, cursor=None) -> tuple[list[UserCard], str | None]:
+        """Return a page of the users whose username starts with `prefix` ignoring case, in username order."""
+
+    def addFollow(self, follower_id, follower_username, followed_id, followed_username) -> bool:
+        """Make one user follow another and merge their tweets into the follower's timeline.
+
+        Returns False if the user already followed the other, and raises ValueError if they are the same user.
+        """
+
+    def removeFollow(self, follower_id, followed_id, followed_username) -> bool:
+        """Make one user stop following another and drop their tweets from the timeline, False if they did not follow them."""
+
+    def isFollowing(self, follower_id, followed_id) -> bool:
+        """Return whether one user follows another."""
+
+    def getTweet(self, tweet_id) -> StoredTweet | None:
+        """Return a tweet, or None if it does not exist."""
+
+    def addTweet(self, tweet_data) -> dict:
+        """Save a new tweet, index it for search and put it on its author's timeline, returning its card."""
+
+    def editTweet(self, tweet: StoredTweet, changes) -> dict:
+        """Change fields of a tweet everywhere it is shown to its author, returning its new card.
+
+        Raises:
+            TweetChanged: if the tweet was changed or deleted since it was read.
+        """
+
+    def deleteTweet(self, tweet: StoredTweet):
+        """Delete a tweet, its search entry and its entry on its author's timeline.
+
+        Raises:
+            TweetChanged: if the tweet was changed or deleted since it was read.
+        """
+
+    def recordRenditions(self, tweet_id, blob_name, rendition_fields) -> bool:
+        """Record the renditions of a tweet's image, unless the image was replaced or the tweet deleted meanwhile."""
+
+    def tweetsByAuthor(self, author_id, cursor=None) -> tuple[list[dict], str | None]:
+        """Return a page of the tweets posted by a user."""
+
+    def searchTweets(self, query, page=1) -> tuple[list[dict], bool]:
+        """Return a 1-based page of the tweets whose words start with every word of `query`, and whether there is a next page."""
+
+    def timeline(self, user_id, username, cursor=None) -> tuple[list[dict], str | None]:
+        """Return a page of the home timeline of a user, their tweets and those of the users they follow."""
+
+    def pushToFollowerTimelines(self, user_id, tweet_id, notify: Notify | None = None):
+        """Add a new tweet to the timelines of its author's followers, notifying `tweet` with its card."""
+
+    def refreshCardInTimelines(self, user_id, tweet_id, notify: Notify | None = None):
+        """Show the current card of a tweet in the timelines of its author and their followers, notifying `update`."""
+
+    def removeFromFollowerTimelines(self, user_id, tweet_ids, notify: Notify | None = None):
+        """Drop deleted tweets from the timelines of their author's followers, notifying `remove` with their ids."""
+
+    def ping(self):
+        """Make a round trip to the backend, opening its connection."""
+
+
+class FirestoreRepository:
+    """Keep the data in Firestore, with users and tweets read through the read cache.
+
+    Args:
+        db: the Firestore client, or a `Lazy` creating it.
+        cache: the read cache, invalidated here whenever a cached user or tweet is written.
+    """
+
+    def __init__(self, db, cache):
+        self.db = db
+        self.cache = cache
+
+    def _tweet_ref(self, tweet_id):
+        return self.db.collection('Tweet').document(tweet_id)
+
+    def loadUser(self, user_token):
+        return loadUser(self.db, self.cache, user_token)
+
+    def userData(self, user_id):
+        return userData(self.db, self.cache, user_id)
+
+    def userIdForUsername(self, username):
+        return userIdForUsername(self.db, self.cache, username)
+
+    def claimUsername(self, user_id, username):
+        claimUsername(self.db, user_id, username)  # reserves the username and sets it on the user in one transaction
+        self.cache.invalidate(userKey(user_id), usernameKey(username))
+
+    def searchUsernames(self, prefix, cursor=None):
+        users, next_cursor = searchUsernames(self.db, prefix, cursor)
+        return [UserCard.fromSnapshot(user) for user in users], next_cursor
+
+    def addFollow(self, follower_id, follower_username, followed_id, followed_username):
+        if not addFollow(self.db, follower_id, follower_username, followed_id, followed_username):  # both edges and counters in one transaction
+            return False
+        self.cache.invalidate(userKey(follower_id), userKey(followed_id))  # both follow counters changed
+        addAuthorToTimeline(self.db, follower_id, followed_username)
+        return True
+
+    def removeFollow(self, follower_id, followed_id, followed_username):
+        if not removeFollow(self.db, follower_id, followed_id):
+            return False
+        self.cache.invalidate(userKey(follower_id), userKey(followed_id))
+        removeAuthorFromTimeline(self.db, follower_id, followed_username)
+        return True
+
+    def isFollowing(self, follower_id, followed_id):
+        return isFollowing(self.db, follower_id, followed_id)
+
+    def getTweet(self, tweet_id):
+        tweet = self._tweet_ref(tweet_id).get()
+        if not tweet.exists:
+            return None
+        return StoredTweet(id=tweet.id, data=tweet.to_dict(), version=tweet.update_time)
+
+    def _commit(self, unit_of_work):
+        try:
+            unit_of_work.commit()
+        except (FailedPrecondition, NotFound) as err:
+            raise TweetChanged(str(err)) from err
+
+    def addTweet(self, tweet_data):
+        # write the tweet, its card, its index entry and the author's timeline in one commit
+        tweet_ref = self.db.collection('Tweet').document()
+        card = tweetCard(tweet_ref.id, tweet_data)
+        unit_of_work = UnitOfWork(self.db)
+        unit_of_work.set(tweet_ref, tweet_data)
+        unit_of_work.set(cardRef(self.db, tweet_ref.id), card)
+        indexTweet(self.db, tweet_ref, tweet_data['body'], tweet_data['date'], unit_of_work)
+        pushToTimelines(self.db, [tweet_data['author_id']], [card], unit_of_work)  # the author sees the tweet on their timeline straight away
+        self._commit(unit_of_work)
+        return card
+
+    def editTweet(self, tweet, changes):
+        # update the tweet, its card, its index entry and the author's timeline in one commit, unless the tweet changed since it was read
+        tweet_ref = self._tweet_ref(tweet.id)
+        card = tweetCard(tweet.id, {**tweet.data, **changes})
+        unit_of_work = UnitOfWork(self.db)
+        unit_of_work.update(tweet_ref, changes, option=self.db.write_option(last_update_time=tweet.version))
+        unit_of_work.set(cardRef(self.db, tweet.id), card)
+        indexTweet(self.db, tweet_ref, card['body'], tweet.data['date'], unit_of_work)
+        replaceInTimelines(self.db, [tweet.data['author_id']], card, unit_of_work)
+        unit_of_work.afterCommit(self.cache.invalidate, tweetKey(tweet.id))
+        self._commit(unit_of_work)
+        return card
+
+    def deleteTweet(self, tweet):
+        # delete the tweet, its card, its index entry and its entry on the author's timeline in one commit, unless the tweet changed since it was read
+        unit_of_work = UnitOfWork(self.db)
+        unit_of_work.delete(self._tweet_ref(tweet.id), option=self.db.write_option(last_update_time=tweet.version))
+        unit_of_work.delete(cardRef(self.db, tweet.id))
+        unindexTweet(self.db, tweet.id, unit_of_work)
+        removeFromTimelines(self.db, [tweet.data['author_id']], [tweet.id], unit_of_work)
+        unit_of_work.afterCommit(self.cache.invalidate, tweetKey(tweet.id))
+        self._commit(unit_of_work)
+
+    def recordRenditions(self, tweet_id, blob_name, rendition_fields):
+        saved = recordRenditions(self.db, tweet_id, blob_name, rendition_fields)
+        if saved:
+            self.cache.invalidate(tweetKey(tweet_id))  # the renditions are recorded on the tweet's card
+        return saved
+
+    def tweetsByAuthor(self, author_id, cursor=None):
+        return tweetsByAuthor(self.db, author_id, cursor)
+
+    def searchTweets(self, query, page=1):
+        return searchTweets(self.db, query, page, self.cache)  # the cards of popular results are read through the cache
+
+    def timeline(self, user_id, username, cursor=None):
+        # the timeline is precomputed on write and holds the cards of its tweets, so this is a single read
+        return timelinePage(readTimeline(self.db, user_id, username), cursor)
+
+    def pushToFollowerTimelines(self, user_id, tweet_id, notify=None):
+        pushToFollowerTimelines(self.db, user_id, tweet_id, notify)
+
+    def refreshCardInTimelines(self, user_id, tweet_id, notify=None):
+        refreshCardInTimelines(self.db, user_id, tweet_id, notify)
+
+    def removeFromFollowerTimelines(self, user_id, tweet_ids, notify=None):
+        removeFromFollowerTimelines(self.db, user_id, tweet_ids, notify)
+
+    def ping(self):
+        pingFirestore(self.db)
+
+
+def createRepository(cache):
+    """Create the repository configured by the DATA_BACKEND and SQLITE_DB_PATH environment variables.
+
+    Args:
+        cache: the read cache of the Firestore backend.
+    """
+    if DATA_BACKEND == 'sqlite':
+        from sqlite_repository import SqliteRepository
+        return SqliteRepository(SQLITE_DB_PATH)
+    return FirestoreRepository(Lazy(lambda: instrumentFirestore(firestore.Client())), cache)  # timing and counting its calls, created on first use
@@ -0,0 +1,227 @@
+"""Indexes for searching the content of tweets and usernames.
+
+Every tweet has a ``TweetIndex/{tweet_id}`` document listing the case-folded
+tokens of its body and every prefix of those tokens. Searching is then an
+``array_contains`` query against Firestore's index of the ``terms`` field,
+newest first through the composite index on ``(terms, date)`` listed in
+``firestore.indexes.json``, instead of a scan over the whole ``Tweet`` collection.
+
+Every user with a username has a case-folded copy of it in ``username_lower``,
+so a username prefix is a bounded range scan over that field.
+
+Run this module directly to rebuild both indexes from the existing data::
+
+    python search_index.py
+"""
+import re
+from google.cloud import firestore
+from google.cloud.firestore_v1.base_query import FieldFilter
+from tweets import hydrateTweets
+
+MAX_PREFIX_LENGTH = 20  # longest token prefix stored in the index
+CANDIDATE_LIMIT = 500  # most recent postings considered when ranking a search
+PAGE_SIZE = 20  # number of results shown per page
+PREFIX_END = '\uf8ff'  # sorts after every other character, so `prefix + PREFIX_END` bounds a prefix range
+
+TOKEN_PATTERN = re.compile(r'\w+')
+
+
+def tokenize(text):
+    """Split text into its unique case-folded tokens, in order of appearance."""
+    return list(dict.fromkeys(TOKEN_PATTERN.findall(text.casefold())))
+
+
+def indexTerms(tokens):
+    """Return every prefix of the given tokens, up to `MAX_PREFIX_LENGTH` characters."""
+    terms = set()
+    for token in tokens:
+        for length in range(1, min(len(token), MAX_PREFIX_LENGTH) + 1):
+            terms.add(token[:length])
+    return sorted(terms)
+
+
+def _index_data(tweet_ref, body, date):
+    """Build the index document for a tweet."""
+    tokens = tokenize(body)
+    return {
+        'tweet': tweet_ref,  # reference to the indexed Tweet document
+        'tokens': tokens,  # the full tokens of the tweet body, used to confirm and rank matches
+        'terms': indexTerms(tokens),  # the postings keys this tweet is listed under
+        'date': date,  # the post date, used to order postings
+    }
+
+
+def indexTweet(db, tweet_ref, body, date, unit_of_work=None):
+    """Add or replace the index entry of a tweet.
+
+    Args:
+        tweet_ref: the DocumentReference of the tweet.
+        body: the text of the tweet.
+        date: the date the tweet was posted.
+        unit_of_work: the UnitOfWork to stage the write on, instead of writing it straight away.
+    """
+    index_ref = db.collection('TweetIndex').document(tweet_ref.id)
+    if unit_of_work is None:
+        index_ref.set(_index_data(tweet_ref, body, date))
+    else:
+        unit_of_work.set(index_ref, _index_data(tweet_ref, body, date))
+
+
+def unindexTweet(db, tweet_id, unit_of_work=None):
+    """Remove the index entry of a deleted tweet, or stage its removal on `unit_of_work`."""
+    index_ref = db.collection('TweetIndex').document(tweet_id)
+    if unit_of_work is None:
+        index_ref.delete()
+    else:
+        unit_of_work.delete(index_ref)
+
+
+def _score(query_tokens, tokens):
+    """Rank a candidate, or return None if it does not match every query token.
+
+    Each query token must be a prefix of one of the tweet's tokens. Whole-word matches
+    score higher than prefix-only matches.
+    """
+    score = 0
+    for query_token in query_tokens:
+        if query_token in tokens:
+            score += 2
+        elif any(token.startswith(query_token) for token in tokens):
+            score += 1
+        else:
+            return None
+    return score
+
+
+def searchTweets(db, query, page=1, cache=None):
+    """Search the tweets whose words start with every word of `query`.
+
+    Args:
+        query: the text typed by the user.
+        page: the 1-based page of results to return.
+        cache: the read cache to take the cards of the results from, if any.
+    Returns:
+        a tuple of the tweet records on the page, best match first, and whether there is a next page.
+    """
+    query_tokens = tokenize(query)
+    if not query_tokens:
+        return [], False
+
+    # look up the postings of the longest (most selective) query token
+    lookup_term = max(query_tokens, key=len)[:MAX_PREFIX_LENGTH]
+    postings = (
+        db.collection('TweetIndex')
+        .where(filter=FieldFilter('terms', 'array_contains', lookup_term))
+        .order_by('date', direction=firestore.Query.DESCENDING)
+        .limit(CANDIDATE_LIMIT)
+        .get()
+    )
+
+    ranked = []
+    for position, posting in enumerate(postings):
+        score = _score(query_tokens, posting.get('tokens'))
+        if score is not None:
+            ranked.append((-score, position, posting.get('tweet')))  # postings arrive newest first, so position breaks ties by date
+    ranked.sort()
+
+    start = (page - 1) * PAGE_SIZE
+    page_refs = [tweet_ref for *_, tweet_ref in ranked[start:start + PAGE_SIZE]]
+    return hydrateTweets(db, page_refs, cache), len(ranked) > start + PAGE_SIZE
+
+
+def normalizeUsername(username):
+    """Return the case-folded form of a username stored in `username_lower`."""
+    return username.strip().casefold()
+
+
+def encodeUsernameCursor(username_lower, user_id):
+    """Return the cursor of the page of username search results that follows the given user."""
+    return f"{username_lower}/{user_id}"
+
+
+def decodeUsernameCursor(cursor):
+    """Split a username search cursor into the case-folded username and id of the user it follows.
+
+    Raises:
+        ValueError: if the cursor is malformed.
+    """
+    username_lower, separator, user_id = cursor.rpartition('/')
+    if not separator or not username_lower or not user_id:
+        raise ValueError(f"Malformed username cursor {cursor}")
+    return username_lower, user_id
+
+
+def searchUsernames(db, prefix, cursor=None):
+    """Search the users whose username starts with `prefix`, ignoring case.
+
+    Args:
+        prefix: the text typed by the user.
+        cursor: the cursor returned with the previous page, if any.
+    Returns:
+        a tuple of the user snapshots on the page, in username order, and the cursor of the next page or None.
+    """
+    prefix = normalizeUsername(prefix)
+    if not prefix:
+        return [], None
+
+    users_query = (
+        db.collection('User')
+        .where(filter=FieldFilter('username_lower', '>=', prefix))
+        .where(filter=FieldFilter('username_lower', '<', prefix + PREFIX_END))
+        .order_by('username_lower')
+        .order_by('__name__')  # usernames may differ only by case, the document id keeps the order total
+        .limit(PAGE_SIZE + 1)
+    )
+    if cursor:
+        username_lower, user_id = decodeUsernameCursor(cursor)
+        users_query = users_query.start_after({'username_lower': username_lower, '__name__': user_id})
+
+    users = users_query.get()
+    if len(users) <= PAGE_SIZE:
+        return users, None
+    last = users[PAGE_SIZE - 1]
+    return users[:PAGE_SIZE], encodeUsernameCursor(last.get('username_lower'), last.id)
+
+
+def rebuildUsernameIndex(db):
+    """Set `username_lower` on every user who has chosen a username.
+
+    Returns:
+        the number of users indexed.
+    """
+    writer = db.bulk_writer()  # batches the writes and retries the ones that fail
+    indexed = 0
+    for user in db.collection('User').stream():
+        username = user.get('username')
+        if username:
+            writer.update(user.reference, {'username_lower': normalizeUsername(username)})
+            indexed += 1
+    writer.close()
+    return indexed
+
+
+def rebuildIndex(db):
+    """Rebuild the index from every tweet in the database, removing entries of deleted tweets.
+
+    Returns:
+        the number of tweets indexed.
+    """
+    writer = db.bulk_writer()
+    tweet_ids = set()
+
+    for tweet in db.collection('Tweet').stream():
+        tweet_ids.add(tweet.id)
+        writer.set(db.collection('TweetIndex').document(tweet.id), _index_data(tweet.reference, tweet.get('body'), tweet.get('date')))
+
+    for posting in db.collection('TweetIndex').stream():
+        if posting.id not in tweet_ids:
+            writer.delete(posting.reference)
+
+    writer.close()
+    return len(tweet_ids)
+
+
+if __name__ == '__main__':
+    client = firestore.Client()
+    print(f"Indexed {rebuildIndex(client)} tweets.")
+    print(f"Indexed {rebuildUsernameIndex(client)} usernames.")
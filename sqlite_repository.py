@@ -0,0 +1,377 @@
+"""Keeping the app's data in an embedded SQLite database, for single node deployments and CI.
+
+`SqliteRepository` implements the `Repository` interface (see `repository.py`)
+over one local database file. Every read is an indexed query on local disk,
+with no network round trip, so there is no read cache in front of it.
+
+- ``users`` has a unique index on ``username``, which reserves usernames, and
+  an index on ``(username_lower, id)`` for username prefix searches.
+- ``follows`` is keyed by ``(follower_id, followed_id)``, with an index on
+  ``(followed_id, follower_id)`` for finding a user's followers.
+- ``tweets`` has an index on ``(author_id, date, id)``, read by profiles and
+  timelines newest first with the same keyset cursors as Firestore.
+- ``tweets_fts`` is an FTS5 index of tweet bodies, kept in step with
+  ``tweets`` by triggers, so a tweet search is a prefix match of every word of
+  the query, ranked by bm25 and then date.
+
+Home timelines are not stored. A page is read straight from the tweets of the
+user and the people they follow (fan-out on read), which is cheap when the
+whole follow graph is local, so the follower fan-out jobs write nothing and
+only notify the followers' open pages.
+
+Dates are stored as integer microseconds since the epoch, in UTC. Statements
+run one at a time on a shared connection, as in `jobs.py`.
+"""
+import functools
+import json
+import sqlite3
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
+from types import MappingProxyType
+from cards import tweetCard
+from jobs import openSqlite
+from lifecycle import Lazy
+from metrics import recordCall
+from repository import StoredTweet, TweetChanged
+from search_index import PAGE_SIZE as SEARCH_PAGE_SIZE, PREFIX_END, decodeUsernameCursor, encodeUsernameCursor, normalizeUsername, tokenize
+from tweets import PAGE_SIZE, decodeCursor, encodeCursor
+from users import CurrentUser, UsernameRejected, checkUsername
+from views import UserCard
+
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+TWEET_FIELDS = ('author_id', 'username', 'body', 'date', 'image_url', 'blob_name', 'thumbnail_url', 'display_url', 'rendition_blob_names')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+    id TEXT PRIMARY KEY,  -- the Firebase uid
+    username TEXT UNIQUE,  -- null until the user has chosen a username
+    username_lower TEXT,  -- case-folded username, for prefix searches
+    following_count INTEGER NOT NULL DEFAULT 0,
+    followers_count INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS users_username_lower ON users (username_lower, id);
+
+CREATE TABLE IF NOT EXISTS follows (
+    follower_id TEXT NOT NULL,
+    followed_id TEXT NOT NULL,
+    date INTEGER NOT NULL,
+    PRIMARY KEY (follower_id, followed_id)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS follows_followed ON follows (followed_id, follower_id);
+
+CREATE TABLE IF NOT EXISTS tweets (
+    seq INTEGER PRIMARY KEY,  -- the rowid of the tweet in the full text index
+    id TEXT NOT NULL UNIQUE,
+    author_id TEXT NOT NULL,
+    username TEXT NOT NULL,  -- the author's username when the tweet was posted
+    body TEXT NOT NULL,
+    date INTEGER NOT NULL,  -- microseconds since the epoch, UTC
+    image_url TEXT NOT NULL DEFAULT '',
+    blob_name TEXT NOT NULL DEFAULT '',
+    thumbnail_url TEXT NOT NULL DEFAULT '',
+    display_url TEXT NOT NULL DEFAULT '',
+    rendition_blob_names TEXT NOT NULL DEFAULT '[]',  -- JSON list
+    version INTEGER NOT NULL DEFAULT 1  -- bumped by every change, to refuse changes based on an older read
+);
+CREATE INDEX IF NOT EXISTS tweets_author ON tweets (author_id, date, id);
+
+CREATE VIRTUAL TABLE IF NOT EXISTS tweets_fts USING fts5(
+    body,
+    content='tweets',
+    content_rowid='seq',
+    tokenize="unicode61 remove_diacritics 0 tokenchars '_'",  -- the same words as `search_index.tokenize`
+    prefix='1 2 3'  -- index short prefixes, which match the most tweets
+);
+CREATE TRIGGER IF NOT EXISTS tweets_fts_insert AFTER INSERT ON tweets BEGIN
+    INSERT INTO tweets_fts (rowid, body) VALUES (new.seq, new.body);
+END;
+CREATE TRIGGER IF NOT EXISTS tweets_fts_delete AFTER DELETE ON tweets BEGIN
+    INSERT INTO tweets_fts (tweets_fts, rowid, body) VALUES ('delete', old.seq, old.body);
+END;
+CREATE TRIGGER IF NOT EXISTS tweets_fts_update AFTER UPDATE OF body ON tweets BEGIN
+    INSERT INTO tweets_fts (tweets_fts, rowid, body) VALUES ('delete', old.seq, old.body);
+    INSERT INTO tweets_fts (rowid, body) VALUES (new.seq, new.body);
+END;
+"""
+
+
+def _micros(date):
+    """Convert a datetime to microseconds since the epoch, taking naive datetimes as UTC like Firestore does."""
+    if date.tzinfo is None:
+        date = date.replace(tzinfo=timezone.utc)
+    return (date - EPOCH) // timedelta(microseconds=1)
+
+
+def _datetime(micros):
+    return EPOCH + timedelta(microseconds=micros)
+
+
+def _columns(fields):
+    """Convert tweet fields to the values of their columns."""
+    unknown = set(fields) - set(TWEET_FIELDS)
+    if unknown:
+        raise ValueError(f"Unknown tweet fields {', '.join(sorted(unknown))}")
+    columns = dict(fields)
+    if 'date' in columns:
+        columns['date'] = _micros(columns['date'])
+    if 'rendition_blob_names' in columns:
+        columns['rendition_blob_names'] = json.dumps(columns['rendition_blob_names'])
+    return columns
+
+
+def _tweet_data(row):
+    """Convert a row of `tweets` to the fields of the tweet."""
+    data = {field: row[field] for field in TWEET_FIELDS}
+    data['date'] = _datetime(row['date'])
+    data['rendition_blob_names'] = json.loads(row['rendition_blob_names'])
+    return data
+
+
+def _card(row):
+    return tweetCard(row['id'], _tweet_data(row))
+
+
+def _after(cursor):
+    """Return the condition and parameters selecting the tweets that come after a cursor, newest first."""
+    if not cursor:
+        return '', ()
+    date, tweet_id = decodeCursor(cursor)
+    return 'AND (date, id) < (?, ?)', (_micros(date), tweet_id)
+
+
+def _page(rows):
+    """Split the rows of a query for one more than a page into the cards on the page and the next cursor."""
+    cards = [_card(row) for row in rows]
+    if len(cards) <= PAGE_SIZE:
+        return cards, None
+    last = cards[PAGE_SIZE - 1]
+    return cards[:PAGE_SIZE], encodeCursor(last['date'], last['id'])
+
+
+def _connect(path):
+    db = openSqlite(path, SCHEMA)
+    db.row_factory = sqlite3.Row
+    db.execute('PRAGMA synchronous=NORMAL')  # in WAL mode a crash can only lose the last commits, not corrupt the database
+    return db
+
+
+class SqliteRepository:
+    """Keep the data in a SQLite database.
+
+    Args:
+        path: the database file, created with its tables on first use if it does not exist.
+    """
+
+    def __init__(self, path):
+        self._db = Lazy(functools.partial(_connect, path))  # opened on first use, e.g. by `ping` when the app warms up
+        self._lock = threading.Lock()
+
+    def _execute(self, call, sql, parameters=(), write=False):
+        """Run one statement and return its rows, recording it as a backend call."""
+        start = time.perf_counter()
+        with self._lock:
+            rows = self._db.execute(sql, parameters).fetchall()
+        recordCall('sqlite', call, time.perf_counter() - start, **{'writes' if write else 'reads': len(rows)})
+        return rows
+
+    @contextmanager
+    def _transaction(self, call):
+        """Run the statements of the block in one transaction, holding the write lock from the start."""
+        start = time.perf_counter()
+        with self._lock:
+            self._db.execute('BEGIN IMMEDIATE')
+            try:
+                yield self._db
+            except BaseException:
+                self._db.execute('ROLLBACK')
+                raise
+            else:
+                self._db.execute('COMMIT')
+            finally:
+                recordCall('sqlite', call, time.perf_counter() - start, writes=1)
+
+    def loadUser(self, user_token):
+        rows = self._execute('get_user', 'SELECT * FROM users WHERE id = ?', (user_token['user_id'],))
+        if not rows:
+            self._execute('create_user', 'INSERT OR IGNORE INTO users (id) VALUES (?)', (user_token['user_id'],), write=True)
+            rows = self._execute('get_user', 'SELECT * FROM users WHERE id = ?', (user_token['user_id'],))
+        user = rows[0]
+        return CurrentUser(
+            user_id=user['id'],
+            token=MappingProxyType(dict(user_token)),
+            username=user['username'] or '',
+            following_count=user['following_count'],
+            followers_count=user['followers_count'],
+        )
+
+    def userData(self, user_id):
+        rows = self._execute('get_user', 'SELECT username, following_count, followers_count FROM users WHERE id = ?', (user_id,))
+        if not rows:
+            return None
+        return {'username': rows[0]['username'] or '', 'following_count': rows[0]['following_count'], 'followers_count': rows[0]['followers_count']}
+
+    def userIdForUsername(self, username):
+        rows = self._execute('find_username', 'SELECT id FROM users WHERE username = ?', (username,))
+        return rows[0]['id'] if rows else None
+
+    def claimUsername(self, user_id, username):
+        checkUsername(username)
+        with self._transaction('claim_username') as db:
+            holder = db.execute('SELECT id FROM users WHERE username = ?', (username,)).fetchone()
+            if holder is not None and holder['id'] != user_id:
+                raise UsernameRejected("This username is already taken.")
+            user = db.execute('SELECT username FROM users WHERE id = ?', (user_id,)).fetchone()
+            if user is not None and user['username'] not in (None, username):
+                raise UsernameRejected("You have already chosen a username.")
+            db.execute(
+                """INSERT INTO users (id, username, username_lower) VALUES (?, ?, ?)
+                   ON CONFLICT (id) DO UPDATE SET username = excluded.username, username_lower = excluded.username_lower""",
+                (user_id, username, normalizeUsername(username)),
+            )
+
+    def searchUsernames(self, prefix, cursor=None):
+        prefix = normalizeUsername(prefix)
+        if not prefix:
+            return [], None
+        after, parameters = '', ()
+        if cursor:
+            after, parameters = 'AND (username_lower, id) > (?, ?)', decodeUsernameCursor(cursor)
+        rows = self._execute('search_usernames', f"""
+            SELECT id, username, username_lower FROM users
+            WHERE username_lower >= ? AND username_lower < ? {after}
+            ORDER BY username_lower, id LIMIT ?""",
+            (prefix, prefix + PREFIX_END, *parameters, SEARCH_PAGE_SIZE + 1),
+        )
+        users = [UserCard(user_id=row['id'], username=row['username']) for row in rows[:SEARCH_PAGE_SIZE]]
+        if len(rows) <= SEARCH_PAGE_SIZE:
+            return users, None
+        last = rows[SEARCH_PAGE_SIZE - 1]
+        return users, encodeUsernameCursor(last['username_lower'], last['id'])
+
+    def addFollow(self, follower_id, follower_username, followed_id, followed_username):
+        if follower_id == followed_id:
+            raise ValueError("Users cannot follow themselves")
+        with self._transaction('add_follow') as db:
+            added = db.execute(
+                'INSERT OR IGNORE INTO follows (follower_id, followed_id, date) VALUES (?, ?, ?)',
+                (follower_id, followed_id, _micros(datetime.now(timezone.utc))),
+            ).rowcount
+            if added:
+                db.execute('UPDATE users SET following_count = following_count + 1 WHERE id = ?', (follower_id,))
+                db.execute('UPDATE users SET followers_count = followers_count + 1 WHERE id = ?', (followed_id,))
+        return bool(added)
+
+    def removeFollow(self, follower_id, followed_id, followed_username):
+        with self._transaction('remove_follow') as db:
+            removed = db.execute('DELETE FROM follows WHERE follower_id = ? AND followed_id = ?', (follower_id, followed_id)).rowcount
+            if removed:
+                db.execute('UPDATE users SET following_count = following_count - 1 WHERE id = ?', (follower_id,))
+                db.execute('UPDATE users SET followers_count = followers_count - 1 WHERE id = ?', (followed_id,))
+        return bool(removed)
+
+    def isFollowing(self, follower_id, followed_id):
+        return bool(self._execute('is_following', 'SELECT 1 FROM follows WHERE follower_id = ? AND followed_id = ?', (follower_id, followed_id)))
+
+    def _follower_ids(self, user_id):
+        return [row['follower_id'] for row in self._execute('follower_ids', 'SELECT follower_id FROM follows WHERE followed_id = ?', (user_id,))]
+
+    def _tweet_row(self, tweet_id):
+        rows = self._execute('get_tweet', 'SELECT * FROM tweets WHERE id = ?', (tweet_id,))
+        return rows[0] if rows else None
+
+    def getTweet(self, tweet_id):
+        row = self._tweet_row(tweet_id)
+        if row is None:
+            return None
+        return StoredTweet(id=row['id'], data=_tweet_data(row), version=row['version'])
+
+    def addTweet(self, tweet_data):
+        tweet_id = uuid.uuid4().hex
+        columns = _columns(tweet_data)
+        self._execute(
+            'add_tweet',
+            f"INSERT INTO tweets (id, {', '.join(columns)}) VALUES (?{', ?' * len(columns)})",
+            (tweet_id, *columns.values()),
+            write=True,
+        )
+        return tweetCard(tweet_id, tweet_data)
+
+    def editTweet(self, tweet, changes):
+        columns = _columns(changes)
+        assignments = ''.join(f'{column} = ?, ' for column in columns)
+        if not self._execute(
+            'edit_tweet',
+            f'UPDATE tweets SET {assignments}version = version + 1 WHERE id = ? AND version = ? RETURNING id',
+            (*columns.values(), tweet.id, tweet.version),
+            write=True,
+        ):
+            raise TweetChanged(f"Tweet {tweet.id} was changed or deleted since it was read")
+        return tweetCard(tweet.id, {**tweet.data, **changes})
+
+    def deleteTweet(self, tweet):
+        if not self._execute('delete_tweet', 'DELETE FROM tweets WHERE id = ? AND version = ? RETURNING id', (tweet.id, tweet.version), write=True):
+            raise TweetChanged(f"Tweet {tweet.id} was changed or deleted since it was read")
+
+    def recordRenditions(self, tweet_id, blob_name, rendition_fields):
+        columns = _columns(rendition_fields)
+        assignments = ''.join(f'{column} = ?, ' for column in columns)
+        return bool(self._execute(
+            'record_renditions',
+            f'UPDATE tweets SET {assignments}version = version + 1 WHERE id = ? AND blob_name = ? RETURNING id',
+            (*columns.values(), tweet_id, blob_name),
+            write=True,
+        ))
+
+    def tweetsByAuthor(self, author_id, cursor=None):
+        after, parameters = _after(cursor)
+        return _page(self._execute('tweets_by_author', f"""
+            SELECT * FROM tweets
+            WHERE author_id = ? {after}
+            ORDER BY date DESC, id DESC LIMIT ?""",
+            (author_id, *parameters, PAGE_SIZE + 1),  # one more than a page, to tell whether there is a next page
+        ))
+
+    def searchTweets(self, query, page=1):
+        query_tokens = tokenize(query)
+        if not query_tokens:
+            return [], False
+        match = ' '.join(f'"{token}"*' for token in query_tokens)  # every word must start one of the tweet's words; tokens hold no quotes
+        start = (page - 1) * SEARCH_PAGE_SIZE
+        rows = self._execute('search_tweets', """
+            SELECT tweets.* FROM tweets_fts JOIN tweets ON tweets.seq = tweets_fts.rowid
+            WHERE tweets_fts MATCH ?
+            ORDER BY tweets_fts.rank, tweets.date DESC LIMIT ? OFFSET ?""",
+            (match, SEARCH_PAGE_SIZE + 1, start),
+        )
+        return [_card(row) for row in rows[:SEARCH_PAGE_SIZE]], len(rows) > SEARCH_PAGE_SIZE
+
+    def timeline(self, user_id, username, cursor=None):
+        after, parameters = _after(cursor)
+        return _page(self._execute('timeline', f"""
+            SELECT * FROM tweets
+            WHERE author_id IN (SELECT followed_id FROM follows WHERE follower_id = ? UNION ALL SELECT ?) {after}
+            ORDER BY date DESC, id DESC LIMIT ?""",
+            (user_id, user_id, *parameters, PAGE_SIZE + 1),
+        ))
+
+    # timelines are read from the follow graph, so the fan-out jobs only tell the open pages about the change
+
+    def pushToFollowerTimelines(self, user_id, tweet_id, notify=None):
+        row = self._tweet_row(tweet_id)
+        if row is not None and notify is not None:
+            notify(self._follower_ids(user_id), 'tweet', _card(row))
+
+    def refreshCardInTimelines(self, user_id, tweet_id, notify=None):
+        row = self._tweet_row(tweet_id)
+        if row is not None and notify is not None:
+            notify([user_id] + self._follower_ids(user_id), 'update', _card(row))
+
+    def removeFromFollowerTimelines(self, user_id, tweet_ids, notify=None):
+        if notify is not None:
+            notify(self._follower_ids(user_id), 'remove', {'ids': list(tweet_ids)})
+
+    def ping(self):
+        self._execute('ping', 'SELECT 1')
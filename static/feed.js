@@ -0,0 +1,106 @@
+// Load the next page of tweets in place when "Load more" is clicked, and keep the
+// first page of the timeline up to date with the tweets pushed over its live connection.
+// The link still works as a plain link to the next page without this script.
+function tweetElements(tweet) {
+    const elements = [];
+
+    const body = document.createElement('p');
+    body.textContent = tweet.body;
+    elements.push(body);
+
+    if (tweet.image_url) {
+        const link = document.createElement('a');
+        link.href = tweet.display_url || tweet.image_url;
+        const image = document.createElement('img');
+        image.src = tweet.thumbnail_url || tweet.image_url;
+        image.alt = 'Image for this tweet';
+        image.height = 100;
+        image.width = 100;
+        image.loading = 'lazy';
+        link.appendChild(image);
+        elements.push(link);
+    }
+
+    const byline = document.createElement('p');
+    byline.style.cssText = 'font-size: smaller; font-style: italic; text-align: right;';
+    byline.textContent = `${tweet.username} on ${tweet.date}`;
+    elements.push(byline, document.createElement('hr'));
+    return elements;
+}
+
+function tweetArticle(tweet) {
+    const article = document.createElement('article');
+    article.dataset.tweetId = tweet.id;
+    article.append(...tweetElements(tweet));
+    return article;
+}
+
+function findTweet(id) {
+    return document.querySelector(`article[data-tweet-id="${CSS.escape(id)}"]`);
+}
+
+function followTimeline(list) {
+    const source = new EventSource(list.dataset.live);
+
+    source.addEventListener('tweet', function (event) {
+        const tweet = JSON.parse(event.data);
+        if (!findTweet(tweet.id)) {
+            list.prepend(tweetArticle(tweet));
+        }
+    });
+    source.addEventListener('update', function (event) {
+        const tweet = JSON.parse(event.data);
+        findTweet(tweet.id)?.replaceWith(tweetArticle(tweet));
+    });
+    source.addEventListener('remove', function (event) {
+        for (const id of JSON.parse(event.data).ids) {
+            findTweet(id)?.remove();
+        }
+    });
+    source.addEventListener('resync', async function () {
+        // events were dropped because this page fell behind, so fetch the top of the timeline again
+        const response = await fetch(list.dataset.api);
+        if (response.ok) {
+            list.replaceChildren(...(await response.json()).tweets.map(tweetArticle));
+        }
+    });
+    source.addEventListener('error', function () {
+        if (source.readyState === EventSource.CLOSED) {
+            setTimeout(() => followTimeline(list), 30000);  // the server refused the connection, try again later
+        }
+    });
+}
+
+window.addEventListener('load', function () {
+    const list = document.getElementById('tweets');
+    if (list && list.dataset.live && window.EventSource) {
+        followTimeline(list);
+    }
+
+    const loadMore = document.getElementById('load-more');
+    if (!loadMore) {
+        return;
+    }
+
+    loadMore.addEventListener('click', async function (event) {
+        event.preventDefault();
+        const response = await fetch(`${loadMore.dataset.api}?cursor=${encodeURIComponent(loadMore.dataset.cursor)}`);
+        if (!response.ok) {
+            window.location.href = loadMore.href;  // fall back to loading the next page
+            return;
+        }
+
+        const page = await response.json();
+        for (const tweet of page.tweets) {
+            loadMore.before(tweetArticle(tweet));
+        }
+        if (page.next_cursor) {
+            loadMore.dataset.cursor = page.next_cursor;
+            const next = new URL(loadMore.href);
+            next.searchParams.set('cursor', page.next_cursor);
+            loadMore.href = next;
+        } else {
+            loadMore.remove();
+        }
+    });
+});
@@ -0,0 +1,214 @@
+"""Storage of uploaded images.
+
+One `StorageService` is created when the app starts and shared by every
+request, so uploads and deletes reuse the same credentials and pooled
+keep-alive HTTP connections instead of bootstrapping a new client each time.
+
+The service writes through a backend. `GCSBackend` stores files in the Cloud
+Storage bucket; `LocalBackend` stores them in a local directory, for running
+the app and its tests without Google Cloud. The Cloud Storage backend is
+created on first use, so creating the service does not wait for credentials to
+be discovered; `warm` creates it ahead of the first request. Every file is
+uploaded under a new name, so files are stored with their content type and a
+Cache-Control that lets browsers and caches keep them for good (the local
+backend's files get the same header from the route serving them, see
+`assets.ImmutableFiles`). The backend and its connection,
+timeout and retry settings are chosen with environment variables:
+
+- STORAGE_BACKEND: `gcs` or `local`, the default when DATA_BACKEND is `sqlite` and `gcs` otherwise
+- STORAGE_LOCAL_ROOT: the directory used by the local backend
+- STORAGE_POOL_SIZE: the most keep-alive connections kept open to Cloud Storage
+- STORAGE_TIMEOUT: the seconds to wait for a Cloud Storage request
+- STORAGE_RETRY_DEADLINE: the seconds to keep retrying a failed Cloud Storage request
+- STORAGE_CHUNK_SIZE: the bytes sent per request when a large file is uploaded in chunks
+"""
+import os
+import shutil
+from pathlib import Path
+from typing import Protocol
+import google.auth
+from google.auth.transport.requests import AuthorizedSession, Request
+from google.cloud import storage
+from google.cloud.storage.retry import DEFAULT_RETRY
+from requests.adapters import HTTPAdapter
+from lifecycle import Lazy
+
+FILE_CACHE_CONTROL = 'public, max-age=31536000, immutable'  # stored files are never overwritten, a new upload gets a new name
+
+
+class StorageBackend(Protocol):
+    """Somewhere to keep uploaded files."""
+
+    def upload(self, name, file_obj, content_type=None, size=None, cache_control=None):
+        """Store the contents of a file object under `name`, with the Cache-Control it is to be served with."""
+
+    def uploadString(self, name, data, content_type):
+        """Store a string under `name`."""
+
+    def download(self, name):
+        """Return the contents of the file stored under `name`."""
+
+    def delete(self, name):
+        """Delete the file stored under `name`."""
+
+    def publicUrl(self, name):
+        """Return the URL the file stored under `name` is served from."""
+
+    def warm(self):
+        """Get ready to serve the first request, e.g. fetch credentials."""
+
+
+class GCSBackend:
+    """Store files in a Cloud Storage bucket through one pooled, authorized HTTP session.
+
+    Args:
+        project: the Google Cloud project of the bucket.
+        bucket_name: the name of the bucket.
+        pool_size: the most keep-alive connections kept open to Cloud Storage.
+        timeout: the seconds to wait for each request.
+        retry_deadline: the seconds to keep retrying a request that failed with a transient error.
+        chunk_size: the bytes sent per request when a file too large for a single request is uploaded.
+    """
+
+    def __init__(self, project, bucket_name, pool_size=10, timeout=60, retry_deadline=120, chunk_size=4 * 1024 * 1024):
+        credentials, _ = google.auth.default(scopes=storage.Client.SCOPE)
+        self.credentials = credentials
+        session = AuthorizedSession(credentials)
+        session.mount('https://', HTTPAdapter(pool_connections=1, pool_maxsize=pool_size))
+        self.client = storage.Client(project=project, credentials=credentials, _http=session)
+        self.bucket = self.client.bucket(bucket_name)
+        self.timeout = timeout
+        self.retry = DEFAULT_RETRY.with_deadline(retry_deadline)  # every upload goes to a fresh name, so a retried one can only write the same bytes again
+        self.chunk_size = chunk_size
+
+    def upload(self, name, file_obj, content_type=None, size=None, cache_control=None):
+        # files up to 8MB of known size go up in one request, larger ones as a resumable upload of `chunk_size` chunks
+        blob = self.bucket.blob(name, chunk_size=self.chunk_size)
+        blob.cache_control = cache_control  # sent as metadata with the upload, and served by Cloud Storage
+        blob.upload_from_file(file_obj, size=size, content_type=content_type, timeout=self.timeout, retry=self.retry)
+
+    def uploadString(self, name, data, content_type):
+        self.bucket.blob(name).upload_from_string(data, content_type=content_type, timeout=self.timeout, retry=self.retry)
+
+    def download(self, name):
+        return self.bucket.blob(name).download_as_bytes(timeout=self.timeout, retry=self.retry)
+
+    def delete(self, name):
+        self.bucket.delete_blob(name, timeout=self.timeout, retry=self.retry)
+
+    def publicUrl(self, name):
+        return self.bucket.blob(name).public_url
+
+    def warm(self):
+        self.credentials.refresh(Request())  # fetch an access token now rather than in the first upload
+
+
+class LocalBackend:
+    """Store files in a local directory.
+
+    Args:
+        root: the directory the files are stored in.
+        base_url: the URL prefix the directory is served from.
+    """
+
+    def __init__(self, root, base_url='/media/'):
+        self.root = Path(root)  # created by `warm`
+        self.base_url = base_url
+
+    def _path(self, name):
+        path = (self.root / name).resolve()
+        if not path.is_relative_to(self.root.resolve()):
+            raise ValueError(f"Invalid file name {name}")
+        return path
+
+    def upload(self, name, file_obj, content_type=None, size=None, cache_control=None):
+        path = self._path(name)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with open(path, 'wb') as destination:
+            shutil.copyfileobj(file_obj, destination)
+
+    def uploadString(self, name, data, content_type):
+        path = self._path(name)
+        if name.endswith('/'):
+            path.mkdir(parents=True, exist_ok=True)  # an empty "directory" blob
+            return
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text(data)
+
+    def download(self, name):
+        return self._path(name).read_bytes()
+
+    def delete(self, name):
+        self._path(name).unlink(missing_ok=True)
+
+    def publicUrl(self, name):
+        return self.base_url + name
+
+    def warm(self):
+        self.root.mkdir(parents=True, exist_ok=True)
+
+
+class StorageService:
+    """The operations the app performs on stored images."""
+
+    def __init__(self, backend: StorageBackend):
+        self.backend = backend
+
+    def addDirectory(self, directory_name: str):
+        """Add an empty directory to the storage bucket.
+
+        Args:
+            directory_name: the name of the directory to add.
+        """
+        directory_name = directory_name + '/'  # dir names must end with a /
+        self.backend.uploadString(directory_name, "", content_type="application/x-www-form-urlencoded:charset=UTF-8")
+
+    def uploadFile(self, blob_name: str, file_obj, content_type: str, size: int | None = None):
+        """Add a file to the storage bucket.
+
+        Args:
+            blob_name: the name to store the file under.
+            file_obj: the file object to read the contents from.
+            content_type: the MIME type of the file.
+            size: the size of the file in bytes, if known.
+        Returns:
+            the public url of the file.
+        """
+        self.backend.upload(blob_name, file_obj, content_type=content_type, size=size, cache_control=FILE_CACHE_CONTROL)
+        return self.backend.publicUrl(blob_name)
+
+    def readFile(self, blob_name: str):
+        """Read a file from the storage bucket.
+
+        Args:
+            blob_name: the name of the blob to read.
+        Returns:
+            the contents of the file.
+        """
+        return self.backend.download(blob_name)
+
+    def deleteFile(self, blob_name: str):
+        """Delete a file in the storage bucket.
+
+        Args:
+            blob_name: the name of the blob to be deleted.
+        """
+        self.backend.delete(blob_name)
+
+    def warm(self):
+        """Create the backend and fetch its credentials ahead of the first request."""
+        self.backend.warm()
+
+
+def createStorageService(project, bucket_name):
+    """Create the storage service configured by the STORAGE_* environment variables."""
+    if os.environ.get('STORAGE_BACKEND', 'local' if os.environ.get('DATA_BACKEND') == 'sqlite' else 'gcs') == 'local':
+        return StorageService(LocalBackend(os.environ.get('STORAGE_LOCAL_ROOT', 'media')))
+    return StorageService(Lazy(lambda: GCSBackend(
+        project,
+        bucket_name,
+        pool_size=int(os.environ.get('STORAGE_POOL_SIZE', 10)),
+        timeout=float(os.environ.get('STORAGE_TIMEOUT', 60)),
+        retry_deadline=float(os.environ.get('STORAGE_RETRY_DEADLINE', 120)),
+        chunk_size=int(os.environ.get('STORAGE_CHUNK_SIZE', 4 * 1024 * 1024)),
+    )))
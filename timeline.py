@@ -0,0 +1,201 @@
+"""Fan-out-on-write home timelines.
+
+Every user owns a single ``Timeline/{user_id}`` document holding the newest
+``TIMELINE_SIZE`` entries of their home timeline, newest first. Each entry is
+the card of a tweet (see `cards.py`), so a page of the timeline is rendered
+from this one document, and the timeline can be kept sorted and trimmed
+without reading the tweets themselves. When a card changes, the timelines of
+its author and their followers are refreshed with `refreshCardInTimelines`.
+
+The entries are kept under the ``cards`` field. Timelines from before cards,
+which kept their entries under ``entries``, are rebuilt on their next read.
+"""
+import functools
+from google.cloud import firestore
+from google.cloud.firestore_v1.base_query import FieldFilter
+from cards import cardRef
+from follows import followerIds, followingUsernames
+from tweets import PAGE_SIZE, decodeCursor, encodeCursor
+
+TIMELINE_SIZE = 200  # number of entries kept in each user's timeline, the furthest back it can be paged
+IN_QUERY_LIMIT = 30  # Firestore caps the number of values in an `in` filter
+
+
+def _chunks(values, size=IN_QUERY_LIMIT):
+    """Split a list of values into lists small enough for an `in` filter."""
+    values = list(values)
+    for start in range(0, len(values), size):
+        yield values[start:start + size]
+
+
+def _entry_key(entry):
+    """Return the key for sorting timeline entries, newest first."""
+    return (entry['date'], entry['id'])
+
+
+def _merge(entries, new_entries):
+    """Merge new entries into a timeline, dropping duplicates and trimming to size."""
+    merged = {entry['id']: entry for entry in entries}
+    for entry in new_entries:
+        merged[entry['id']] = entry
+    return sorted(merged.values(), key=_entry_key, reverse=True)[:TIMELINE_SIZE]
+
+
+def _updated_timeline(update, snapshot):
+    """Return the timeline document with `update` applied to its entries, or None if it has not been built."""
+    if not snapshot.exists or 'cards' not in snapshot.to_dict():
+        return None  # the timeline has not been built yet, readTimeline will build it from scratch
+    return {'cards': update(snapshot.get('cards'))}
+
+
+@firestore.transactional
+def _update_timeline(transaction, timeline_ref, update):
+    """Apply `update` to the entries of a timeline document inside a transaction."""
+    data = _updated_timeline(update, timeline_ref.get(transaction=transaction))
+    if data is not None:
+        transaction.set(timeline_ref, data)
+
+
+@firestore.transactional
+def _build_timeline(transaction, timeline_ref, entries):
+    """Store a newly built timeline, unless it was built meanwhile, e.g. by another request, and return its entries.
+
+    A timeline built meanwhile may already hold tweets fanned out to it since, so it is kept as it is.
+    """
+    snapshot = timeline_ref.get(transaction=transaction)
+    if snapshot.exists and 'cards' in snapshot.to_dict():
+        return snapshot.get('cards')
+    transaction.set(timeline_ref, {'cards': entries})
+    return entries
+
+
+def _apply(db, user_ids, update, unit_of_work=None):
+    """Run `update` against the timeline of every user in `user_ids`, or stage it on `unit_of_work`."""
+    for user_id in set(user_ids):
+        timeline_ref = db.collection('Timeline').document(user_id)
+        if unit_of_work is None:
+            _update_timeline(db.transaction(), timeline_ref, update)
+        else:
+            unit_of_work.modify(timeline_ref, functools.partial(_updated_timeline, update))
+
+
+def pushToTimelines(db, user_ids, entries, unit_of_work=None):
+    """Add timeline entries to the timelines of the given users."""
+    _apply(db, user_ids, lambda current: _merge(current, entries), unit_of_work)
+
+
+def removeFromTimelines(db, user_ids, tweet_ids, unit_of_work=None):
+    """Remove the given tweets from the timelines of the given users."""
+    tweet_ids = set(tweet_ids)
+    _apply(db, user_ids, lambda current: [entry for entry in current if entry['id'] not in tweet_ids], unit_of_work)
+
+
+def replaceInTimelines(db, user_ids, card, unit_of_work=None):
+    """Replace the entry of a tweet with its updated card, in the timelines of the given users that hold it."""
+    _apply(db, user_ids, lambda current: [card if entry['id'] == card['id'] else entry for entry in current], unit_of_work)
+
+
+def removeAuthorFromTimeline(db, user_id, username):
+    """Remove every tweet by `username` from the timeline of `user_id`."""
+    _apply(db, [user_id], lambda current: [entry for entry in current if entry['username'] != username])
+
+
+def pushToFollowerTimelines(db, user_id, tweet_id, notify=None):
+    """Add a tweet to the timelines of its author's followers, unless it has been deleted meanwhile.
+
+    Run as a background job after the tweet was added to its author's own timeline.
+
+    Args:
+        notify: called with the ids of the users whose timelines changed, `'tweet'` and the card.
+    """
+    card = cardRef(db, tweet_id).get()
+    if card.exists:
+        follower_ids = followerIds(db, user_id)
+        pushToTimelines(db, follower_ids, [card.to_dict()])
+        if notify is not None:
+            notify(follower_ids, 'tweet', card.to_dict())
+
+
+def refreshCardInTimelines(db, user_id, tweet_id, notify=None):
+    """Replace the entry of a tweet with its current card in the timelines of its author and their followers.
+
+    Run as a background job after the card changed.
+
+    Args:
+        notify: called with the ids of the users whose timelines changed, `'update'` and the card.
+    """
+    card = cardRef(db, tweet_id).get()
+    if card.exists:
+        user_ids = [user_id] + followerIds(db, user_id)
+        replaceInTimelines(db, user_ids, card.to_dict())
+        if notify is not None:
+            notify(user_ids, 'update', card.to_dict())
+
+
+def removeFromFollowerTimelines(db, user_id, tweet_ids, notify=None):
+    """Remove tweets from the timelines of their author's followers.
+
+    Run as a background job after the tweets were removed from their author's own timeline.
+
+    Args:
+        notify: called with the ids of the users whose timelines changed, `'remove'` and the tweet ids under `ids`.
+    """
+    follower_ids = followerIds(db, user_id)
+    removeFromTimelines(db, follower_ids, tweet_ids)
+    if notify is not None:
+        notify(follower_ids, 'remove', {'ids': list(tweet_ids)})
+
+
+def addAuthorToTimeline(db, user_id, username):
+    """Merge the latest tweets by `username` into the timeline of `user_id`."""
+    pushToTimelines(db, [user_id], latestEntries(db, [username]))
+
+
+def latestEntries(db, usernames):
+    """Query the newest tweets posted by any of the given users, as timeline entries.
+
+    The query is served by the composite index on the cards' `(username, date)`, listed in `firestore.indexes.json`.
+    """
+    entries = []
+    for chunk in _chunks(usernames):
+        tweets_query = (
+            db.collection('TweetCard')
+            .where(filter=FieldFilter('username', 'in', chunk))
+            .order_by('date', direction=firestore.Query.DESCENDING)
+            .limit(TIMELINE_SIZE)
+        )
+        entries.extend(card.to_dict() for card in tweets_query.get())
+    return _merge([], entries)
+
+
+def timelinePage(entries, cursor=None):
+    """Take a page of timeline entries.
+
+    Args:
+        entries: the entries of a timeline, newest first.
+        cursor: the cursor returned with the previous page, if any.
+    Returns:
+        a tuple of the entries on the page and the cursor of the next page, or None if it is the last.
+    """
+    if cursor:
+        after = decodeCursor(cursor)
+        entries = [entry for entry in entries if _entry_key(entry) < after]
+    if len(entries) <= PAGE_SIZE:
+        return entries, None
+    last = entries[PAGE_SIZE - 1]
+    return entries[:PAGE_SIZE], encodeCursor(last['date'], last['id'])
+
+
+def readTimeline(db, user_id, username):
+    """Return the timeline entries of a user, newest first.
+
+    Timelines are built on first use for users who predate the timeline store or tweet cards,
+    from the latest tweets of the user and the people they follow.
+    """
+    timeline_ref = db.collection('Timeline').document(user_id)
+    snapshot = timeline_ref.get()
+    if snapshot.exists and 'cards' in snapshot.to_dict():
+        return snapshot.get('cards')
+
+    entries = latestEntries(db, [username] + followingUsernames(db, user_id))
+    return _build_timeline(db.transaction(), timeline_ref, entries)
@@ -0,0 +1,137 @@
+"""Loading tweets for display.
+
+Templates are only ever given plain tweet records (dicts), never Firestore
+references or snapshots, so rendering a page cannot trigger database reads.
+
+Lists of tweets are built from tweet cards (see `cards.py`), never the Tweet
+documents themselves. Tweets belong to their author through the `author_id`
+field, the id of the author's User document, and a user's tweets are found
+with an indexed query of their cards on `(author_id, date)` rather than a list
+kept on the User document. The composite indexes these queries need are listed
+in `firestore.indexes.json`.
+
+Lists of tweets are paginated with keyset cursors on `(date, tweet id)`, newest
+first. A cursor names the last tweet of a page, and the next page starts
+right after it, so each page is a single bounded read however deep it is.
+
+Running this module sets `author_id` on tweets posted before it existed and
+removes the `tweets` lists from user documents.
+"""
+from datetime import datetime
+from google.cloud import firestore
+from google.cloud.firestore_v1.base_query import FieldFilter
+from cards import cardRef
+from read_cache import tweetKey
+
+PAGE_SIZE = 20  # number of tweets shown per page
+
+
+def tweetJson(tweet):
+    """Convert a tweet record into the fields sent by the JSON API."""
+    return {
+        'id': tweet['id'],
+        'username': tweet['username'],
+        'body': tweet['body'],
+        'date': str(tweet['date']),  # formatted the same way the pages show it
+        'image_url': tweet.get('image_url', ''),
+        'thumbnail_url': tweet.get('thumbnail_url', ''),
+        'display_url': tweet.get('display_url', ''),
+    }
+
+
+def _read_cards(db, tweet_refs):
+    return {card.id: card.to_dict() for card in db.get_all([cardRef(db, ref.id) for ref in tweet_refs]) if card.exists}
+
+
+def hydrateTweets(db, tweet_refs, cache=None):
+    """Load the cards of a list of tweet references with a single batched read.
+
+    Args:
+        tweet_refs: the DocumentReferences of the tweets to load.
+        cache: the read cache to take cards from, reading only the ones it is missing.
+    Returns:
+        the tweet cards in the same order as `tweet_refs`, skipping tweets that no longer exist.
+    """
+    tweet_refs = list(tweet_refs)
+    if not tweet_refs:
+        return []
+    if cache is None:
+        tweets = _read_cards(db, tweet_refs)
+    else:
+        refs = {tweetKey(ref.id): ref for ref in tweet_refs}
+        cached = cache.getMany(refs, lambda keys: {
+            tweetKey(tweet_id): card for tweet_id, card in _read_cards(db, [refs[key] for key in keys]).items()
+        })
+        tweets = {record['id']: record for record in cached.values()}
+    return [tweets[ref.id] for ref in tweet_refs if ref.id in tweets]
+
+
+def encodeCursor(date, tweet_id):
+    """Return the cursor of the page that follows the tweet with the given date and id."""
+    return f"{date.isoformat()}/{tweet_id}"
+
+
+def decodeCursor(cursor):
+    """Split a cursor into the date and id of the tweet it follows.
+
+    Raises:
+        ValueError: if the cursor is malformed.
+    """
+    date, tweet_id = cursor.rsplit('/', 1)
+    date = datetime.fromisoformat(date)
+    if date.tzinfo is None:
+        raise ValueError(f"Cursor {cursor} has no timezone")
+    return date, tweet_id
+
+
+def tweetsByAuthor(db, author_id, cursor=None):
+    """Load a page of the tweets posted by a user, newest first.
+
+    Args:
+        author_id: the id of the author's User document.
+        cursor: the cursor returned with the previous page, if any.
+    Returns:
+        a tuple of the tweet cards on the page and the cursor of the next page, or None if it is the last.
+    """
+    tweets_query = (
+        db.collection('TweetCard')
+        .where(filter=FieldFilter('author_id', '==', author_id))
+        .order_by('date', direction=firestore.Query.DESCENDING)
+        .order_by('__name__', direction=firestore.Query.DESCENDING)
+        .limit(PAGE_SIZE + 1)  # one more than a page, to tell whether there is a next page
+    )
+    if cursor:
+        date, tweet_id = decodeCursor(cursor)
+        tweets_query = tweets_query.start_after({'date': date, '__name__': tweet_id})
+
+    tweets = [card.to_dict() for card in tweets_query.get()]
+    if len(tweets) <= PAGE_SIZE:
+        return tweets, None
+    return tweets[:PAGE_SIZE], encodeCursor(tweets[PAGE_SIZE - 1]['date'], tweets[PAGE_SIZE - 1]['id'])
+
+
+def migrateTweetAuthors(db):
+    """Set `author_id` on every tweet from its author's username, and drop the `tweets` lists of the user documents.
+
+    Returns:
+        the number of tweets migrated.
+    """
+    user_ids = {}
+    writer = db.bulk_writer()
+    for user in db.collection('User').stream():
+        if user.to_dict().get('username'):
+            user_ids[user.get('username')] = user.id
+        writer.update(user.reference, {'tweets': firestore.DELETE_FIELD})
+
+    migrated = 0
+    for tweet in db.collection('Tweet').stream():
+        author_id = user_ids.get(tweet.get('username'))
+        if author_id and tweet.to_dict().get('author_id') != author_id:
+            writer.update(tweet.reference, {'author_id': author_id})
+            migrated += 1
+    writer.close()
+    return migrated
+
+
+if __name__ == '__main__':
+    print(f"Set the author of {migrateTweetAuthors(firestore.Client())} tweets.")
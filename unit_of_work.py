@@ -0,0 +1,107 @@
+"""Grouping the Firestore writes of a request into one atomic commit.
+
+A route that changes several documents, such as posting a tweet (the tweet, its
+search index entry and its author's timeline), stages every write on a
+`UnitOfWork` and commits them together. Either all of them are applied or none
+are, and the request pays for one commit instead of a round trip per document.
+
+Side effects outside Firestore, such as deleting files from storage, are
+registered with `afterCommit` and only run once the commit succeeded, so a
+failed commit never leaves the database pointing at a deleted file.
+"""
+from google.cloud import firestore
+
+TRANSACTION_ATTEMPTS = 5  # commits tried before giving up when the documents read keep changing
+
+
+@firestore.transactional
+def _commit_in_transaction(transaction, unit):
+    """Read the documents `unit` modifies and stage all of its writes inside a transaction."""
+    refs = [ref for kind, ref, _ in unit._writes if kind == 'modify']
+    snapshots = {snapshot.reference.path: snapshot for snapshot in transaction.get_all(refs)}
+    unit._stage(transaction, snapshots)
+
+
+class UnitOfWork:
+    """Collect the Firestore writes of one operation and commit them together.
+
+    Writes are staged with `set`, `update` and `delete`, as on a WriteBatch, and
+    writes depending on the current state of a document with `modify`. `commit`
+    applies them in order in a single WriteBatch, or in a transaction if any of
+    them has to read first, which Firestore retries if a document read changes
+    before the commit.
+
+    Args:
+        db: the Firestore client.
+        max_attempts: the commits tried when the documents read keep changing.
+    """
+
+    def __init__(self, db, max_attempts=TRANSACTION_ATTEMPTS):
+        self.db = db
+        self.max_attempts = max_attempts
+        self._writes = []  # (kind, DocumentReference, argument)
+        self._after_commit = []  # (function, args, kwargs)
+
+    def set(self, ref, data, merge=False):
+        """Stage setting the fields of a document, replacing it unless `merge` is true."""
+        self._writes.append(('set', ref, (data, merge)))
+
+    def update(self, ref, data, option=None):
+        """Stage updating fields of a document. The commit fails if the document does not exist.
+
+        Args:
+            option: a write option, e.g. `db.write_option(last_update_time=...)` to fail the commit
+                if the document changed since it was read.
+        """
+        self._writes.append(('update', ref, (data, option)))
+
+    def delete(self, ref, option=None):
+        """Stage deleting a document, with an optional write option as for `update`."""
+        self._writes.append(('delete', ref, option))
+
+    def modify(self, ref, change):
+        """Stage a write computed from the current state of a document.
+
+        Args:
+            change: called with the DocumentSnapshot of the document read in the commit, returns the
+                fields to set, or None to leave the document as it is. It is called again if the
+                transaction is retried, so it must not have side effects.
+        """
+        self._writes.append(('modify', ref, change))
+
+    def afterCommit(self, function, *args, **kwargs):
+        """Run `function(*args, **kwargs)` once the writes have been committed, e.g. to delete a file."""
+        self._after_commit.append((function, args, kwargs))
+
+    def _stage(self, writer, snapshots=None):
+        for kind, ref, argument in self._writes:
+            if kind == 'set':
+                data, merge = argument
+                writer.set(ref, data, merge=merge)
+            elif kind == 'update':
+                data, option = argument
+                writer.update(ref, data, option=option)
+            elif kind == 'delete':
+                writer.delete(ref, option=argument)
+            else:
+                data = argument(snapshots[ref.path])
+                if data is not None:
+                    writer.set(ref, data)
+
+    def commit(self):
+        """Commit the staged writes, then run the side effects registered with `afterCommit`.
+
+        The side effects run in the order they were registered. One that fails is logged and the
+        rest still run, since the writes they follow up on are already committed.
+        """
+        if any(kind == 'modify' for kind, _, _ in self._writes):
+            _commit_in_transaction(self.db.transaction(max_attempts=self.max_attempts), self)
+        elif self._writes:
+            batch = self.db.batch()
+            self._stage(batch)
+            batch.commit()
+        for function, args, kwargs in self._after_commit:
+            try:
+                function(*args, **kwargs)
+            except Exception as err:
+                print(f"Could not run {getattr(function, '__name__', function)} after commit: {err}")
@@ -0,0 +1,165 @@
+"""The signed in user of a request, and the registry of usernames.
+
+Every username taken is reserved by a ``Username/{username}`` document holding
+the id of the user who claimed it. The reservation and the user's `username`
+field are written in one transaction, so two users can never end up with the
+same username, and finding a user by username is a single document read.
+
+Running this module builds the registry from the usernames of existing users.
+"""
+from dataclasses import dataclass
+from types import MappingProxyType
+from typing import Mapping
+from google.api_core.exceptions import AlreadyExists
+from google.cloud import firestore
+from read_cache import userKey, usernameKey
+from search_index import normalizeUsername
+
+USERNAME_MAX_LENGTH = 50  # longest username accepted
+
+
+@dataclass(frozen=True)
+class CurrentUser:
+    """The signed in user, loaded from the repository once per request."""
+    user_id: str  # the Firebase uid, also the id of the User document
+    token: Mapping  # the verified claims of the Firebase ID token
+    username: str  # empty until the user has chosen a username
+    following_count: int  # number of users this user follows
+    followers_count: int  # number of users who follow this user
+
+
+def newUserData():
+    """Return the fields of the User document created on first login."""
+    return {
+        "username": "",  # username for this user
+        "following_count": 0,  # the number of users this user follows, kept in step with the follow graph (see `follows.py`)
+        "followers_count": 0,  # the number of users who follow this user
+    }
+
+
+def userData(db, cache, user_id):
+    """Return the fields of a User document through the read cache, or None if it does not exist."""
+    def read():
+        snapshot = db.collection('User').document(user_id).get()
+        return snapshot.to_dict() if snapshot.exists else None
+    return cache.get(userKey(user_id), read)
+
+
+class UsernameRejected(ValueError):
+    """A username that cannot be claimed, with a message to show the user."""
+
+
+def checkUsername(username):
+    """Check that a username can be used as the id of its registry document.
+
+    Raises:
+        UsernameRejected: if the username is empty, too long or has characters Firestore does not allow in ids.
+    """
+    if not username.strip():
+        raise UsernameRejected("Please choose a username.")
+    if len(username) > USERNAME_MAX_LENGTH:
+        raise UsernameRejected(f"Usernames must be at most {USERNAME_MAX_LENGTH} characters long.")
+    if '/' in username or username in ('.', '..') or (username.startswith('__') and username.endswith('__')):
+        raise UsernameRejected("Usernames cannot contain / or be . or .. or start and end with __.")
+
+
+def _registry_ref(db, username):
+    return db.collection('Username').document(username)
+
+
+@firestore.transactional
+def _claim_username(transaction, db, user_id, username):
+    registry_ref = _registry_ref(db, username)
+    user_ref = db.collection('User').document(user_id)
+    claim = registry_ref.get(transaction=transaction)
+    user = user_ref.get(transaction=transaction)
+    if claim.exists and claim.get('user_id') != user_id:
+        raise UsernameRejected("This username is already taken.")
+    if user.exists and user.to_dict().get('username') not in ('', username):
+        raise UsernameRejected("You have already chosen a username.")
+    transaction.set(registry_ref, {'user_id': user_id})
+    transaction.update(user_ref, {'username': username, 'username_lower': normalizeUsername(username)})
+
+
+def claimUsername(db, user_id, username):
+    """Reserve a username for a user and set it on their User document, atomically.
+
+    Raises:
+        UsernameRejected: if the username is invalid or taken, or the user already has another one.
+    """
+    checkUsername(username)
+    _claim_username(db.transaction(), db, user_id, username)
+
+
+def userIdForUsername(db, cache, username):
+    """Return the User document id of a username through the read cache, or None if nobody has it."""
+    try:
+        checkUsername(username)
+    except UsernameRejected:
+        return None  # nobody can have claimed it
+
+    def read():
+        claim = _registry_ref(db, username).get()
+        return claim.get('user_id') if claim.exists else None
+    return cache.get(usernameKey(username), read)
+
+
+def loadUser(db, cache, user_token):
+    """Load the signed in user with at most a single read, creating their document if it does not exist.
+
+    Args:
+        cache: the read cache holding recently read User documents.
+        user_token: the verified claims of the user's Firebase ID token.
+    """
+    user_ref = db.collection('User').document(user_token['user_id'])
+    user_data = userData(db, cache, user_ref.id)
+    if user_data is None:
+        user_data = newUserData()
+        try:
+            user_ref.create(user_data)  # fails instead of overwriting if a concurrent request created the user first
+        except AlreadyExists:
+            user_data = user_ref.get().to_dict()
+        cache.set(userKey(user_ref.id), user_data)
+
+    return CurrentUser(
+        user_id=user_ref.id,
+        token=MappingProxyType(dict(user_token)),
+        username=user_data['username'],
+        following_count=user_data.get('following_count', 0),
+        followers_count=user_data.get('followers_count', 0),
+    )
+
+
+def rebuildUsernameRegistry(db):
+    """Reserve the usernames of existing users who have no registry document yet.
+
+    Usernames held by more than one user are reserved for the first one found and
+    the others are printed, to be renamed by hand.
+
+    Returns:
+        the number of usernames reserved.
+    """
+    claimed = {claim.id: claim.get('user_id') for claim in db.collection('Username').stream()}
+    writer = db.bulk_writer()
+    reserved = 0
+    for user in db.collection('User').stream():
+        username = user.to_dict().get('username')
+        if not username or claimed.get(username) == user.id:
+            continue
+        if username in claimed:
+            print(f"Username {username} of user {user.id} is already held by user {claimed[username]}")
+            continue
+        try:
+            checkUsername(username)
+        except UsernameRejected as err:
+            print(f"Username {username} of user {user.id} cannot be reserved: {err}")
+            continue
+        writer.create(_registry_ref(db, username), {'user_id': user.id})
+        claimed[username] = user.id
+        reserved += 1
+    writer.close()
+    return reserved
+
+
+if __name__ == '__main__':
+    print(f"Reserved {rebuildUsernameRegistry(firestore.Client())} usernames.")
@@ -0,0 +1,71 @@
+"""View models passed to the templates.
+
+Routes load everything a page shows before rendering it and hand the templates
+these small immutable objects, never Firestore snapshots or references, so a
+template cannot trigger a read and rendering can be timed and cached on its
+own.
+"""
+from dataclasses import dataclass
+from datetime import datetime
+
+
+@dataclass(frozen=True, slots=True)
+class TweetView:
+    """A tweet as shown in a list of tweets."""
+    id: str
+    username: str  # the author
+    body: str
+    date: datetime
+    image_url: str  # the original image, empty if the tweet has none
+    thumbnail_url: str  # empty until the thumbnail has been made
+    display_url: str  # empty until the display sized rendition has been made
+
+    @classmethod
+    def fromRecord(cls, record):
+        """Build the view of a tweet record, such as a tweet card."""
+        return cls(
+            id=record['id'],
+            username=record['username'],
+            body=record['body'],
+            date=record['date'],
+            image_url=record.get('image_url', ''),
+            thumbnail_url=record.get('thumbnail_url', ''),
+            display_url=record.get('display_url', ''),
+        )
+
+    @property
+    def image_src(self):
+        """The image shown in the list, the thumbnail once it has been made."""
+        return self.thumbnail_url or self.image_url
+
+    @property
+    def image_link(self):
+        """The image opened from the list, the display sized rendition once it has been made."""
+        return self.display_url or self.image_url
+
+
+def tweetViews(records):
+    """Build the views of a list of tweet records."""
+    return [TweetView.fromRecord(record) for record in records]
+
+
+@dataclass(frozen=True, slots=True)
+class UserCard:
+    """A user as shown in a list of users."""
+    user_id: str
+    username: str
+
+    @classmethod
+    def fromSnapshot(cls, snapshot):
+        """Build the card of a User DocumentSnapshot."""
+        return cls(user_id=snapshot.id, username=snapshot.get('username'))
+
+
+@dataclass(frozen=True, slots=True)
+class ProfileHeader:
+    """The top of a profile page."""
+    username: str
+    following: int  # number of users this user follows
+    followers: int  # number of users following this user
+    is_own: bool  # whether the profile is the signed in user's
+    is_following: bool = False  # whether the signed in user follows this user